@@ -0,0 +1,192 @@
+# Headless Batch Pipeline for the Nutritional Planning/Tracking App
+#
+# Description: Runs the same stages as the Submit button (BMI, nutritional plan, QR code, BMI chart and saving
+# the user's history) for a whole file of users without opening a window. Records are streamed from a CSV file
+# or a SQLite database, the rendering stages are spread over a pool of processes and every record gets its own
+# result, so one bad row does not stop the batch.
+#
+# Usage: python batch_pipeline.py users.csv --output-dir batch_output --workers 8 --report results.csv
+
+#--------------------------------------- Imports ---------------------------------------
+
+import os
+os.environ.setdefault("MPLBACKEND", "Agg")          # Batch jobs have no display, render off-screen
+
+import argparse
+import csv
+import sqlite3
+import sys
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import nutritional_planner as planner
+import planner_db
+import tracing
+from chart_renderer import render_bmi_chart
+
+#--------------------------------------- Constants ---------------------------------------
+
+RECORD_FIELDS = ["profile_name", "weight", "height_ft", "height_in", "goals", "activity_level", "dietary_preferences", "allergies"]
+RESULT_FIELDS = ["index", "profile_name", "bmi", "qr_code_path", "chart_path", "error"]
+
+SQLITE_QUERY = ("SELECT profiles.name AS profile_name, weight, height_ft, height_in, goals, activity_level, dietary_preferences, "
+                "allergies FROM users LEFT JOIN profiles ON profiles.id = users.profile_id")
+
+#--------------------------------------- Functions ---------------------------------------
+
+# Function to stream user records from a CSV file with a header row
+def read_csv_records(path):
+    with open(path, newline='') as file:
+        for row in csv.DictReader(file):
+            yield row
+
+# Function to stream user records from a SQLite database (defaults to the app's users table)
+def read_sqlite_records(path, query=SQLITE_QUERY):
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    try:
+        for row in conn.execute(query):
+            yield dict(row)
+    finally:
+        conn.close()
+
+# Function to pick the right reader from the file extension
+def read_records(path):
+    if path.lower().endswith(".csv"):
+        return read_csv_records(path)
+    return read_sqlite_records(path)
+
+# Function to run the cheap stages (BMI and plan) for one record in the parent process
+def prepare_record(index, record, output_dir):
+    weight = float(record["weight"])
+    height = (int(record["height_ft"]), int(record["height_in"]))
+    bmi = planner.calculate_bmi(weight, height)
+    plan = planner.get_full_plan(bmi, record.get("goals", ""), record.get("activity_level", ""),
+                                 record.get("dietary_preferences", ""), record.get("allergies", ""))
+
+    return {
+        "index": index,
+        "record": record,
+        "weight": weight,
+        "height": height,
+        "bmi": bmi,
+        "plan": plan,
+        "qr_code_path": os.path.join(output_dir, f"qr_code_{index}.png"),       # One file per record so workers never
+        "chart_path": os.path.join(output_dir, f"bmi_chart_{index}.png"),       # overwrite each other's images
+    }
+
+# Function run in a worker process: the expensive rendering stages for one record
+def render_record(job):
+    planner.generate_qr_code(job["plan"], job["qr_code_path"])
+    render_bmi_chart(job["weight"], job["height"], job["bmi"], job["chart_path"])
+    return job
+
+# Function to turn a finished (or failed) job into a result row
+def make_result(job, error=None):
+    return {
+        "index": job["index"],
+        "profile_name": job["record"].get("profile_name", ""),
+        "bmi": job.get("bmi"),
+        "plan": job.get("plan"),
+        "qr_code_path": None if error else job.get("qr_code_path"),
+        "chart_path": None if error else job.get("chart_path"),
+        "error": error,
+    }
+
+# Function to run the whole pipeline; yields one result per record (in completion order)
+def run_pipeline(records, output_dir="batch_output", workers=None, max_pending=None, save=True):
+
+    os.makedirs(output_dir, exist_ok=True)
+    planner.create_db()
+    workers = workers or os.cpu_count() or 1
+    max_pending = max_pending or workers * 4                    # Bound on jobs in flight (backpressure on the reader)
+
+    planner.create_food_options_table(os.path.join(output_dir, "food_options_table.png"))     # Same for every user, render once
+
+    if save:
+        planner_db.enable_write_behind()                        # Group the history inserts into batched transactions
+
+    try:
+        yield from run_jobs(records, output_dir, workers, max_pending, save)
+    finally:
+        if save:
+            planner_db.disable_write_behind()                   # Commit whatever is still waiting
+
+# Function to feed records through the process pool, keeping at most max_pending jobs in flight
+def run_jobs(records, output_dir, workers, max_pending, save):
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = {}
+
+        # Function to collect finished jobs, saving successful ones to the database
+        def drain(block):
+            if not pending:
+                return
+            done, _ = wait(pending, return_when=FIRST_COMPLETED) if block else (
+                [future for future in pending if future.done()], None)
+            for future in done:
+                job = pending.pop(future)
+                error = future.exception()
+                if error is None and save:
+                    try:
+                        record = job["record"]
+                        planner.save_user_data(job["weight"], job["height"][0], job["height"][1], record.get("goals", ""),
+                                               job["bmi"], job["plan"], record.get("activity_level", ""),
+                                               record.get("dietary_preferences", ""), record.get("allergies", ""),
+                                               record.get("profile_name", ""))
+                    except Exception as e:
+                        error = e
+                yield make_result(job, None if error is None else f"{type(error).__name__}: {error}")
+
+        for index, record in enumerate(records):
+            try:
+                job = prepare_record(index, record, output_dir)
+            except Exception as e:
+                yield make_result({"index": index, "record": record}, f"{type(e).__name__}: {e}")
+                continue
+
+            while len(pending) >= max_pending:                  # Queue is full, wait for a worker to finish
+                yield from drain(block=True)
+            pending[pool.submit(render_record, job)] = job
+            yield from drain(block=False)
+
+        while pending:
+            yield from drain(block=True)
+
+# Function for the command line interface
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate plans, QR codes and BMI charts for a batch of users.")
+    parser.add_argument("input", help="CSV file (with a header row) or SQLite database of user records")
+    parser.add_argument("--output-dir", default="batch_output", help="directory for the generated images")
+    parser.add_argument("--workers", type=int, default=None, help="number of rendering processes (default: all cores)")
+    parser.add_argument("--max-pending", type=int, default=None, help="maximum records in flight (default: 4 per worker)")
+    parser.add_argument("--no-save", action="store_true", help="do not save the results to the user history")
+    parser.add_argument("--report", help="write one CSV row per record (paths or error) to this file")
+    args = parser.parse_args(argv)
+
+    report_file = open(args.report, "w", newline='') if args.report else None
+    report = csv.DictWriter(report_file, fieldnames=RESULT_FIELDS, extrasaction="ignore") if report_file else None
+    if report:
+        report.writeheader()
+
+    trace_path = tracing.enable_from_env()             # PLANNER_TRACE=spans.jsonl records the database spans
+    succeeded = failed = 0
+    try:
+        for result in run_pipeline(read_records(args.input), args.output_dir, args.workers, args.max_pending, not args.no_save):
+            if result["error"]:
+                failed += 1
+                print(f"record {result['index']} ({result['profile_name']}): {result['error']}", file=sys.stderr)
+            else:
+                succeeded += 1
+            if report:
+                report.writerow(result)
+    finally:
+        if report_file:
+            report_file.close()
+        if trace_path:
+            tracing.export(trace_path)
+
+    print(f"{succeeded} records processed, {failed} failed")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,342 @@
+# Benchmark Suite for the Nutritional Planning/Tracking App
+#
+# Description: Times the app's hot paths headless (Agg backend, in a temporary working directory): BMI and plan
+# calculation (one user at a time and in bulk), the BMI chart, the food options table, QR codes, saving history rows
+# and the history queries behind "Track Progress" over synthetic databases of 10k to 10M rows. All inputs come from
+# seeded generators, so runs are comparable. Results can be stored as a baseline and later runs compared against it;
+# the comparison fails (exit code 1) when a benchmark got slower than the baseline by more than the threshold.
+#
+# Usage: python benchmarks.py --save-baseline                  (store benchmark_baseline.json)
+#        python benchmarks.py --threshold 0.25                 (compare against it, fail on a >25% regression)
+#        python benchmarks.py --only history --history-rows 10000 10000000
+
+#--------------------------------------- Imports ---------------------------------------
+
+import os
+os.environ.setdefault("MPLBACKEND", "Agg")          # Benchmarks have no display, render off-screen
+
+import argparse
+import datetime
+import json
+import platform
+import random
+import sys
+import tempfile
+import time
+
+import nutritional_planner as planner
+import planner_db
+
+#--------------------------------------- Constants ---------------------------------------
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+SEED = 1234
+DAY = "2024-01-01"                                  # Day of the generated plans (menus and tips change daily)
+THRESHOLD = 0.25                                    # Allowed slowdown before a benchmark counts as a regression
+HISTORY_ROWS = [10_000, 100_000, 1_000_000]         # Sizes of the synthetic history databases (10M with --history-rows)
+HISTORY_PROFILES = 100
+HISTORY_CHUNK = 100_000                             # Rows generated and inserted at a time
+
+HISTORY_INSERT_SQL = ("INSERT INTO users (weight, height_ft, height_in, goals, bmi, plan, activity_level, dietary_preferences, "
+                      "allergies, timestamp, profile_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)")
+
+#--------------------------------------- Synthetic Data ---------------------------------------
+
+# Function to generate a cohort of users as columns (same names as the users table)
+def make_users(count, seed=SEED):
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    return {
+        "weight": rng.uniform(90, 300, count).round(1),
+        "height_ft": rng.integers(4, 7, count),
+        "height_in": rng.integers(0, 12, count),
+        "activity_level": rng.choice(planner.ACTIVITY_LEVELS, count),
+        "dietary_preferences": rng.choice(planner.DIETARY_PREFERENCES, count),
+        "allergies": rng.choice(planner.ALLERGIES, count),
+    }
+
+# Function to generate history rows (as insert_user takes them) for a list of profile names
+def make_history_rows(count, profile_names, seed=SEED):
+    users = make_users(count, seed)
+    rng = random.Random(seed)
+    rows = []
+    for i in range(count):
+        weight, height = float(users["weight"][i]), (int(users["height_ft"][i]), int(users["height_in"][i]))
+        bmi = planner.calculate_bmi(weight, height)
+        plan = planner.get_full_plan(bmi, "", users["activity_level"][i], users["dietary_preferences"][i], users["allergies"][i], DAY)
+        rows.append((weight, height[0], height[1], "", bmi, plan, str(users["activity_level"][i]),
+                     str(users["dietary_preferences"][i]), str(users["allergies"][i]), rng.choice(profile_names)))
+    return rows
+
+# Function to fill a database with `rows` history rows spread over `profiles` profiles, one row every 10 minutes
+def make_history_db(path, rows, profiles=HISTORY_PROFILES, seed=SEED):
+    import numpy as np
+
+    planner_db.migrate(path)
+    rng = np.random.default_rng(seed)
+    start = datetime.datetime(2020, 1, 1)
+    with planner_db.transaction(path) as conn:
+        conn.executemany("INSERT INTO profiles (id, name) VALUES (?, ?)", [(i + 1, f"profile_{i}") for i in range(profiles)])
+
+    for offset in range(0, rows, HISTORY_CHUNK):
+        count = min(HISTORY_CHUNK, rows - offset)
+        weights = rng.uniform(90, 300, count).round(1)
+        height_ft = rng.integers(4, 7, count)
+        height_in = rng.integers(0, 12, count)
+        bmis = planner.calculate_bmi_bulk(weights, height_ft, height_in)
+        plan_codes = planner.classify_bmi_bulk(bmis)
+        profile_ids = rng.integers(1, profiles + 1, count)
+        batch = [(float(weights[i]), int(height_ft[i]), int(height_in[i]), "", float(bmis[i]), planner.PLAN_NAMES[plan_codes[i]],
+                  "Moderate", "None", "None", (start + datetime.timedelta(minutes=10 * (offset + i))).strftime('%Y-%m-%d %H:%M:%S'),
+                  int(profile_ids[i])) for i in range(count)]
+        with planner_db.transaction(path) as conn:
+            last_id = conn.execute("SELECT max(id) FROM users").fetchone()[0] or 0
+            conn.executemany(HISTORY_INSERT_SQL, batch)
+            planner_db.update_rollups(conn, last_id)
+
+#--------------------------------------- Benchmarks ---------------------------------------
+
+# Each benchmark function sets up its inputs and returns (run, operations): run() does the timed work once, and the
+# reported metric is the best run's time divided by the number of operations it performed
+
+# Function to get a render cache in the benchmark's working directory (a temporary directory, see run_benchmarks), so
+# the user's cache is neither read nor filled
+def temp_render_cache():
+    from render_cache import RenderCache
+    return RenderCache(os.path.join(os.getcwd(), "render_cache"))
+
+# Function to benchmark calculate_bmi one user at a time
+def bench_bmi_scalar():
+    users = make_users(100_000)
+    pairs = list(zip(users["weight"].tolist(), zip(users["height_ft"].tolist(), users["height_in"].tolist())))
+    return lambda: [planner.calculate_bmi(weight, height) for weight, height in pairs], len(pairs)
+
+# Function to benchmark calculate_bmi_bulk
+def bench_bmi_bulk():
+    users = make_users(1_000_000)
+    return lambda: planner.calculate_bmi_bulk(users["weight"], users["height_ft"], users["height_in"]), 1_000_000
+
+# Function to benchmark get_nutritional_plan one user at a time
+def bench_plan_scalar():
+    users = make_users(100_000)
+    bmis = planner.calculate_bmi_bulk(users["weight"], users["height_ft"], users["height_in"]).tolist()
+    rows = list(zip(bmis, users["activity_level"].tolist(), users["dietary_preferences"].tolist(), users["allergies"].tolist()))
+    return lambda: [planner.get_nutritional_plan(bmi, "", activity, preferences, allergies)
+                    for bmi, activity, preferences, allergies in rows], len(rows)
+
+# Function to benchmark get_full_plan (plan, menu and tip) one user at a time, memoized
+def bench_full_plan_cached():
+    users = make_users(100_000)
+    bmis = planner.calculate_bmi_bulk(users["weight"], users["height_ft"], users["height_in"]).tolist()
+    rows = list(zip(bmis, users["activity_level"].tolist(), users["dietary_preferences"].tolist(), users["allergies"].tolist()))
+    return lambda: [planner.get_full_plan(bmi, "", activity, preferences, allergies, DAY)
+                    for bmi, activity, preferences, allergies in rows], len(rows)
+
+# Function to benchmark scoring a whole cohort (BMI and plan codes)
+def bench_plan_bulk():
+    users = make_users(1_000_000)
+    return lambda: planner.score_cohort(users), 1_000_000
+
+# Function to benchmark the original pyplot BMI chart
+def bench_chart_pyplot():
+    return lambda: planner.replicate_and_pinpoint_bmi_on_chart(165, (5, 9), "bmi_chart.png"), 1
+
+# Function to benchmark the cached-background BMI chart
+def bench_chart_cached():
+    from chart_renderer import render_bmi_chart
+    cache = temp_render_cache()
+    render_bmi_chart(165, (5, 9), 24.4, cache=cache)                    # Background cache warmed up outside the timing
+    weights = [120 + i for i in range(20)]
+    return lambda: [render_bmi_chart(weight, (5, 9), planner.calculate_bmi(weight, (5, 9)), cache=cache)
+                    for weight in weights], len(weights)
+
+# Function to benchmark drawing the food options table from scratch
+def bench_food_table_render():
+    return planner.render_food_options_table, 1
+
+# Function to benchmark getting a copy of the food options table from the render cache
+def bench_food_table_cached():
+    cache = temp_render_cache()
+    planner.create_food_options_table(cache=cache)
+    return lambda: [planner.create_food_options_table(cache=cache) for _ in range(100)], 100
+
+# Function to benchmark generate_qr_code on distinct plans (so no cached code is reused)
+def bench_qr_code():
+    runs = [0]
+    rows = make_history_rows(50, ["benchmark"])
+
+    # Function to make the codes, new payloads on every run
+    def run():
+        runs[0] += 1
+        for i, row in enumerate(rows):
+            planner.generate_qr_code(f"{row[5]}\nRun {runs[0]}", f"qr_code_{i}.png")
+
+    return run, len(rows)
+
+# Function to benchmark save_user_data, every row its own transaction
+def bench_save_user_data():
+    planner.create_db()
+    rows = make_history_rows(2000, [f"profile_{i}" for i in range(20)])
+    return lambda: [planner.save_user_data(*row) for row in rows], len(rows)
+
+# Function to benchmark save_user_data in write-behind mode (batched transactions), including the final commit
+def bench_save_user_data_write_behind():
+    planner.create_db()
+    rows = make_history_rows(20_000, [f"profile_{i}" for i in range(20)])
+
+    # Function to save every row, then wait until all of them are committed
+    def run():
+        planner_db.enable_write_behind()
+        try:
+            for row in rows:
+                planner.save_user_data(*row)
+        finally:
+            planner_db.disable_write_behind()
+
+    return run, len(rows)
+
+# Function to make the benchmark of the Track Progress queries over a history of `rows` rows
+def make_history_benchmark(rows):
+
+    # Function to benchmark the history and latest-row queries of 20 profiles
+    def bench_history():
+        path = f"history_{rows}.db"
+        make_history_db(path, rows)
+        names = [f"profile_{i}" for i in range(20)]
+        return lambda: [(planner_db.get_bmi_history(name, path), planner_db.get_latest_user(name, path)) for name in names], len(names)
+
+    return bench_history
+
+# Function to make the benchmark of the progress chart series (rollups and downsampling) over a history of `rows` rows
+def make_progress_benchmark(rows):
+
+    # Function to benchmark the whole-history progress series of 20 profiles
+    def bench_progress():
+        import progress_analytics
+
+        path = f"history_{rows}.db"
+        if not os.path.exists(path):
+            make_history_db(path, rows)
+        names = [f"profile_{i}" for i in range(20)]
+        return lambda: [progress_analytics.progress_series(name, path=path) for name in names], len(names)
+
+    return bench_progress
+
+# Function to list the benchmarks to run as (name, setup function)
+def get_benchmarks(history_rows=HISTORY_ROWS):
+    benchmarks = [
+        ("bmi_scalar", bench_bmi_scalar),
+        ("bmi_bulk", bench_bmi_bulk),
+        ("plan_scalar", bench_plan_scalar),
+        ("plan_bulk", bench_plan_bulk),
+        ("full_plan_cached", bench_full_plan_cached),
+        ("chart_pyplot", bench_chart_pyplot),
+        ("chart_cached", bench_chart_cached),
+        ("food_table_render", bench_food_table_render),
+        ("food_table_cached", bench_food_table_cached),
+        ("qr_code", bench_qr_code),
+        ("save_user_data", bench_save_user_data),
+        ("save_user_data_write_behind", bench_save_user_data_write_behind),
+    ]
+    benchmarks += [(f"history_{rows}", make_history_benchmark(rows)) for rows in history_rows]
+    benchmarks += [(f"progress_{rows}", make_progress_benchmark(rows)) for rows in history_rows]
+    return benchmarks
+
+#--------------------------------------- Functions ---------------------------------------
+
+# Function to run one benchmark: returns the best time per operation in seconds over `repeat` runs
+def measure(setup, repeat=3):
+    random.seed(SEED)                               # Menus and tips are random, keep them the same every run
+    run, operations = setup()
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - start)
+    return best / operations
+
+# Function to run the selected benchmarks in a temporary working directory; returns {name: seconds per operation}
+def run_benchmarks(benchmarks, repeat=3, progress=print):
+    results = {}
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="planner_bench_") as directory:
+        os.chdir(directory)                         # The app's database and images go to the temporary directory
+        try:
+            for name, setup in benchmarks:
+                results[name] = measure(setup, repeat)
+                progress(f"{name:<32} {format_time(results[name])}")
+        finally:
+            os.chdir(cwd)
+    return results
+
+# Function to format a time per operation
+def format_time(seconds):
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:8.2f} {unit}/op"
+    return f"{seconds / 1e-9:8.2f} ns/op"
+
+# Function to load a stored baseline ({"machine": ..., "results": {name: seconds per operation}})
+def load_baseline(path=BASELINE_PATH):
+    with open(path) as file:
+        return json.load(file)
+
+# Function to store results as the baseline
+def save_baseline(results, path=BASELINE_PATH):
+    baseline = {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "machine": platform.platform(),
+        "python": platform.python_version(),
+        "results": results,
+    }
+    with open(path, "w") as file:
+        json.dump(baseline, file, indent=2, sort_keys=True)
+
+# Function to compare results with a baseline; prints a report and returns the names of the regressed benchmarks
+def compare(results, baseline, threshold=THRESHOLD):
+    regressions = []
+    print(f"\n{'benchmark':<32} {'baseline':>14} {'current':>14} {'change':>8}")
+    for name, seconds in results.items():
+        old = baseline["results"].get(name)
+        if old is None:
+            print(f"{name:<32} {'-':>14} {format_time(seconds):>14} {'new':>8}")
+            continue
+        change = seconds / old - 1
+        status = ""
+        if change > threshold:
+            regressions.append(name)
+            status = "  REGRESSION"
+        print(f"{name:<32} {format_time(old):>14} {format_time(seconds):>14} {change:+8.1%}{status}")
+
+    if regressions:
+        print(f"\n{len(regressions)} benchmark(s) more than {threshold:.0%} slower than the baseline: {', '.join(regressions)}")
+    return regressions
+
+# Function for the command line interface
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the planner's hot paths and compare them with a baseline.")
+    parser.add_argument("--only", nargs="+", metavar="PREFIX", help="only run benchmarks whose name starts with one of these")
+    parser.add_argument("--history-rows", nargs="+", type=int, default=HISTORY_ROWS, help="sizes of the synthetic histories")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per benchmark, the fastest one counts")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="baseline file (default: %(default)s)")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD, help="allowed slowdown, 0.25 = 25%% (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    benchmarks = get_benchmarks(args.history_rows)
+    if args.only:
+        benchmarks = [(name, setup) for name, setup in benchmarks if name.startswith(tuple(args.only))]
+    results = run_benchmarks(benchmarks, args.repeat)
+
+    if args.save_baseline:
+        save_baseline(results, args.baseline)
+        print(f"\nBaseline saved to {args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f"\nNo baseline at {args.baseline}, run with --save-baseline first")
+        return 0
+    return 1 if compare(results, load_baseline(args.baseline), args.threshold) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
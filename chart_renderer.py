@@ -0,0 +1,162 @@
+# Cached BMI Chart Renderer for the Nutritional Planning/Tracking App
+#
+# Description: Draws the same BMI chart as replicate_and_pinpoint_bmi_on_chart, but the colored BMI background
+# (meshgrid, contours, colorbar, title and labels) is only rasterized once per process, or loaded from the render
+# cache keyed by the chart's ranges, levels and colors. Each user's chart is then just the cached background with
+# the user's "k+" marker and legend drawn on top of it.
+
+#--------------------------------------- Imports ---------------------------------------
+
+import io
+import json
+import struct
+import threading
+import zlib
+
+import matplotlib
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+from render_cache import RenderCache
+
+#--------------------------------------- Constants ---------------------------------------
+
+HEIGHT_RANGE_FT = (4.6, 6.9)                                    # Physical range of heights on x-y plot
+WEIGHT_RANGE_LBS = (100, 250)                                   # Physical range of weights
+GRID_POINTS = 100                                               # Points per axis of the BMI grid
+LEVELS = [10, 15, 20, 25, 30, 40]                               # BMI levels
+COLORS = ['aqua', 'limegreen', 'yellow', 'orange', 'red']       # Colors of BMI categories
+FIGSIZE = (10, 5)
+DPI = 100
+
+_lock = threading.Lock()            # Figures are not thread safe, one chart at a time per process
+_overlay = None                     # (background pixels, layout, marker, legend) once loaded
+
+#--------------------------------------- Functions ---------------------------------------
+
+# Function to build the key that identifies one background (changes whenever anything drawn in it changes)
+def background_key():
+    return RenderCache.key(["bmi_background", HEIGHT_RANGE_FT, WEIGHT_RANGE_LBS, GRID_POINTS, LEVELS, COLORS, FIGSIZE, DPI,
+                            matplotlib.__version__])
+
+# Function to draw the full chart (everything except the user's marker) on a new figure
+def draw_background(fig):
+    ax = fig.add_subplot()
+
+    height_range = np.linspace(*HEIGHT_RANGE_FT, GRID_POINTS)
+    weight_range = np.linspace(*WEIGHT_RANGE_LBS, GRID_POINTS)
+
+    height_range_meters = height_range * 0.3048                                     # Set numerical range of heights (meters)
+    weight_range_kg = weight_range * 0.453592                                       # Set numerical range of weights (kg)
+
+    height_grid, weight_grid = np.meshgrid(height_range_meters, weight_range_kg)    # Create grid using ranges
+    bmi_grid = weight_grid / (height_grid ** 2)                                     # Set BMI category divisions
+
+    contours = ax.contourf(height_grid * 3.28084, weight_grid * 2.20462, bmi_grid, levels=LEVELS, colors=COLORS, alpha=0.8)
+    fig.colorbar(contours, ax=ax, label='BMI')
+
+    ax.set_title('BMI Chart')
+    ax.set_xlabel('Height (ft)')
+    ax.set_ylabel('Weight (lbs)')
+    return ax
+
+# Function to add the user's marker and legend to an axes
+def add_marker(ax, weight, height, bmi):
+    marker, = ax.plot(height[0] + height[1] / 12, weight, 'k+', markersize=12, label=f'Your BMI: {bmi:.2f}')
+    legend = ax.legend(loc='upper right')               # Legend in upper right of window
+    return marker, legend
+
+# Function to rasterize the background and describe where its plot area is
+def render_background():
+    fig = Figure(figsize=FIGSIZE, dpi=DPI)
+    canvas = FigureCanvasAgg(fig)
+    ax = draw_background(fig)
+    canvas.draw()
+
+    pixels = np.array(canvas.buffer_rgba())             # Copy, the canvas buffer is reused
+    layout = {"position": list(ax.get_position().bounds), "xlim": list(ax.get_xlim()), "ylim": list(ax.get_ylim())}
+    return pixels, layout
+
+# Function to load the background from the render cache (the user's by default), rendering and storing it on a miss
+def load_background(cache=None):
+    cache = cache or RenderCache()
+    key = background_key()
+    data = cache.get(key, ".npz")
+    if data is not None:
+        with np.load(io.BytesIO(data)) as stored:
+            return stored["pixels"], json.loads(str(stored["layout"]))
+
+    pixels, layout = render_background()
+    buffer = io.BytesIO()
+    np.savez(buffer, pixels=pixels, layout=json.dumps(layout))
+    cache.put(key, buffer.getvalue(), ".npz")           # A read-only cache only costs the render
+    return pixels, layout
+
+# Function to build the figure the markers are drawn on: just an axes in the same place as the background's,
+# holding one marker and legend that are moved and relabeled for every user (the background comes from `cache` the
+# first time)
+def get_overlay(cache=None):
+    global _overlay
+    if _overlay is None:
+        pixels, layout = load_background(cache)
+        fig = Figure(figsize=FIGSIZE, dpi=DPI)
+        canvas = FigureCanvasAgg(fig)
+        ax = fig.add_axes(layout["position"])
+        ax.set_xlim(layout["xlim"])
+        ax.set_ylim(layout["ylim"])
+        marker, legend = add_marker(ax, 0, (0, 0), 0)
+        canvas.draw()                                   # Create the renderer once
+        _overlay = (pixels, layout, marker, legend)
+    return _overlay
+
+# Function to encode RGB(A) pixels as a PNG; rows are stored unfiltered, which is several times faster to
+# encode than PIL's adaptive filtering and still compresses the flat chart colors well
+def encode_png(pixels, compress_level=1):
+    height, width, channels = pixels.shape
+    rows = np.empty((height, width * channels + 1), dtype=np.uint8)
+    rows[:, 0] = 0                                      # Filter type "None" at the start of every row
+    rows[:, 1:] = pixels.reshape(height, -1)
+
+    # Function to build one PNG chunk (length, type, data, CRC)
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    color_type = {3: 2, 4: 6}[channels]                 # RGB or RGBA, 8 bits per channel
+    header = struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0)
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(rows.tobytes(), compress_level))
+            + chunk(b"IEND", b""))
+
+# Function to render a chart from scratch, used for users outside the chart's range (the axes grow to fit them)
+def render_full_png(weight, height, bmi):
+    fig = Figure(figsize=FIGSIZE, dpi=DPI)
+    FigureCanvasAgg(fig)
+    ax = draw_background(fig)
+    add_marker(ax, weight, height, bmi)
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png')
+    return buffer.getvalue()
+
+# Function to render the user's BMI chart as PNG bytes (cache: RenderCache holding the background, the user's by default)
+def render_bmi_chart_png(weight, height, bmi, cache=None):
+    x = height[0] + height[1] / 12
+    with _lock:
+        pixels, layout, marker, legend = get_overlay(cache)
+        (x_min, x_max), (y_min, y_max) = layout["xlim"], layout["ylim"]
+        if not (x_min <= x <= x_max and y_min <= weight <= y_max):
+            return render_full_png(weight, height, bmi)
+
+        ax = marker.axes
+        buffer = np.asarray(ax.figure.canvas.buffer_rgba())
+        buffer[:] = pixels                              # Start from the cached background
+        marker.set_data([x], [weight])
+        legend.get_texts()[0].set_text(f'Your BMI: {bmi:.2f}')
+        ax.draw_artist(marker)
+        ax.draw_artist(legend)
+        return encode_png(buffer[:, :, :3])             # The chart is opaque, the alpha channel adds nothing
+
+# Function to render the user's BMI chart to a file (drop-in for replicate_and_pinpoint_bmi_on_chart)
+def render_bmi_chart(weight, height, bmi, chart_path='bmi_chart.png', cache=None):
+    with open(chart_path, 'wb') as file:
+        file.write(render_bmi_chart_png(weight, height, bmi, cache))
+    return chart_path                                   # Return chart path
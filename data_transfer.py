@@ -0,0 +1,367 @@
+# Bulk Import and Export for the Nutritional Planning/Tracking App
+#
+# Description: Moves profiles and their history in and out of the database in bulk. Supported formats (picked from the
+# file extension) are CSV (quoted, with a header row), JSON Lines, NumPy .npz (columnar, one group of arrays per chunk
+# of rows) and Parquet (needs pyarrow). Exports stream from one read transaction in chunks, so memory stays the same
+# whatever the size of the history; imports read the file in chunks and insert each chunk with executemany in one
+# transaction, keeping the original timestamps. Rows that can't be read are skipped and reported, one bad row does not
+# stop the import.
+#
+# Usage: python data_transfer.py export history.csv [--profiles Ann Bob] [--no-plans] [--db nutritional_planner.db]
+#        python data_transfer.py import history.jsonl
+#        python data_transfer.py export profiles.csv --dataset profiles
+
+#--------------------------------------- Imports ---------------------------------------
+
+import argparse
+import csv
+import datetime
+import json
+import math
+import os
+import sys
+import time
+import zipfile
+
+import plan_codec
+import planner_db
+
+#--------------------------------------- Constants ---------------------------------------
+
+CHUNK_SIZE = 50_000                             # Rows per chunk (and per import transaction)
+MAX_REPORTED_ERRORS = 10                        # Skipped rows whose error is kept for the report
+
+HISTORY_FIELDS = ["profile_name", "weight", "height_ft", "height_in", "goals", "bmi", "plan", "activity_level",
+                  "dietary_preferences", "allergies", "timestamp"]
+PROFILE_FIELDS = ["profile_name"]
+NUMERIC_FIELDS = {"weight", "height_ft", "height_in", "bmi"}
+
+EXPORT_SQL = ("SELECT profiles.name, weight, height_ft, height_in, goals, bmi, plan, plan_type, menu, tip_id, activity_level, "
+              "dietary_preferences, allergies, timestamp FROM users LEFT JOIN profiles ON profiles.id = users.profile_id "
+              "{where} ORDER BY users.id")
+EXPORT_PROFILES_SQL = "SELECT name FROM profiles {where} ORDER BY name"
+
+#--------------------------------------- Classes ---------------------------------------
+
+# Each writer takes chunks of rows (tuples in the order of its fields) and is closed once at the end
+
+class CsvWriter:
+
+    def __init__(self, path, fields):
+        self.file = open(path, "w", newline="", encoding="utf-8")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(fields)
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.file.close()
+
+
+class JsonLinesWriter:
+
+    def __init__(self, path, fields):
+        self.file = open(path, "w", encoding="utf-8")
+        self.fields = fields
+        self.encode = json.JSONEncoder(ensure_ascii=False).encode
+
+    def write(self, rows):
+        self.file.writelines(self.encode(dict(zip(self.fields, row))) + "\n" for row in rows)
+
+    def close(self):
+        self.file.close()
+
+
+# Columns are stored as "<chunk>/<field>.npy" members (np.load reads the file too): numbers as float64 (NaN when
+# missing), timestamps as datetime64[s] and text as UTF-8 bytes
+class NpzWriter:
+
+    def __init__(self, path, fields):
+        self.zip = zipfile.ZipFile(path, "w", zipfile.ZIP_STORED, allowZip64=True)
+        self.fields = fields
+        self.chunks = 0
+
+    def write(self, rows):
+        import numpy as np
+
+        for field, column in zip(self.fields, zip(*rows)):
+            if field in NUMERIC_FIELDS:
+                array = np.array(column, dtype=np.float64)
+            elif field == "timestamp":
+                array = np.array(column, dtype="datetime64[s]")
+            else:
+                array = np.array([b"" if value is None else str(value).encode() for value in column], dtype=bytes)
+            with self.zip.open(f"{self.chunks:06d}/{field}.npy", "w", force_zip64=True) as member:
+                np.lib.format.write_array(member, array, allow_pickle=False)
+        self.chunks += 1
+
+    def close(self):
+        self.zip.close()
+
+
+class ParquetWriter:
+
+    def __init__(self, path, fields):
+        pa, pq = import_pyarrow()
+        self.pa = pa
+        self.schema = pa.schema([(field, pa.float64() if field in NUMERIC_FIELDS else pa.string()) for field in fields])
+        self.writer = pq.ParquetWriter(path, self.schema)
+
+    def write(self, rows):                          # One row group per chunk
+        self.writer.write_table(self.pa.Table.from_arrays([list(column) for column in zip(*rows)], schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+#--------------------------------------- Functions ---------------------------------------
+
+# Function to import pyarrow for the Parquet format (an optional dependency)
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError("The Parquet format needs pyarrow (pip install pyarrow); use .csv, .jsonl or .npz instead")
+    return pyarrow, pyarrow.parquet
+
+# Function to stream the CSV rows of a file as chunks of dicts
+def read_csv_chunks(path, chunk_size=CHUNK_SIZE):
+    with open(path, newline="", encoding="utf-8") as file:
+        yield from chunked(csv.DictReader(file), chunk_size)
+
+# Function to stream the objects of a JSON Lines file as chunks of dicts
+def read_jsonl_chunks(path, chunk_size=CHUNK_SIZE):
+    with open(path, encoding="utf-8") as file:
+        yield from chunked((json.loads(line) for line in file if line.strip()), chunk_size)
+
+# Function to stream the chunks of an .npz file written by NpzWriter as chunks of dicts
+def read_npz_chunks(path, chunk_size=None):
+    import numpy as np
+
+    with zipfile.ZipFile(path) as archive:
+        chunks = {}                                 # chunk -> [member names]
+        for name in archive.namelist():
+            chunks.setdefault(name.split("/", 1)[0], []).append(name)
+        for chunk in sorted(chunks):
+            columns = {}
+            for name in chunks[chunk]:
+                field = name.split("/", 1)[1][:-len(".npy")]
+                with archive.open(name) as member:
+                    array = np.lib.format.read_array(member, allow_pickle=False)
+                if array.dtype.kind == "M":
+                    strings = np.datetime_as_string(array, unit="s")
+                    columns[field] = [None if value == "NaT" else value.replace("T", " ") for value in strings.tolist()]
+                elif array.dtype.kind == "S":
+                    columns[field] = [value.decode() for value in array.tolist()]
+                else:
+                    columns[field] = [None if math.isnan(value) else value for value in array.tolist()]
+            yield [dict(zip(columns, values)) for values in zip(*columns.values())]
+
+# Function to stream the row groups of a Parquet file as chunks of dicts
+def read_parquet_chunks(path, chunk_size=CHUNK_SIZE):
+    pa, pq = import_pyarrow()
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size):
+        yield batch.to_pylist()
+
+# File extension -> (writer class, chunk reader)
+FORMATS = {
+    ".csv": (CsvWriter, read_csv_chunks),
+    ".jsonl": (JsonLinesWriter, read_jsonl_chunks),
+    ".ndjson": (JsonLinesWriter, read_jsonl_chunks),
+    ".npz": (NpzWriter, read_npz_chunks),
+    ".parquet": (ParquetWriter, read_parquet_chunks),
+}
+
+# Function to find the format of a file from its extension
+def get_format(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in FORMATS:
+        raise ValueError(f"Unknown file format '{extension}', use one of {', '.join(FORMATS)}")
+    return FORMATS[extension]
+
+# Function to group an iterable into lists of chunk_size items
+def chunked(items, chunk_size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+# Function to build the WHERE clause limiting an export to some profiles
+def profile_filter(profiles, column="profiles.name"):
+    if not profiles:
+        return "", ()
+    return f"WHERE {column} IN ({', '.join('?' * len(profiles))})", tuple(profiles)
+
+# Function to stream the history (all of it, or of some profiles) as chunks of rows in HISTORY_FIELDS order, oldest
+# entry first, from one consistent snapshot of the database; plans=False leaves the plan text out
+def iter_history_chunks(path=planner_db.DB_PATH, profiles=None, chunk_size=CHUNK_SIZE, plans=True):
+    planner_db.flush()
+    where, parameters = profile_filter(profiles)
+    with planner_db.connection(path) as conn:
+        conn.execute("BEGIN")                       # Read everything from the same snapshot
+        rebuild = plan_codec.make_rebuilder(dict(conn.execute("SELECT id, text FROM plan_parts"))) if plans else None
+        cursor = conn.execute(EXPORT_SQL.format(where=where), parameters)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield [(row[0], row[1], row[2], row[3], row[4], row[5],
+                    rebuild(*row[6:13]) if plans else None, row[10], row[11], row[12], row[13])
+                   for row in rows]
+        conn.execute("COMMIT")
+
+# Function to stream the profile names as chunks of one-field rows
+def iter_profile_chunks(path=planner_db.DB_PATH, profiles=None, chunk_size=CHUNK_SIZE):
+    where, parameters = profile_filter(profiles, "name")
+    with planner_db.connection(path) as conn:
+        cursor = conn.execute(EXPORT_PROFILES_SQL.format(where=where), parameters)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+
+# Function to export the history ("history") or the profile names ("profiles") to a file; returns the rows written
+def export_data(file_path, dataset="history", db_path=planner_db.DB_PATH, profiles=None, chunk_size=CHUNK_SIZE, plans=True):
+    writer_class, _ = get_format(file_path)
+    if dataset == "history":
+        fields, chunks = HISTORY_FIELDS, iter_history_chunks(db_path, profiles, chunk_size, plans)
+    else:
+        fields, chunks = PROFILE_FIELDS, iter_profile_chunks(db_path, profiles, chunk_size)
+
+    count = 0
+    writer = writer_class(file_path, fields)
+    try:
+        for rows in chunks:
+            writer.write(rows)
+            count += len(rows)
+    finally:
+        writer.close()
+    return count
+
+# Function to read a text field of an imported record (missing -> default)
+def text_field(record, field, default=""):
+    value = record.get(field)
+    return default if value is None or value == "" else str(value)
+
+# Function to read a numeric field of an imported record (missing -> None)
+def number_field(record, field):
+    value = record.get(field)
+    if value is None or value == "":
+        return None
+    value = float(value)
+    return None if math.isnan(value) else value
+
+# Function to read a timestamp field of an imported record (missing -> None) as it is stored by CURRENT_TIMESTAMP
+# (UTC, YYYY-MM-DD HH:MM:SS): ISO 8601 text (times with an offset are converted to UTC) or a unix time in seconds.
+# Anything else raises ValueError, so the record is skipped instead of failing its chunk.
+def timestamp_field(record, field):
+    value = record.get(field)
+    if value is None or value == "":
+        return None
+    if isinstance(value, datetime.datetime):        # Parquet timestamp columns
+        moment = value
+    elif isinstance(value, str) and not value.strip().lstrip("+-").replace(".", "", 1).isdigit():
+        try:
+            moment = datetime.datetime.fromisoformat(value.strip())
+        except ValueError:
+            raise ValueError(f"{field} {value!r} is not an ISO 8601 date and time or a unix time") from None
+    else:
+        seconds = float(value)
+        if math.isnan(seconds):
+            return None
+        try:
+            moment = datetime.datetime.fromtimestamp(seconds, datetime.timezone.utc)
+        except (OverflowError, OSError):
+            raise ValueError(f"{field} {value!r} is out of range") from None
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return moment.isoformat(sep=" ", timespec="seconds")
+
+# Function to turn an imported record into a history row with its timestamp (see planner_db.write_users); the BMI
+# is calculated when the record has none
+def to_history_row(record):
+    import nutritional_planner as planner
+
+    name = text_field(record, "profile_name", None)
+    weight, height_ft, height_in = (number_field(record, field) for field in ("weight", "height_ft", "height_in"))
+    if name is None or weight is None or height_ft is None or height_in is None:
+        raise ValueError("profile_name, weight, height_ft and height_in are required")
+    height = (int(height_ft), int(height_in))
+    bmi = number_field(record, "bmi")
+    if bmi is None:
+        bmi = planner.calculate_bmi(weight, height)
+    timestamp = timestamp_field(record, "timestamp")
+    return (weight, height[0], height[1], text_field(record, "goals"), bmi, text_field(record, "plan", None),
+            text_field(record, "activity_level"), text_field(record, "dietary_preferences"), text_field(record, "allergies"),
+            name, timestamp)
+
+# Function to read the name of an imported profile record
+def to_profile_name(record):
+    name = text_field(record, "profile_name", None) or text_field(record, "name", None)
+    if name is None:
+        raise ValueError("profile_name is required")
+    return name
+
+# Function to import the history ("history") or profile names ("profiles") of a file; returns a report
+# {"rows": imported, "skipped": rows that could not be read, "errors": [first few errors]}
+def import_data(file_path, dataset="history", db_path=planner_db.DB_PATH, chunk_size=CHUNK_SIZE):
+    _, read_chunks = get_format(file_path)
+    planner_db.migrate(db_path)
+    report = {"rows": 0, "skipped": 0, "errors": []}
+    convert = to_history_row if dataset == "history" else to_profile_name
+    number = 0
+    for records in read_chunks(file_path, chunk_size):
+        rows = []
+        for record in records:
+            number += 1
+            try:
+                rows.append(convert(record))
+            except (ValueError, TypeError, AttributeError) as e:
+                report["skipped"] += 1
+                if len(report["errors"]) < MAX_REPORTED_ERRORS:
+                    report["errors"].append(f"Record {number}: {e}")
+        with planner_db.transaction(db_path) as conn:
+            if dataset == "history":
+                planner_db.write_users(conn, rows, timestamps=True)
+            else:
+                conn.executemany(planner_db.ENSURE_PROFILE_SQL, [(name,) for name in rows])
+        report["rows"] += len(rows)
+    return report
+
+# Function for the command line interface
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Import or export profiles and history in bulk.")
+    parser.add_argument("command", choices=["import", "export"])
+    parser.add_argument("file", help=f"data file ({', '.join(FORMATS)})")
+    parser.add_argument("--dataset", choices=["history", "profiles"], default="history", help="what to move (default: %(default)s)")
+    parser.add_argument("--profiles", nargs="+", help="only export these profiles")
+    parser.add_argument("--no-plans", action="store_true", help="leave the plan text out of a history export")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="rows per chunk (default: %(default)s)")
+    parser.add_argument("--db", default=planner_db.DB_PATH, help="history database file (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    try:
+        if args.command == "export":
+            count = export_data(args.file, args.dataset, args.db, args.profiles, args.chunk_size, not args.no_plans)
+            print(f"Exported {count} rows to {args.file} in {time.perf_counter() - start:.1f} s")
+        else:
+            report = import_data(args.file, args.dataset, args.db, args.chunk_size)
+            print(f"Imported {report['rows']} rows from {args.file} in {time.perf_counter() - start:.1f} s"
+                  + (f", skipped {report['skipped']}:" if report["skipped"] else ""))
+            for error in report["errors"]:
+                print(f"  {error}")
+    except (ValueError, RuntimeError, OSError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
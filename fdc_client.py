@@ -0,0 +1,213 @@
+# USDA FoodData Central Client for the Nutritional Planning/Tracking App
+#
+# Description: Client for the FoodData Central (FDC) API used by fetch_nutritional_info. It keeps one pooled
+# requests.Session (keep-alive, retries, timeouts), caches responses on disk (honoring ETag / Last-Modified, with a
+# time to live and size-based eviction) and in memory, walks paginated food lists page by page, and fetches food
+# detail pages concurrently under a rate limit. The base URL can point at a local stand-in server for testing.
+
+#--------------------------------------- Imports ---------------------------------------
+
+import collections
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from render_cache import CACHE_DIR, RenderCache
+
+#--------------------------------------- Constants ---------------------------------------
+
+BASE_URL = "https://api.nal.usda.gov/fdc/v1"
+API_KEY = os.environ.get("FDC_API_KEY", "pU0wN58tdNGVf0DE4ZwFIGbrHlPkRn7zO1d3O7Jo")
+
+HTTP_CACHE_DIR = os.path.join(CACHE_DIR, "fdc")
+HTTP_CACHE_BYTES = 64 * 1024 * 1024
+CACHE_TTL = 24 * 60 * 60                        # Seconds a response is used without asking the server again
+MEMORY_CACHE_SIZE = 1024                        # Responses kept parsed in memory
+
+MAX_PAGE_SIZE = 200                             # Largest pageSize the FDC API accepts
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+#--------------------------------------- Classes ---------------------------------------
+
+# Token bucket shared by all threads of a client: at most `rate` requests per second, bursts of up to `burst`
+class RateLimiter:
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Function to block until a request may be sent
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+# HTTP response cache: parsed JSON in a small in-memory LRU, and the response with its validators on disk
+class HTTPCache:
+
+    def __init__(self, directory=HTTP_CACHE_DIR, max_bytes=HTTP_CACHE_BYTES, ttl=CACHE_TTL, memory_size=MEMORY_CACHE_SIZE):
+        self.disk = RenderCache(directory, max_bytes)
+        self.ttl = ttl
+        self.memory_size = memory_size
+        self.memory = collections.OrderedDict()     # key -> entry, most recently used last
+        self.lock = threading.Lock()
+
+    # Function to get a cached entry ({"data", "etag", "last_modified", "stored_at"}), fresh or stale, or None
+    def get(self, key):
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                self.memory.move_to_end(key)
+                return entry
+
+        stored = self.disk.get(key, ".json")
+        if stored is None:
+            return None
+        try:
+            entry = json.loads(stored)
+        except ValueError:
+            return None
+        self.remember(key, entry)
+        return entry
+
+    # Function to tell whether an entry can be used without asking the server
+    def is_fresh(self, entry):
+        return time.time() - entry["stored_at"] < self.ttl
+
+    # Function to store a response
+    def put(self, key, data, etag=None, last_modified=None):
+        entry = {"data": data, "etag": etag, "last_modified": last_modified, "stored_at": time.time()}
+        self.remember(key, entry)
+        self.disk.put(key, json.dumps(entry).encode(), ".json")
+        return entry
+
+    # Function to keep an entry in the in-memory LRU
+    def remember(self, key, entry):
+        with self.lock:
+            self.memory[key] = entry
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.memory_size:
+                self.memory.popitem(last=False)
+
+
+class FDCClient:
+
+    # rate_limit: requests per second sent to the server (cache hits are not limited)
+    def __init__(self, api_key=API_KEY, base_url=BASE_URL, timeout=10, cache=None, pool_size=10, rate_limit=4, burst=10):
+        self.api_key = api_key
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.cache = cache if cache is not None else HTTPCache()
+        self.limiter = RateLimiter(rate_limit, burst)
+
+        retries = Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=["GET"])
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retries)
+        self.session = requests.Session()           # Keep-alive connections reused by every request
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.session.close()
+
+    # Function to GET a JSON resource through the cache; raises a requests.RequestException on failure (HTTPError,
+    # ConnectionError, Timeout, RetryError once the retries are used up, ...)
+    def get_json(self, path, params=None):
+        params = dict(params or {})
+        key = RenderCache.key([self.base_url, path, sorted(params.items())])      # The API key is not part of the key
+        entry = self.cache.get(key)
+        if entry is not None and self.cache.is_fresh(entry):
+            return entry["data"]
+
+        headers = {}
+        if entry is not None:                       # Stale: ask the server whether it changed
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        self.limiter.acquire()
+        response = self.session.get(f"{self.base_url}{path}", params={**params, "api_key": self.api_key},
+                                    headers=headers, timeout=self.timeout)
+        if response.status_code == 304:
+            if entry is None:                       # Not a conditional request (or the copy is gone), no body to use
+                raise requests.HTTPError(f"304 Not Modified without a cached copy of {path}", response=response)
+            return self.cache.put(key, entry["data"], entry.get("etag"), entry.get("last_modified"))["data"]
+        response.raise_for_status()
+
+        data = response.json()
+        self.cache.put(key, data, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+        return data
+
+    # Function to get one page of the food list (page_number starts at 1)
+    def list_foods(self, page_number=1, page_size=50, data_type=None, sort_by=None, sort_order=None):
+        params = {"pageNumber": page_number, "pageSize": page_size}
+        if data_type:
+            params["dataType"] = data_type
+        if sort_by:
+            params["sortBy"] = sort_by
+        if sort_order:
+            params["sortOrder"] = sort_order
+        return self.get_json("/foods/list", params)
+
+    # Function to stream the food list page by page, stopping at the first short page or after max_pages
+    def iter_foods(self, page_size=MAX_PAGE_SIZE, max_pages=None, **filters):
+        page_number = 1
+        while max_pages is None or page_number <= max_pages:
+            foods = self.list_foods(page_number, page_size, **filters)
+            yield from foods
+            if len(foods) < page_size:
+                return
+            page_number += 1
+
+    # Function to get the details (nutrients and portions) of one food
+    def get_food(self, fdc_id):
+        return self.get_json(f"/food/{fdc_id}")
+
+    # Function to fetch the details of many foods concurrently; returns {fdc_id: food or the exception raised}
+    def prefetch_foods(self, fdc_ids, workers=4):
+        fdc_ids = list(dict.fromkeys(fdc_ids))     # Drop duplicates, keep order
+
+        # Function run by each worker thread
+        def fetch(fdc_id):
+            try:
+                return self.get_food(fdc_id)
+            except Exception as e:
+                return e
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return dict(zip(fdc_ids, pool.map(fetch, fdc_ids)))
+
+#--------------------------------------- Functions ---------------------------------------
+
+# Function to get the process-wide client (created on first use)
+def get_client():
+    global _default_client
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = FDCClient()
+    return _default_client
@@ -0,0 +1,228 @@
+# Food Catalog for the Nutritional Planning/Tracking App
+#
+# Description: The single list of menu items, by category, each tagged with the diets it suits and the allergens it
+# contains. Inverted indexes (tag -> bitset of items, one bit per item) are built once, so the items allowed for any
+# combination of dietary preference and allergies are found with a few bitwise operations. Menus are picked from the
+# allowed items only and do not repeat an item within a category over several days, for one user or (with numpy) for
+# a whole cohort at once.
+
+#--------------------------------------- Imports ---------------------------------------
+
+import functools
+import random
+
+#--------------------------------------- Constants ---------------------------------------
+
+# Diet tags: vegetarian, vegan, keto (the item suits the diet). Allergen tags: nuts (peanuts included), gluten, chicken,
+# dairy, eggs, fish, shellfish, soy (the item contains it).
+CATALOG = {
+
+    "Breakfast": [
+        ("Whole grain cereal", "vegetarian vegan gluten"),
+        ("Egg whites", "vegetarian keto eggs"),
+        ("Fruit juice", "vegetarian vegan"),
+        ("Greek yogurt", "vegetarian keto dairy"),
+        ("Oatmeal", "vegetarian vegan gluten"),
+        ("Avocado toast", "vegetarian vegan gluten"),
+        ("Smoothie with greens", "vegetarian vegan"),
+        ("Whole grain pancakes", "vegetarian gluten eggs dairy"),
+        ("Almond butter on toast", "vegetarian vegan nuts gluten"),
+        ("Chia seeds pudding", "vegetarian vegan keto"),
+        ("Mixed berries", "vegetarian vegan"),
+        ("Scrambled eggs with veggies", "vegetarian keto eggs"),
+        ("Protein shake", "vegetarian keto dairy"),
+        ("Nut and seed granola", "vegetarian vegan nuts gluten"),
+        ("Quinoa porridge", "vegetarian vegan"),
+        ("Fruit salad", "vegetarian vegan"),
+        ("Cottage cheese", "vegetarian keto dairy"),
+        ("Breakfast burrito", "gluten eggs dairy"),
+        ("Sweet potato hash", "vegetarian vegan"),
+        ("Protein-rich smoothie", "vegetarian dairy"),
+    ],
+
+    "Lunch": [
+        ("Grilled chicken salad", "keto chicken"),
+        ("Quinoa and black beans", "vegetarian vegan"),
+        ("Turkey and avocado wrap", "gluten"),
+        ("Chicken and vegetable stir-fry", "chicken soy"),
+        ("Salmon with quinoa", "fish"),
+        ("Lean beef with veggies", "keto"),
+        ("Chickpea and spinach stew", "vegetarian vegan"),
+        ("Grilled tofu and vegetables", "vegetarian vegan keto soy"),
+        ("Greek salad with chicken", "keto chicken dairy"),
+        ("Whole grain pasta with marinara", "vegetarian vegan gluten"),
+        ("Vegetable and lentil soup", "vegetarian vegan"),
+        ("Chicken and sweet potato salad", "chicken"),
+        ("Tofu and veggie kebabs", "vegetarian vegan keto soy"),
+        ("Turkey chili", ""),
+        ("Stuffed bell peppers", "vegetarian dairy"),
+        ("Chicken and quinoa bowl", "chicken"),
+        ("Vegetable curry", "vegetarian vegan"),
+        ("Grilled shrimp with brown rice", "shellfish"),
+        ("Salmon and spinach salad", "keto fish"),
+        ("Chicken and avocado salad", "keto chicken"),
+    ],
+
+    "Dinner": [
+        ("Grilled salmon with vegetables", "keto fish"),
+        ("Chicken breast with steamed broccoli", "keto chicken"),
+        ("Turkey meatballs with zucchini noodles", "keto eggs"),
+        ("Stuffed bell peppers with quinoa", "vegetarian vegan"),
+        ("Baked cod with asparagus", "keto fish"),
+        ("Vegetable stir-fry with tofu", "vegetarian vegan soy"),
+        ("Beef and vegetable kebabs", "keto"),
+        ("Lentil soup with spinach", "vegetarian vegan"),
+        ("Chicken curry with brown rice", "chicken"),
+        ("Grilled chicken with sweet potato mash", "chicken"),
+        ("Vegetarian chili", "vegetarian vegan"),
+        ("Grilled shrimp with mixed vegetables", "keto shellfish"),
+        ("Baked chicken thighs with Brussels sprouts", "keto chicken"),
+        ("Spaghetti squash with marinara sauce", "vegetarian vegan keto"),
+        ("Stuffed mushrooms with spinach", "vegetarian keto dairy"),
+        ("Salmon and kale salad", "keto fish"),
+        ("Chicken and vegetable soup", "chicken"),
+        ("Baked tofu with broccoli", "vegetarian vegan keto soy"),
+        ("Beef stew with carrots", ""),
+        ("Grilled portobello mushrooms", "vegetarian vegan keto"),
+    ],
+
+    "Snacks": [
+        ("Almonds and walnuts", "vegetarian vegan keto nuts"),
+        ("Greek yogurt with honey", "vegetarian dairy"),
+        ("Apple slices with almond butter", "vegetarian vegan nuts"),
+        ("Carrot sticks with hummus", "vegetarian vegan"),
+        ("Mixed berries", "vegetarian vegan"),
+        ("Protein bar", "vegetarian dairy nuts soy"),
+        ("Edamame", "vegetarian vegan soy"),
+        ("Celery with peanut butter", "vegetarian vegan keto nuts"),
+        ("Cottage cheese with pineapple", "vegetarian dairy"),
+        ("Homemade trail mix", "vegetarian vegan nuts"),
+        ("Protein shake", "vegetarian keto dairy"),
+        ("Vegetable sticks with guacamole", "vegetarian vegan keto"),
+        ("Apple with cheese slices", "vegetarian dairy"),
+        ("Rice cakes with avocado", "vegetarian vegan"),
+        ("Chia pudding", "vegetarian vegan keto"),
+        ("Pumpkin seeds", "vegetarian vegan keto"),
+        ("Baked sweet potato fries", "vegetarian vegan"),
+        ("Smoothie with protein powder", "vegetarian dairy"),
+        ("Hard-boiled eggs", "vegetarian keto eggs"),
+        ("Low-fat cheese sticks", "vegetarian keto dairy"),
+    ]
+}
+
+FOOD_CATEGORIES = {category: [name for name, _ in items] for category, items in CATALOG.items()}    # Item names by category
+
+DIET_TAGS = {"vegetarian", "vegan", "keto"}
+ALLERGEN_TAGS = {"nuts", "gluten", "chicken", "dairy", "eggs", "fish", "shellfish", "soy"}
+NO_ITEM = 255                                   # Menu slot with no allowed item (bulk menus)
+NO_ITEM_TEXT = "No suitable option"
+ALLOWED_CACHE_SIZE = 1024                       # Preference/allergy combinations remembered per catalog
+
+#--------------------------------------- Classes ---------------------------------------
+
+class FoodCatalog:
+
+    def __init__(self, catalog=CATALOG):
+        self.categories = list(catalog)
+        self.items = []                             # (category, name) of each item; bit i of a bitset is item i
+        self.category_masks = {}                    # category -> bitset of its items
+        self.tag_masks = {}                         # tag -> bitset of the items carrying it
+        for category, items in catalog.items():
+            self.category_masks[category] = 0
+            for name, tags in items:
+                bit = 1 << len(self.items)
+                self.items.append((category, name))
+                self.category_masks[category] |= bit
+                for tag in tags.split():
+                    self.tag_masks[tag] = self.tag_masks.get(tag, 0) | bit
+        self.all_items = (1 << len(self.items)) - 1
+        self.allowed_cache = {}                     # (dietary preferences, allergies) -> bitset of allowed items
+
+    # Function to get the bitset of items allowed for a dietary preference ("Vegan", "None", ...) and allergies ("Nuts",
+    # "Nuts, Gluten", ...); unknown preferences ("Meat", "None") allow everything
+    def allowed(self, dietary_preferences=None, allergies=None):
+        key = (dietary_preferences, allergies)
+        if key in self.allowed_cache:
+            return self.allowed_cache[key]
+        mask = self.all_items
+        for preference in split_tags(dietary_preferences):
+            if preference in DIET_TAGS:
+                mask &= self.tag_masks.get(preference, 0)
+        for allergy in split_tags(allergies):
+            if allergy in ALLERGEN_TAGS:
+                mask &= ~self.tag_masks.get(allergy, 0)
+        if len(self.allowed_cache) >= ALLOWED_CACHE_SIZE:
+            self.allowed_cache.clear()
+        self.allowed_cache[key] = mask
+        return mask
+
+    # Function to get the item numbers of a category that are in a bitset
+    def options(self, category, mask):
+        mask &= self.category_masks[category]
+        return [i for i in range(len(self.items)) if mask >> i & 1]
+
+    # Function to pick a menu for several days: a list (one per day) of item names in category order. An item is not
+    # repeated within a category until all the allowed items of that category have been used.
+    def menu(self, days=1, dietary_preferences=None, allergies=None, rng=random):
+        mask = self.allowed(dietary_preferences, allergies)
+        columns = []
+        for category in self.categories:
+            options = self.options(category, mask)
+            if not options:
+                columns.append([NO_ITEM_TEXT] * days)
+                continue
+            picks = rng.sample(options, min(days, len(options)))
+            columns.append([self.items[picks[day % len(picks)]][1] for day in range(days)])
+        return [list(day) for day in zip(*columns)]
+
+    # Function to pick menus for a whole cohort with numpy: returns a uint8 array (profiles, days, categories) of item
+    # numbers (NO_ITEM where nothing is allowed). Profiles sharing the same preference and allergies are done together.
+    def menus_bulk(self, dietary_preferences, allergies, days=7, seed=None, chunk_size=65536):
+        import numpy as np
+
+        rng = np.random.default_rng(seed)
+        groups = {}                                 # (preference, allergies) -> group number
+        group_of = np.fromiter((groups.setdefault(key, len(groups)) for key in zip(dietary_preferences, allergies)),
+                               dtype=np.int32, count=len(dietary_preferences))
+        menus = np.full((len(group_of), days, len(self.categories)), NO_ITEM, dtype=np.uint8)
+
+        for (preference, allergy), group in groups.items():
+            rows = np.flatnonzero(group_of == group)
+            mask = self.allowed(preference, allergy)
+            for c, category in enumerate(self.categories):
+                options = np.array(self.options(category, mask), dtype=np.uint8)
+                if len(options) == 0:
+                    continue
+                days_to_column = np.arange(days) % len(options)             # Cycle only when there are too few options
+                for start in range(0, len(rows), chunk_size):
+                    chunk = rows[start:start + chunk_size]
+                    permutations = rng.random((len(chunk), len(options))).argsort(axis=1)      # One shuffle per profile
+                    menus[chunk, :, c] = options[permutations[:, days_to_column]]
+        return menus
+
+    # Function to turn a menu of item numbers (days, categories), e.g. one profile of menus_bulk, into item names
+    def menu_names(self, menu):
+        return [[self.items[i][1] if i != NO_ITEM else NO_ITEM_TEXT for i in day] for day in menu]
+
+    # Function to write a menu (a list of days of item names) as text
+    def menu_text(self, menu):
+        text = "\nSuggested Healthy Menu:\n"
+        for day_number, day in enumerate(menu, 1):
+            if len(menu) > 1:
+                text += f"Day {day_number}:\n"
+            for category, name in zip(self.categories, day):
+                text += "{}{}: {}\n".format("    " if len(menu) > 1 else "", category, name)
+        return text
+
+#--------------------------------------- Functions ---------------------------------------
+
+# Function to split a preference or allergy field ("Nuts, Gluten") into lowercase tags
+def split_tags(text):
+    if not text:
+        return []
+    return [tag.strip().lower() for tag in str(text).replace(";", ",").split(",") if tag.strip()]
+
+# Function to get the shared catalog (indexes built on first use)
+@functools.lru_cache(maxsize=None)
+def get_catalog():
+    return FoodCatalog()
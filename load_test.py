@@ -0,0 +1,183 @@
+# Load Test for the Nutritional Planning/Tracking App's HTTP Service
+#
+# Description: Sends requests to planner_service.py from many concurrent keep-alive connections for a fixed time and
+# reports the requests per second and the latency percentiles (p50, p90, p99, max) of each endpoint. With
+# --spawn-server a service is started on a free localhost port with a temporary database and stopped at the end.
+#
+# Usage: python load_test.py --spawn-server --duration 10 --connections 64
+#        python load_test.py --url http://127.0.0.1:8080 --endpoints plan chart qr
+
+#--------------------------------------- Imports ---------------------------------------
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from nutritional_planner import ACTIVITY_LEVELS, ALLERGIES, DIETARY_PREFERENCES       # The app's form choices
+
+#--------------------------------------- Constants ---------------------------------------
+
+DEFAULT_URL = "http://127.0.0.1:8080"
+PROFILES = [f"load_test_{i}" for i in range(50)]
+ENDPOINTS = ["plan", "chart", "qr", "history", "progress"]
+SERVER_START_TIMEOUT = 30                       # Seconds to wait for a spawned service to answer /health
+
+#--------------------------------------- Functions ---------------------------------------
+
+# Function to make a random plan request body
+def random_user(rng):
+    return {"profile": rng.choice(PROFILES), "weight": round(rng.uniform(100, 250), 1), "height_ft": rng.randint(4, 6),
+            "height_in": rng.randint(0, 11), "goals": "", "activity_level": rng.choice(ACTIVITY_LEVELS),
+            "dietary_preferences": rng.choice(DIETARY_PREFERENCES), "allergies": rng.choice(ALLERGIES)}
+
+# Function to make a random request of an endpoint: (method, target, body)
+def make_request(endpoint, rng):
+    if endpoint == "plan":
+        return "POST", "/plan", json.dumps(random_user(rng)).encode()
+    if endpoint == "chart":                     # Few distinct charts, so identical renders get coalesced
+        query = urllib.parse.urlencode({"weight": rng.randrange(120, 220, 10), "height_ft": 5, "height_in": rng.randrange(0, 12, 3)})
+        return "GET", f"/chart.png?{query}", b""
+    if endpoint == "qr":
+        return "POST", "/qr.png", f"Plan for {rng.choice(PROFILES)}: {rng.randrange(1000)}".encode()
+    profile = urllib.parse.quote(rng.choice(PROFILES))
+    if endpoint == "history":
+        return "GET", f"/profiles/{profile}/history", b""
+    return "GET", f"/profiles/{profile}/progress", b""
+
+# Function to send one request on an open connection and read the whole response; returns the status code
+async def send(reader, writer, host, method, target, body):
+    writer.write(f"{method} {target} HTTP/1.1\r\nHost: {host}\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    length = 0
+    for line in lines[1:]:
+        name, _, value = line.partition(":")
+        if name.strip().lower() == "content-length":
+            length = int(value)
+    await reader.readexactly(length)
+    return int(lines[0].split(" ")[1])
+
+# Function run by each connection: sends requests one after the other until the deadline, recording
+# (endpoint, status, seconds) for each
+async def run_connection(host, port, endpoints, deadline, results, seed):
+    rng = random.Random(seed)
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        while time.perf_counter() < deadline:
+            endpoint = rng.choice(endpoints)
+            method, target, body = make_request(endpoint, rng)
+            start = time.perf_counter()
+            try:
+                status = await send(reader, writer, host, method, target, body)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                results.append((endpoint, 0, time.perf_counter() - start))
+                writer.close()
+                reader, writer = await asyncio.open_connection(host, port)
+                continue
+            results.append((endpoint, status, time.perf_counter() - start))
+    finally:
+        writer.close()
+
+# Function to run the load: `connections` concurrent connections for `duration` seconds
+async def run_load(host, port, endpoints, connections, duration, seed=0):
+    results = []
+    deadline = time.perf_counter() + duration
+    start = time.perf_counter()
+    await asyncio.gather(*(run_connection(host, port, endpoints, deadline, results, seed + i) for i in range(connections)))
+    return results, time.perf_counter() - start
+
+# Function to get a percentile of sorted values (nearest rank); NaN when there are none
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return float("nan")
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+# Function to print the report of a run (latencies are nan for no requests); returns the number of failed requests
+def report(results, elapsed):
+    print(f"\n{'endpoint':<10} {'requests':>9} {'req/s':>9} {'errors':>7} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    failures = 0
+    for endpoint in sorted({result[0] for result in results}) + ["all"]:
+        rows = [result for result in results if endpoint in ("all", result[0])]
+        errors = sum(1 for _, status, _ in rows if not 200 <= status < 300)
+        if endpoint == "all":
+            failures = errors
+        latencies = sorted(seconds * 1000 for _, _, seconds in rows)
+        print(f"{endpoint:<10} {len(rows):>9} {len(rows) / elapsed:>9.1f} {errors:>7} {percentile(latencies, 0.5):>8.2f} "
+              f"{percentile(latencies, 0.9):>8.2f} {percentile(latencies, 0.99):>8.2f} {percentile(latencies, 1):>8.2f}")
+    print(f"\n{failures} of {len(results)} requests failed" if results else "\nNo request completed")
+    return failures
+
+# Function to create the test profiles (existing ones are kept)
+def create_profiles(url):
+    for name in PROFILES:
+        request = urllib.request.Request(f"{url}/profiles", data=json.dumps({"name": name}).encode(), method="POST")
+        try:
+            urllib.request.urlopen(request).close()
+        except urllib.error.HTTPError as e:
+            if e.code != 409:                       # 409: the profile already exists
+                raise
+
+# Function to start a service on a free localhost port with a database in `directory`; returns (process, url)
+def spawn_server(directory, workers=None):
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "planner_service.py"),
+               "--port", str(port), "--db", os.path.join(directory, "load_test.db")]
+    if workers:
+        command += ["--workers", str(workers)]
+    process = subprocess.Popen(command, cwd=directory)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while True:
+        try:
+            urllib.request.urlopen(f"{url}/health").close()
+            return process, url
+        except OSError:
+            if process.poll() is not None or time.monotonic() > deadline:
+                process.kill()
+                raise RuntimeError("The service did not start")
+            time.sleep(0.1)
+
+# Function for the command line interface
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the planner's HTTP service.")
+    parser.add_argument("--url", default=DEFAULT_URL, help="service to test (default: %(default)s)")
+    parser.add_argument("--spawn-server", action="store_true", help="start a service with a temporary database instead")
+    parser.add_argument("--workers", type=int, help="render processes of the spawned service")
+    parser.add_argument("--endpoints", nargs="+", choices=ENDPOINTS, default=["plan"], help="endpoints to call (default: plan)")
+    parser.add_argument("--connections", type=int, default=64, help="concurrent connections (default: %(default)s)")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to run (default: %(default)s)")
+    parser.add_argument("--warmup", type=float, default=1, help="seconds of load before measuring (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(prefix="planner_load_") as directory:
+        process, url = spawn_server(directory, args.workers) if args.spawn_server else (None, args.url.rstrip("/"))
+        try:
+            create_profiles(url)
+            address = urllib.parse.urlsplit(url)
+            if args.warmup:
+                asyncio.run(run_load(address.hostname, address.port, args.endpoints, args.connections, args.warmup))
+            results, elapsed = asyncio.run(run_load(address.hostname, address.port, args.endpoints, args.connections,
+                                                    args.duration))
+            print(f"{len(results)} requests in {elapsed:.1f} s over {args.connections} connections")
+            failures = report(results, elapsed)
+        finally:
+            if process:
+                process.terminate()
+                process.wait()
+    return 1 if failures or not results else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
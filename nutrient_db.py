@@ -0,0 +1,361 @@
+# Local Nutrient Database for the Nutritional Planning/Tracking App
+#
+# Description: Builds a local SQLite database of foods and their macros (kcal, protein, carbs and fat per 100 g) from
+# USDA FoodData Central bulk downloads, so menu items can be looked up offline instead of calling the FDC API. Ranking
+# full-text matches is slow for common words, so the foods the menu items resolve to are stored when a download is
+# ingested (their lookups are a primary key read), and every lookup is remembered in memory. Lookups never write.
+# Supported inputs are the CSV download (food.csv and food_nutrient.csv) and the JSON downloads (Foundation, SR Legacy,
+# Branded, ...; also JSON Lines). Files are streamed in batches, each batch is committed together with how far the file
+# has been read, so an interrupted ingest resumes where it stopped and an unchanged file is skipped. Descriptions are
+# indexed with FTS5 full-text search.
+#
+# Usage: python nutrient_db.py ingest food.csv food_nutrient.csv [--db nutrients.db]
+#        python nutrient_db.py lookup "greek yogurt"
+#        python nutrient_db.py menu
+
+#--------------------------------------- Imports ---------------------------------------
+
+import argparse
+import csv
+import json
+import os
+import re
+import sys
+import threading
+
+import planner_db
+
+#--------------------------------------- Constants ---------------------------------------
+
+NUTRIENT_DB_PATH = 'nutrients.db'
+BATCH_SIZE = 5000                               # Source rows per transaction
+CACHE_SIZE = 4096                               # Looked up food names remembered per database
+
+# FDC nutrient id -> (macros column, rank); energy comes in several flavors, the highest rank available wins
+MACRO_NUTRIENTS = {
+    1008: ("kcal", 3),                          # Energy (kcal)
+    2048: ("kcal", 2),                          # Energy, Atwater specific factors
+    2047: ("kcal", 1),                          # Energy, Atwater general factors
+    1003: ("protein", 0),
+    1005: ("carbs", 0),                         # Carbohydrate, by difference
+    1004: ("fat", 0),                           # Total lipid (fat)
+}
+NUTRIENT_NUMBERS = {"208": 1008, "958": 2048, "957": 2047, "203": 1003, "205": 1005, "204": 1004}    # Older nutrient numbers
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS foods (fdc_id INTEGER PRIMARY KEY, description TEXT NOT NULL, data_type TEXT)",
+    "CREATE INDEX IF NOT EXISTS foods_description ON foods (description COLLATE NOCASE)",
+    "CREATE TABLE IF NOT EXISTS macros (fdc_id INTEGER PRIMARY KEY, kcal REAL, kcal_rank INTEGER, protein REAL, carbs REAL, fat REAL)",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS foods_fts USING fts5(description, content='foods', content_rowid='fdc_id')",
+    '''CREATE TRIGGER IF NOT EXISTS foods_insert AFTER INSERT ON foods BEGIN
+           INSERT INTO foods_fts (rowid, description) VALUES (new.fdc_id, new.description);
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS foods_delete AFTER DELETE ON foods BEGIN
+           INSERT INTO foods_fts (foods_fts, rowid, description) VALUES ('delete', old.fdc_id, old.description);
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS foods_update AFTER UPDATE ON foods BEGIN
+           INSERT INTO foods_fts (foods_fts, rowid, description) VALUES ('delete', old.fdc_id, old.description);
+           INSERT INTO foods_fts (rowid, description) VALUES (new.fdc_id, new.description);
+       END''',
+    "CREATE TABLE IF NOT EXISTS ingest_progress (source TEXT PRIMARY KEY, size INTEGER, mtime REAL, rows INTEGER, done INTEGER)",
+    "CREATE TABLE IF NOT EXISTS resolved_names (name TEXT PRIMARY KEY, fdc_id INTEGER) WITHOUT ROWID",    # NULL: no match
+]
+
+UPSERT_FOOD_SQL = ("INSERT INTO foods (fdc_id, description, data_type) VALUES (?, ?, ?) ON CONFLICT (fdc_id) DO UPDATE "
+                   "SET description = excluded.description, data_type = excluded.data_type")
+UPSERT_KCAL_SQL = ("INSERT INTO macros (fdc_id, kcal, kcal_rank) VALUES (?, ?, ?) ON CONFLICT (fdc_id) DO UPDATE "
+                   "SET kcal = excluded.kcal, kcal_rank = excluded.kcal_rank "
+                   "WHERE macros.kcal_rank IS NULL OR excluded.kcal_rank >= macros.kcal_rank")
+UPSERT_MACRO_SQL = {column: f"INSERT INTO macros (fdc_id, {column}) VALUES (?, ?) ON CONFLICT (fdc_id) DO UPDATE "
+                            f"SET {column} = excluded.{column}" for column in ("protein", "carbs", "fat")}
+
+MACROS_SELECT = ("SELECT foods.fdc_id, foods.description, macros.kcal, macros.protein, macros.carbs, macros.fat "
+                 "FROM foods LEFT JOIN macros ON macros.fdc_id = foods.fdc_id")
+BY_ID_SQL = MACROS_SELECT + " WHERE foods.fdc_id = ?"
+EXACT_SQL = MACROS_SELECT + " WHERE foods.description = ? COLLATE NOCASE LIMIT 1"
+SEARCH_SQL = MACROS_SELECT + " JOIN foods_fts ON foods_fts.rowid = foods.fdc_id WHERE foods_fts MATCH ? ORDER BY bm25(foods_fts) LIMIT ?"
+
+STOP_WORDS = {"and", "with", "on", "of", "the", "a", "in"}
+
+_databases = {}
+_databases_lock = threading.Lock()
+
+#--------------------------------------- Functions ---------------------------------------
+
+# Function to open a nutrient database, creating its tables if needed
+def open_db(path=NUTRIENT_DB_PATH):
+    conn = planner_db.connect(path)
+    for statement in SCHEMA:
+        conn.execute(statement)
+    return conn
+
+# Function to stream the items of the first JSON array in a file (the list of foods of an FDC download) without
+# loading the whole file
+def iter_json_array(file, chunk_size=1 << 20):
+    decoder = json.JSONDecoder()
+    buffer, position = "", 0
+    while "[" not in buffer:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            return
+        buffer += chunk
+    position = buffer.index("[") + 1
+
+    while True:
+        while position < len(buffer) and buffer[position] in " \t\r\n,":
+            position += 1
+        if position == len(buffer):
+            buffer, position = file.read(chunk_size), 0
+            if not buffer:
+                return
+            continue
+        if buffer[position] == "]":
+            return
+        try:
+            item, position = decoder.raw_decode(buffer, position)
+        except ValueError:                          # Item continues in the next chunk
+            chunk = file.read(chunk_size)
+            if not chunk:
+                raise
+            buffer, position = buffer[position:] + chunk, 0
+            continue
+        yield item
+        if position > chunk_size:                   # Drop what has been parsed
+            buffer, position = buffer[position:], 0
+
+# Function to turn one food of a JSON download into ("food", ...) and ("nutrient", ...) records
+def json_food_records(food):
+    fdc_id = int(food["fdcId"])
+    records = [("food", fdc_id, food.get("description", ""), food.get("dataType"))]
+    for nutrient in food.get("foodNutrients", []):
+        if "nutrient" in nutrient:                  # Download format: {"nutrient": {"id", "number", ...}, "amount"}
+            nutrient_id = nutrient["nutrient"].get("id") or NUTRIENT_NUMBERS.get(str(nutrient["nutrient"].get("number")))
+            amount = nutrient.get("amount")
+        else:                                       # API format: {"nutrientId", "nutrientNumber", "value"}
+            nutrient_id = nutrient.get("nutrientId") or NUTRIENT_NUMBERS.get(str(nutrient.get("nutrientNumber")))
+            amount = nutrient.get("value", nutrient.get("amount"))
+        if nutrient_id in MACRO_NUTRIENTS and amount is not None:
+            records.append(("nutrient", fdc_id, nutrient_id, float(amount)))
+    return records
+
+# Function to stream the items of a source file: one item per CSV row, JSON food or JSON Lines line; each item is a
+# list of records
+def iter_source(file, path):
+    if path.lower().endswith(".csv"):
+        reader = csv.DictReader(file)
+        if "nutrient_id" in reader.fieldnames:     # food_nutrient.csv
+            for row in reader:
+                nutrient_id = int(row["nutrient_id"])
+                if nutrient_id in MACRO_NUTRIENTS and row["amount"]:
+                    yield [("nutrient", int(row["fdc_id"]), nutrient_id, float(row["amount"]))]
+                else:
+                    yield []
+        else:                                       # food.csv
+            for row in reader:
+                yield [("food", int(row["fdc_id"]), row["description"], row.get("data_type"))]
+    elif path.lower().endswith((".jsonl", ".ndjson")):
+        for line in file:
+            yield json_food_records(json.loads(line)) if line.strip() else []
+    else:
+        for food in iter_json_array(file):
+            yield json_food_records(food)
+
+# Function to write one batch of records (one executemany per statement, records of a column stay in order)
+def write_records(conn, records):
+    conn.executemany(UPSERT_FOOD_SQL, [record[1:] for record in records if record[0] == "food"])
+    kcal_rows, macro_rows = [], {column: [] for column in UPSERT_MACRO_SQL}
+    for record in records:
+        if record[0] == "nutrient":
+            _, fdc_id, nutrient_id, amount = record
+            column, rank = MACRO_NUTRIENTS[nutrient_id]
+            if column == "kcal":
+                kcal_rows.append((fdc_id, amount, rank))
+            else:
+                macro_rows[column].append((fdc_id, amount))
+    conn.executemany(UPSERT_KCAL_SQL, kcal_rows)
+    for column, rows in macro_rows.items():
+        conn.executemany(UPSERT_MACRO_SQL[column], rows)
+
+# Function to ingest one bulk download file; resumes an interrupted ingest and skips a file that is already done.
+# Returns the number of items read from the file in this call.
+def ingest(path, db_path=NUTRIENT_DB_PATH, batch_size=BATCH_SIZE, progress=None):
+    conn = open_db(db_path)
+    try:
+        source = os.path.abspath(path)
+        stat = os.stat(path)
+        state = conn.execute("SELECT size, mtime, rows, done FROM ingest_progress WHERE source = ?", (source,)).fetchone()
+        if state is None or (state[0], state[1]) != (stat.st_size, stat.st_mtime):
+            state = (stat.st_size, stat.st_mtime, 0, 0)         # New or changed file, start over (upserts are idempotent)
+        if state[3]:
+            return 0
+
+        skip = state[2]
+        done_rows = skip
+        with open(path, newline='', encoding='utf-8-sig') as file:
+            batch, batch_items = [], 0
+            for index, records in enumerate(iter_source(file, path)):
+                if index < skip:                                # Already committed by an earlier run
+                    continue
+                batch.extend(records)
+                batch_items += 1
+                if batch_items >= batch_size:
+                    done_rows += batch_items
+                    commit_batch(conn, batch, source, stat, done_rows, False)
+                    batch, batch_items = [], 0
+                    if progress:
+                        progress(path, done_rows)
+            done_rows += batch_items
+            commit_batch(conn, batch, source, stat, done_rows, True)
+        store_resolved_names(conn, menu_items())
+        clear_cache(db_path)
+        return done_rows - skip
+    finally:
+        conn.close()
+
+# Function to commit a batch of records together with how far the source file has been read
+def commit_batch(conn, records, source, stat, rows, done):
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        write_records(conn, records)
+        if any(record[0] == "food" for record in records):
+            conn.execute("DELETE FROM resolved_names")             # New foods may match names better
+        conn.execute("INSERT OR REPLACE INTO ingest_progress (source, size, mtime, rows, done) VALUES (?, ?, ?, ?, ?)",
+                     (source, stat.st_size, stat.st_mtime, rows, int(done)))
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+# Function to find the food that best matches a name: an exact description, else the best full-text match of all its
+# words, else of any of its words; returns its MACROS_SELECT row or None
+def find_food(conn, name):
+    row = conn.execute(EXACT_SQL, (name,)).fetchone()
+    for operator in (" ", " OR "):
+        query = fts_query(name, operator)
+        if row is not None or not query:
+            break
+        row = conn.execute(SEARCH_SQL, (query, 1)).fetchone()
+    return row
+
+# Function to store the foods that names resolve to (NULL when nothing matches), so their lookups are a primary key read
+def store_resolved_names(conn, names):
+    resolved = [(name, row[0] if row else None) for name, row in ((name, find_food(conn, name)) for name in names)]
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.executemany("INSERT OR REPLACE INTO resolved_names (name, fdc_id) VALUES (?, ?)", resolved)
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+# Function to get the names of the items of the food options table
+def menu_items():
+    from food_catalog import FOOD_CATEGORIES
+    return [item for items in FOOD_CATEGORIES.values() for item in items]
+
+# Function to turn free text into an FTS5 query (quoted words, so punctuation can't break the query syntax)
+def fts_query(text, operator=" "):
+    words = [word for word in re.findall(r"\w+", text.lower()) if word not in STOP_WORDS]
+    return operator.join(f'"{word}"' for word in words)
+
+# Function to get the shared lookup object of a database
+def get_db(path=NUTRIENT_DB_PATH):
+    key = os.path.abspath(path)
+    with _databases_lock:
+        if key not in _databases:
+            _databases[key] = NutrientDB(path)
+        return _databases[key]
+
+# Function to forget cached lookups after the database changed
+def clear_cache(path=NUTRIENT_DB_PATH):
+    with _databases_lock:
+        db = _databases.get(os.path.abspath(path))
+    if db:
+        db.cache.clear()
+
+# Function to look up the macros of a food name, e.g. an item of get_food_menu (None when nothing matches)
+def get_food_macros(name, path=NUTRIENT_DB_PATH):
+    return get_db(path).macros_for(name)
+
+# Function to look up every item of the food options table ({category: {item: macros or None}})
+def resolve_food_options(path=NUTRIENT_DB_PATH):
+    from food_catalog import FOOD_CATEGORIES
+    db = get_db(path)
+    return {category: {item: db.macros_for(item) for item in items} for category, items in FOOD_CATEGORIES.items()}
+
+#--------------------------------------- Classes ---------------------------------------
+
+class NutrientDB:
+
+    def __init__(self, path=NUTRIENT_DB_PATH):
+        self.path = path
+        self.cache = {}                             # name -> macros of the best match
+        self.lock = threading.Lock()
+        self.conn = open_db(path)
+
+    # Function to turn a result row into a dict
+    @staticmethod
+    def row_to_macros(row):
+        fdc_id, description, kcal, protein, carbs, fat = row
+        return {"fdc_id": fdc_id, "description": description, "kcal": kcal, "protein": protein, "carbs": carbs, "fat": fat}
+
+    # Function to full-text search descriptions; every word must match, best matches first
+    def search(self, text, limit=10):
+        query = fts_query(text)
+        if not query:
+            return []
+        with self.lock:
+            rows = self.conn.execute(SEARCH_SQL, (query, limit)).fetchall()
+        return [self.row_to_macros(row) for row in rows]
+
+    # Function to get the macros of the food that best matches a name (see find_food); names resolved at ingest time
+    # are read from resolved_names, others are searched, and either way only remembered in memory
+    def macros_for(self, name):
+        if name in self.cache:
+            return self.cache[name]
+
+        with self.lock:
+            resolved = self.conn.execute("SELECT fdc_id FROM resolved_names WHERE name = ?", (name,)).fetchone()
+            if resolved is not None:
+                row = self.conn.execute(BY_ID_SQL, resolved).fetchone() if resolved[0] is not None else None
+            else:
+                row = find_food(self.conn, name)
+
+        macros = self.row_to_macros(row) if row else None
+        if len(self.cache) >= CACHE_SIZE:
+            self.cache.clear()
+        self.cache[name] = macros
+        return macros
+
+#--------------------------------------- Command Line ---------------------------------------
+
+# Function for the command line interface
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build and query the local nutrient database.")
+    parser.add_argument("--db", default=NUTRIENT_DB_PATH, help="nutrient database file (default: %(default)s)")
+    commands = parser.add_subparsers(dest="command", required=True)
+    ingest_parser = commands.add_parser("ingest", help="load FDC bulk download files (CSV, JSON or JSON Lines)")
+    ingest_parser.add_argument("files", nargs="+")
+    ingest_parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    lookup_parser = commands.add_parser("lookup", help="search foods by description")
+    lookup_parser.add_argument("text")
+    lookup_parser.add_argument("--limit", type=int, default=10)
+    commands.add_parser("menu", help="show the macros of every item of the food options table")
+    args = parser.parse_args(argv)
+
+    if args.command == "ingest":
+        for path in args.files:                     # Ingest food.csv before food_nutrient.csv
+            count = ingest(path, args.db, args.batch_size, lambda path, rows: print(f"{path}: {rows} rows", end="\r"))
+            print(f"{path}: {count} new rows" if count else f"{path}: already up to date")
+    elif args.command == "lookup":
+        for food in get_db(args.db).search(args.text, args.limit):
+            print(food)
+    else:
+        for category, items in resolve_food_options(args.db).items():
+            print(category)
+            for item, macros in items.items():
+                print(f"    {item}: {macros}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -10,18 +10,66 @@
 
 #--------------------------------------- Imports ---------------------------------------
 
-import matplotlib.pyplot as plt
-import matplotlib.patches as patches
-import numpy as np
-from PIL import Image, ImageDraw, ImageFont, ImageTk
-import tkinter as tk
-from tkinter import messagebox, filedialog, ttk
-import qrcode
+# Only light standard library modules are imported here. matplotlib, numpy, qrcode, requests and tkinter are imported
+# by the functions that use them, so scripts and worker processes that only calculate BMIs or write history start fast.
+import base64
+import contextlib
+import datetime
+import hashlib
 import os
-import sqlite3
-import requests
 import random
-import datetime
+import sqlite3
+import sys
+import functools
+import io
+import shutil
+from render_cache import RenderCache
+from plan_cache import PlanCache
+import food_catalog
+import planner_db
+import tracing
+
+#--------------------------------------- Constants ---------------------------------------
+
+PLAN_GAIN, PLAN_MAINTAIN, PLAN_LOSE = 0, 1, 2                                       # Plan codes used by the bulk functions
+PLAN_NAMES = ["Gain weight plan", "Maintain weight plan", "Lose weight plan"]       # Plan text for each plan code
+BMI_THRESHOLDS = [18.5, 24.9]                                                       # BMI boundaries between the plans
+
+ACTIVITY_LEVELS = ["Sedentary", "Moderate", "Active"]                               # Choices of the form's comboboxes
+DIETARY_PREFERENCES = ["None", "Vegetarian", "Vegan", "Keto", "Meat"]
+ALLERGIES = ["None", "Nuts", "Chicken", "Gluten"]
+
+FOOD_CATEGORIES = food_catalog.FOOD_CATEGORIES                    # Menu items by category (tagged in food_catalog.CATALOG)
+
+FOOD_TABLE_POSITIONS = {                                # Place each category of food in designated spots
+    "Breakfast": (0.05, 0.55, 0.4, 0.4),
+    "Lunch": (0.55, 0.55, 0.4, 0.4),
+    "Dinner": (0.05, 0.05, 0.4, 0.4),
+    "Snacks": (0.55, 0.05, 0.4, 0.4)
+}
+
+FOOD_TABLE_COLORS = {                                   # Set color of each menu
+    "Breakfast": '#e9153f',
+    "Lunch": '#32cd32',
+    "Dinner": '#30b3f5',
+    "Snacks": '#d1b300'
+}
+
+FOOD_TABLE_FIGSIZE = (12, 10)
+
+TIPS = [                                                # Daily health and nutrition tips
+    "Drink plenty of water throughout the day.",
+    "Include a variety of fruits and vegetables in your diet.",
+    "Avoid processed foods and opt for whole foods.",
+    "Exercise regularly to maintain a healthy weight.",
+    "Get enough sleep to support overall health.",
+    "Limit sugary drinks and snacks.",
+    "Choose lean proteins such as chicken, fish, and beans.",
+    "Include healthy fats like nuts, seeds, and avocados in your diet."
+]
+
+RENDER_WORKERS = 2                                      # Processes rendering QR codes and charts for the window
+POLL_INTERVAL_MS = 30                                   # How often the window checks for finished renders
 
 #--------------------------------------- Functions ---------------------------------------
 
@@ -33,81 +81,149 @@ def calculate_bmi(weight, height):
 
 # Function to generate a nutritional plan based on BMI and goals
 def get_nutritional_plan(bmi, goals, activity_level, dietary_preferences, allergies):
+    return build_plan_text(get_plan_code(bmi), activity_level, dietary_preferences, allergies)    # Return nutritional plan (string)
+
+# Function to pick the plan code of a BMI
+def get_plan_code(bmi):
 
-    plan = ""
     if bmi < 18.5:                                                  # Depending on BMI, assign specific plan
-        plan = "Gain weight plan"                                   # If too low, suggest gaining weight
+        return PLAN_GAIN                                            # If too low, suggest gaining weight
     elif 18.5 <= bmi < 24.9:                                        # If at expected level then maintain weight
-        plan = "Maintain weight plan"                               # Otherwise suggest to lose weight
-    else:
-        plan = "Lose weight plan"
-    
+        return PLAN_MAINTAIN                                        # Otherwise suggest to lose weight
+    return PLAN_LOSE
+
+# Function to build the text of a nutritional plan from its plan code
+def build_plan_text(plan_code, activity_level, dietary_preferences, allergies):
+
+    plan = PLAN_NAMES[plan_code]
     plan += f"\nActivity Level: {activity_level}"                   # Add activity level
     plan += f"\nDietary Preferences: {dietary_preferences}"         # Add any preferences
     plan += f"\nAllergies: {allergies}"                             # Add any allergies
     return plan                                                     # Return nutritional plan (string)
 
+# Function to calculate BMI for whole arrays of users at once (weights in lbs, heights in feet and inches)
+def calculate_bmi_bulk(weights, height_ft, height_in):
+    import numpy as np
+
+    weights = np.asarray(weights, dtype=np.float64)
+    height_ft = np.asarray(height_ft, dtype=np.float64)
+    height_in = np.asarray(height_in, dtype=np.float64)
+
+    height_meters = (height_ft * 12 + height_in) * 0.0254                  # Same operations (and order) as calculate_bmi
+    return weights * 0.453592 / (height_meters ** 2)                        # so every row matches the scalar result exactly
+
+# Function to classify an array of BMIs into plan codes (PLAN_GAIN, PLAN_MAINTAIN or PLAN_LOSE)
+def classify_bmi_bulk(bmis):
+    import numpy as np
+
+    bmis = np.asarray(bmis, dtype=np.float64)
+    codes = np.searchsorted(BMI_THRESHOLDS, bmis, side='right')            # < 18.5 -> 0, [18.5, 24.9) -> 1, >= 24.9 (or NaN) -> 2
+    return codes.astype(np.uint8)
+
+# Function to score a whole cohort: returns the BMI array and a plan code per row
+def get_nutritional_plan_bulk(weights, height_ft, height_in):
+
+    bmis = calculate_bmi_bulk(weights, height_ft, height_in)
+    return bmis, classify_bmi_bulk(bmis)
+
+# Function to score a columnar table (dict of arrays, DataFrame, ...) with the same column names as the users table
+def score_cohort(table):
+
+    bmis, plan_codes = get_nutritional_plan_bulk(table["weight"], table["height_ft"], table["height_in"])
+    return CohortPlans(bmis, plan_codes, table["activity_level"], table["dietary_preferences"], table["allergies"])
+
+# Result of score_cohort; plan text is only built when a row is asked for
+class CohortPlans:
+
+    def __init__(self, bmis, plan_codes, activity_levels, dietary_preferences, allergies):
+        self.bmis = bmis
+        self.plan_codes = plan_codes
+        self.activity_levels = activity_levels
+        self.dietary_preferences = dietary_preferences
+        self.allergies = allergies
+
+    def __len__(self):
+        return len(self.plan_codes)
+
+    # Build the plan text for a single row on demand
+    def plan_text(self, i):
+        return build_plan_text(int(self.plan_codes[i]), self.activity_levels[i], self.dietary_preferences[i], self.allergies[i])
+
+    # Lazily yield the plan text of every row
+    def iter_plan_texts(self):
+        for i in range(len(self)):
+            yield self.plan_text(i)
+
+    # Pick a menu for every row (uint8 item numbers, see food_catalog.FoodCatalog.menus_bulk)
+    def menus(self, days=7, seed=None):
+        return food_catalog.get_catalog().menus_bulk(self.dietary_preferences, self.allergies, days, seed)
+
 # Function to generate a QR code
-def generate_qr_code(data):
-    
-    qr = qrcode.make(data)                   # Take in data (nutritional plan) and convert to QR
-    qr_path = "qr_code.png"                  # Set path to QR code image
-    qr.save(qr_path)                         # Save the data to the path
-    return qr_path                           # Return QR code path to image => data
-
-# Function to create a table of food options
-def create_food_options_table():
-
-    categories = {
-
-        "Breakfast": [
-            "Whole grain cereal", "Egg whites", "Fruit juice", "Greek yogurt", "Oatmeal", "Avocado toast", "Smoothie with greens", 
-            "Whole grain pancakes", "Almond butter on toast", "Chia seeds pudding", "Mixed berries", "Scrambled eggs with veggies", 
-            "Protein shake", "Nut and seed granola", "Quinoa porridge", "Fruit salad", "Cottage cheese", "Breakfast burrito", 
-            "Sweet potato hash", "Protein-rich smoothie"
-        ],
-
-        "Lunch": [
-            "Grilled chicken salad", "Quinoa and black beans", "Turkey and avocado wrap", "Chicken and vegetable stir-fry", 
-            "Salmon with quinoa", "Lean beef with veggies", "Chickpea and spinach stew", "Grilled tofu and vegetables", 
-            "Greek salad with chicken", "Whole grain pasta with marinara", "Vegetable and lentil soup", "Chicken and sweet potato salad", 
-            "Tofu and veggie kebabs", "Turkey chili", "Stuffed bell peppers", "Chicken and quinoa bowl", "Vegetable curry", 
-            "Grilled shrimp with brown rice", "Salmon and spinach salad", "Chicken and avocado salad"
-        ],
-
-        "Dinner": [
-            "Grilled salmon with vegetables", "Chicken breast with steamed broccoli", "Turkey meatballs with zucchini noodles", 
-            "Stuffed bell peppers with quinoa", "Baked cod with asparagus", "Vegetable stir-fry with tofu", "Beef and vegetable kebabs", 
-            "Lentil soup with spinach", "Chicken curry with brown rice", "Grilled chicken with sweet potato mash", 
-            "Vegetarian chili", "Grilled shrimp with mixed vegetables", "Baked chicken thighs with Brussels sprouts", 
-            "Spaghetti squash with marinara sauce", "Stuffed mushrooms with spinach", "Salmon and kale salad", 
-            "Chicken and vegetable soup", "Baked tofu with broccoli", "Beef stew with carrots", "Grilled portobello mushrooms"
-        ],
-
-        "Snacks": [
-            "Almonds and walnuts", "Greek yogurt with honey", "Apple slices with almond butter", "Carrot sticks with hummus", 
-            "Mixed berries", "Protein bar", "Edamame", "Celery with peanut butter", "Cottage cheese with pineapple", 
-            "Homemade trail mix", "Protein shake", "Vegetable sticks with guacamole", "Apple with cheese slices", 
-            "Rice cakes with avocado", "Chia pudding", "Pumpkin seeds", "Baked sweet potato fries", "Smoothie with protein powder", 
-            "Hard-boiled eggs", "Low-fat cheese sticks"
-        ]
-    }
-
-    fig, ax = plt.subplots(figsize=(12, 10))            # Initialize figure size dimensions
-
-    positions = {                                       # Place each category of food in designated spots
-        "Breakfast": (0.05, 0.55, 0.4, 0.4),
-        "Lunch": (0.55, 0.55, 0.4, 0.4),
-        "Dinner": (0.05, 0.05, 0.4, 0.4),
-        "Snacks": (0.55, 0.05, 0.4, 0.4)
-    }
-
-    colors = {                                          # Set color of each menu
-        "Breakfast": '#e9153f',
-        "Lunch": '#32cd32',
-        "Dinner": '#30b3f5',
-        "Snacks": '#d1b300'
-    }
+def generate_qr_code(data, qr_path="qr_code.png"):
+    import qr_renderer
+
+    return qr_renderer.save_qr_code(data, qr_path)     # Written under a temporary name and renamed, returns the path
+
+# Function to generate a QR code in memory, as PNG bytes (no file is written)
+def generate_qr_code_png(data):
+    import qr_renderer
+
+    return qr_renderer.qr_png(data)
+
+# Function to get the QR code of some data as PNG bytes from the plan cache (also shared with other processes on disk
+# after enable_shared_plan_cache())
+def get_qr_code_png(data):
+    return get_plan_cache().get("qr", hashlib.sha256(data.encode()).hexdigest(), lambda: generate_qr_code_png(data), ".png")
+
+# Function to create a table of food options at food_table_path (rendered once, then copied from the render cache, the
+# user's by default). The file is the caller's: the cache's own file may be evicted by another process at any time.
+def create_food_options_table(food_table_path='food_options_table.png', cache=None):
+
+    cache = cache or RenderCache()
+    key = food_options_table_key()
+    cached_path = cache.get_path(key)                               # Hits never touch matplotlib
+    if cached_path is not None:
+        try:
+            shutil.copyfile(cached_path, food_table_path)
+            return food_table_path
+        except FileNotFoundError:                                   # Evicted since get_path, render it again
+            pass
+
+    image = render_food_options_table()
+    cache.put(key, image)                                           # Cache may be read-only, the file is written anyway
+    with open(food_table_path, 'wb') as file:
+        file.write(image)
+    return food_table_path                                          # Return path
+
+# Function to get the table of food options as PNG bytes (from the render cache, rendered on a miss)
+def get_food_options_table_png():
+
+    cache = RenderCache()
+    key = food_options_table_key()
+    image = cache.get(key)
+    if image is None:
+        image = render_food_options_table()
+        cache.put(key, image)                                       # Cache may be read-only, the bytes are enough
+    return image
+
+# Function to build the render cache key of the food options table from everything the table depends on
+@functools.lru_cache(maxsize=None)
+def food_options_table_key():
+    import importlib.metadata
+    return RenderCache.key({
+        "categories": FOOD_CATEGORIES,
+        "positions": FOOD_TABLE_POSITIONS,
+        "colors": FOOD_TABLE_COLORS,
+        "figsize": FOOD_TABLE_FIGSIZE,
+        "matplotlib": importlib.metadata.version("matplotlib"),
+    })
+
+# Function to draw the table of food options, returns the PNG image bytes
+def render_food_options_table():
+    import matplotlib.pyplot as plt
+    import matplotlib.patches as patches
+
+    fig, ax = plt.subplots(figsize=FOOD_TABLE_FIGSIZE)  # Initialize figure size dimensions
 
     # Function to draw a menu including labels and names of food items
     def draw_section(ax, position, title, items, color):       
@@ -118,66 +234,32 @@ def create_food_options_table():
         for i, item in enumerate(items):
             ax.text(x + 0.02, y + height - 0.06 - 0.015 * i, f"• {item}", ha='left', va='top', fontsize=9, wrap=True)
 
-    for category, items in categories.items():
-        draw_section(ax, positions[category], category, items, colors[category])    # Draw each menu for each category
+    for category, items in FOOD_CATEGORIES.items():
+        draw_section(ax, FOOD_TABLE_POSITIONS[category], category, items, FOOD_TABLE_COLORS[category])    # Draw each menu for each category
 
     ax.axis('off')
 
     plt.suptitle('Meal Plan Options', fontsize=18, fontweight='bold', y=0.95)       # Set title
 
-    food_table_path = 'food_options_table.png'                                      # Set name to image
-    plt.savefig(food_table_path)                                                    # Save configuration to image name
+    buffer = io.BytesIO()
+    plt.savefig(buffer, format='png')                                               # Save configuration to image bytes
     plt.close()                                                                     # Close
     
-    return food_table_path                                                          # Return path
-
-# Function to return a random selection of meals in each category
-def get_food_menu():
-
-    categories = {
-
-        "Breakfast": [
-            "Whole grain cereal", "Egg whites", "Fruit juice", "Greek yogurt", "Oatmeal", "Avocado toast", "Smoothie with greens", 
-            "Whole grain pancakes", "Almond butter on toast", "Chia seeds pudding", "Mixed berries", "Scrambled eggs with veggies", 
-            "Protein shake", "Nut and seed granola", "Quinoa porridge", "Fruit salad", "Cottage cheese", "Breakfast burrito", 
-            "Sweet potato hash", "Protein-rich smoothie"
-        ],
-
-        "Lunch": [
-            "Grilled chicken salad", "Quinoa and black beans", "Turkey and avocado wrap", "Chicken and vegetable stir-fry", 
-            "Salmon with quinoa", "Lean beef with veggies", "Chickpea and spinach stew", "Grilled tofu and vegetables", 
-            "Greek salad with chicken", "Whole grain pasta with marinara", "Vegetable and lentil soup", "Chicken and sweet potato salad", 
-            "Tofu and veggie kebabs", "Turkey chili", "Stuffed bell peppers", "Chicken and quinoa bowl", "Vegetable curry", 
-            "Grilled shrimp with brown rice", "Salmon and spinach salad", "Chicken and avocado salad"
-        ],
-
-        "Dinner": [
-            "Grilled salmon with vegetables", "Chicken breast with steamed broccoli", "Turkey meatballs with zucchini noodles", 
-            "Stuffed bell peppers with quinoa", "Baked cod with asparagus", "Vegetable stir-fry with tofu", "Beef and vegetable kebabs", 
-            "Lentil soup with spinach", "Chicken curry with brown rice", "Grilled chicken with sweet potato mash", 
-            "Vegetarian chili", "Grilled shrimp with mixed vegetables", "Baked chicken thighs with Brussels sprouts", 
-            "Spaghetti squash with marinara sauce", "Stuffed mushrooms with spinach", "Salmon and kale salad", 
-            "Chicken and vegetable soup", "Baked tofu with broccoli", "Beef stew with carrots", "Grilled portobello mushrooms"
-        ],
-
-        "Snacks": [
-            "Almonds and walnuts", "Greek yogurt with honey", "Apple slices with almond butter", "Carrot sticks with hummus", 
-            "Mixed berries", "Protein bar", "Edamame", "Celery with peanut butter", "Cottage cheese with pineapple", 
-            "Homemade trail mix", "Protein shake", "Vegetable sticks with guacamole", "Apple with cheese slices", 
-            "Rice cakes with avocado", "Chia pudding", "Pumpkin seeds", "Baked sweet potato fries", "Smoothie with protein powder", 
-            "Hard-boiled eggs", "Low-fat cheese sticks"
-        ]
-    }
-    
-    menu = "\nSuggested Healthy Menu:\n"
-    for key, value in categories.items():
+    return buffer.getvalue()
 
-        menu += "{}: {}\n".format(key, random.choice(value)) 
-    
-    return menu
+# Function to return a random selection of meals in each category, leaving out items that don't suit the dietary
+# preference or contain an allergen; over several days an item isn't repeated while the category has others left
+# (with a seed the same menu is picked every time)
+def get_food_menu(dietary_preferences=None, allergies=None, days=1, seed=None):
+
+    catalog = food_catalog.get_catalog()
+    rng = random if seed is None else random.Random(seed)
+    return catalog.menu_text(catalog.menu(days, dietary_preferences, allergies, rng))
 
 # Function to replicate and pinpoint BMI on a chart
-def replicate_and_pinpoint_bmi_on_chart(weight, height):
+def replicate_and_pinpoint_bmi_on_chart(weight, height, chart_path='bmi_chart.png'):
+    import matplotlib.pyplot as plt
+    import numpy as np
 
     height_meters = (height[0] * 12 + height[1]) * 0.0254                           # Convert height to meters
     
@@ -206,7 +288,6 @@ def replicate_and_pinpoint_bmi_on_chart(weight, height):
     
     plt.legend(loc='upper right')       # Legend in upper right of window
     
-    chart_path = 'bmi_chart.png'
     plt.savefig(chart_path)
     plt.close()
     
@@ -214,66 +295,114 @@ def replicate_and_pinpoint_bmi_on_chart(weight, height):
 
 # Function to fetch real-time nutritional information from an external API
 def fetch_nutritional_info():
+    import requests
+    import fdc_client
 
     try:
-        response = requests.get('https://api.nal.usda.gov/fdc/v1/foods/list?api_key=pU0wN58tdNGVf0DE4ZwFIGbrHlPkRn7zO1d3O7Jo')  # Included actual API key
-        if response.status_code == 200:
-            data = response.json()
-            # Process and return the data as needed
-            return data[:5]  # Just an example, returning the first 5 items ADJUST TO SHOW MACROS FOR FOOD
-        else:
-            return "Failed to fetch data"
-        
+        return fdc_client.get_client().list_foods(page_size=5)  # Pooled session, cached responses; first 5 items ADJUST TO SHOW MACROS FOR FOOD
+    except requests.RequestException:                      # HTTP errors, and connection errors once retries are used up
+        return "Failed to fetch data"
     except Exception as e:
         return f"Error: {e}"
 
-# Function to get daily health and nutrition tips
-def get_daily_tip():
-
-    tips = [                                                            # List of tips
-        "Drink plenty of water throughout the day.",
-        "Include a variety of fruits and vegetables in your diet.",
-        "Avoid processed foods and opt for whole foods.",
-        "Exercise regularly to maintain a healthy weight.",
-        "Get enough sleep to support overall health.",
-        "Limit sugary drinks and snacks.",
-        "Choose lean proteins such as chicken, fish, and beans.",
-        "Include healthy fats like nuts, seeds, and avocados in your diet."
-    ]
-    return random.choice(tips)                  # Return a random tip from list
+# Function to get daily health and nutrition tips (a random one, or the tip of a day: "2024-05-01")
+def get_daily_tip(day=None):
+
+    if day is None:
+        return random.choice(TIPS)              # Return a random tip from list
+    return TIPS[day_seed(day) % len(TIPS)]
+
+# Function to turn a day ("2024-05-01") and optional other values into a seed for the menu or tip of that day
+def day_seed(day, *values):
+    return int(RenderCache.key([day, *values])[:16], 16)
+
+# Function to build the full plan shown to the user (nutritional plan, food menu and daily tip). Users with the same
+# plan code and choices get the same menu and tip on the same day, so the plan is memoized: the key is the plan code
+# (not the BMI or the goals, which don't change the text), the form's choices and the day. The menu's seed only
+# depends on the items the preference and allergies allow, so "Nuts, Gluten" and "gluten; nuts" share a menu.
+def get_full_plan(bmi, goals, activity_level, dietary_preferences, allergies, day=None):
+
+    day = day or datetime.date.today().isoformat()
+    plan_code = get_plan_code(bmi)
+
+    # Function to make the plan on a miss
+    def make_plan():
+        allowed = food_catalog.get_catalog().allowed(dietary_preferences, allergies)
+        return (build_plan_text(plan_code, activity_level, dietary_preferences, allergies)
+                + get_food_menu(dietary_preferences, allergies, seed=day_seed(day, allowed)) + get_daily_tip(day))
+
+    key = (plan_code, activity_level, dietary_preferences, allergies, day)
+    return get_plan_cache().get("plan", key, make_plan)
+
+# Function to hash everything memoized plans depend on (food catalog, tips, plan names and BMI bands)
+def plan_inputs_fingerprint():
+    return RenderCache.key({
+        "catalog": food_catalog.CATALOG,
+        "tips": TIPS,
+        "plans": PLAN_NAMES,
+        "thresholds": BMI_THRESHOLDS,
+    })
+
+# Function to get this process's plan cache (in memory only until enable_shared_plan_cache() is called)
+@functools.lru_cache(maxsize=None)
+def get_plan_cache():
+    return PlanCache(plan_inputs_fingerprint)
+
+# Function to also keep this process's cached QR codes in the render cache on disk (the user's by default), so worker
+# processes rendering the app's own plans share them. Opt-in: the files hold plan text, and only the app's plans
+# (never text sent by a client) should go through get_qr_code_png once it is on.
+def enable_shared_plan_cache(cache=None):
+    get_plan_cache().disk = cache or RenderCache()
+
+# Function to forget memoized plans, menus and QR codes after the food catalog or tips have been changed
+def invalidate_plan_cache():
+    food_catalog.get_catalog.cache_clear()                          # Indexes rebuilt from the new catalog
+    food_options_table_key.cache_clear()
+    get_plan_cache().invalidate()
 
 # Function to create the Tkinter user interface
-def create_tkinter_window():
+# (background=True renders the QR code, BMI chart and food table on a pool of worker processes so the window never
+# freezes while they are drawn)
+def create_tkinter_window(background=True):
+    import concurrent.futures
+    import multiprocessing
+    import tkinter as tk
+    from tkinter import messagebox, filedialog, ttk
+    from profile_picker import ProfilePicker
+
+    workers = []                                        # Worker pool, started on the first submit
+    current_job = [None]                                # {future: display function} of the submit being rendered
+
+    # Function to show a PNG image (bytes) in a new window; the image is only written to disk if the user saves it
+    def show_image_window(title, png, default_name):
+        image_window = tk.Toplevel(window)
+        image_window.title(title)
+
+        image = tk.PhotoImage(data=base64.b64encode(png), format="png")         # Decoded by Tk straight from memory
+        image_label = tk.Label(image_window, image=image)
+        image_label.image = image
+        image_label.pack(pady=10)
+        tk.Button(image_window, text="Save Image", command=lambda: save_image_to_file(png, default_name)).pack(pady=(0, 10))
+
+    # Function to save a shown image where the user chooses
+    def save_image_to_file(png, default_name):
+        file_path = filedialog.asksaveasfilename(defaultextension=".png", initialfile=default_name, filetypes=[("PNG images", "*.png")])
+        if file_path:
+            with open(file_path, 'wb') as file:
+                file.write(png)
+            messagebox.showinfo("Saved", f"Image saved to {file_path}")
 
-    # Function to display QR code using QR code path
-    def display_qr_code(qr_code_path):  
-        qr_code_window = tk.Toplevel(window)
-        qr_code_window.title("QR Code")
-        
-        qr_code_img = tk.PhotoImage(file=qr_code_path)
-        qr_code_label = tk.Label(qr_code_window, image=qr_code_img)
-        qr_code_label.image = qr_code_img
-        qr_code_label.pack(pady=10)
+    # Function to display QR code
+    def display_qr_code(qr_code_png):
+        show_image_window("QR Code", qr_code_png, "qr_code.png")
 
     # Function to display BMI chart with graph
-    def display_bmi_chart(chart_path):
-        bmi_chart_window = tk.Toplevel(window)
-        bmi_chart_window.title("BMI Chart")
-        
-        chart_img = tk.PhotoImage(file=chart_path)
-        chart_label = tk.Label(bmi_chart_window, image=chart_img)
-        chart_label.image = chart_img
-        chart_label.pack(pady=10)
+    def display_bmi_chart(chart_png):
+        show_image_window("BMI Chart", chart_png, "bmi_chart.png")
 
     # Function to display suggested menu and food options
-    def display_food_options(food_table_path):
-        food_options_window = tk.Toplevel(window)
-        food_options_window.title("Food Options")
-        
-        food_table_img = tk.PhotoImage(file=food_table_path)
-        food_table_label = tk.Label(food_options_window, image=food_table_img)
-        food_table_label.image = food_table_img
-        food_table_label.pack(pady=10)
+    def display_food_options(food_table_png):
+        show_image_window("Food Options", food_table_png, "food_options_table.png")
 
     # Function to clear form
     def clear_form():
@@ -285,21 +414,26 @@ def create_tkinter_window():
         dietary_preferences_combobox.set('')
         allergies_combobox.set('')
 
-    # Function to save generated nutrition info to a text file locally
-    def save_data_to_file(data):
+    # Function to save generated nutrition info to a text file locally (one quoted CSV line, so commas in goals are kept)
+    def save_data_to_file(fields):
+        import csv
         file_path = filedialog.asksaveasfilename(defaultextension=".txt", filetypes=[("Text files", "*.txt")])
         if file_path:
-            with open(file_path, 'w') as file:
-                file.write(data)
+            with open(file_path, 'w', newline='') as file:
+                csv.writer(file).writerow(fields)
             messagebox.showinfo("Saved", f"Data saved to {file_path}")
 
     # Function for loading data from locally saved files
     def load_data_from_file():
         file_path = filedialog.askopenfilename(filetypes=[("Text files", "*.txt")])
         if file_path:
-            with open(file_path, 'r') as file:
-                data = file.read()
-                weight, height_ft, height_in, goals, activity_level, dietary_preferences, allergies = data.split(',')
+            import csv
+            with open(file_path, 'r', newline='') as file:
+                data = next(csv.reader(file), [])
+                if len(data) != 7:
+                    messagebox.showerror("Error", f"{file_path} is not a saved nutrition info file")
+                    return
+                weight, height_ft, height_in, goals, activity_level, dietary_preferences, allergies = data
                 weight_entry.insert(0, weight)
                 height_ft_entry.insert(0, height_ft)
                 height_in_entry.insert(0, height_in)
@@ -328,78 +462,148 @@ def create_tkinter_window():
     def create_profile():
         profile_name = profile_entry.get()
         if profile_name:
-            conn = sqlite3.connect('nutritional_planner.db')
-            c = conn.cursor()
-            c.execute("INSERT INTO profiles (name) VALUES (?)", (profile_name,))
-            conn.commit()
-            conn.close()
+            try:
+                with planner_db.connection() as conn:
+                    conn.execute("INSERT INTO profiles (name) VALUES (?)", (profile_name,))
+            except sqlite3.IntegrityError:                  # Profile names are unique
+                messagebox.showwarning("Profile Exists", f"Profile '{profile_name}' already exists.")
+                return
             messagebox.showinfo("Profile Created", f"Profile '{profile_name}' created successfully!")
             profile_entry.delete(0, tk.END)
-            load_profiles()
+            profile_picker.add(profile_name)                # Inserted in place, the list isn't reloaded
     
-    # Function for retrieving profile names from database to display
+    # Function for retrieving profile names from database to display (only the first page, see ProfilePicker)
     def load_profiles():
-        conn = sqlite3.connect('nutritional_planner.db')
-        c = conn.cursor()
-        c.execute("SELECT name FROM profiles")
-        profiles = c.fetchall()
-        conn.close()
-        profile_listbox.delete(0, tk.END)
-        for profile in profiles:
-            profile_listbox.insert(tk.END, profile[0])
+        profile_picker.reload()
 
     # Function for retrieving data on a preexisting user from database
     def select_profile(event):
         try:
             selected_profile = profile_listbox.get(profile_listbox.curselection())
-            conn = sqlite3.connect('nutritional_planner.db')
-            c = conn.cursor()
-            c.execute("SELECT * FROM users WHERE profile_name=?", (selected_profile,))
-            user_data = c.fetchone()
-            conn.close()
+            user_data = planner_db.get_latest_user(selected_profile)       # Most recent entry of the profile
             if user_data:
                 weight_entry.delete(0, tk.END)
                 height_ft_entry.delete(0, tk.END)
                 height_in_entry.delete(0, tk.END)
                 goals_entry.delete(0, tk.END)
-                activity_level_combobox.set(user_data[7])
-                dietary_preferences_combobox.set(user_data[8])
-                allergies_combobox.set(user_data[9])
-                weight_entry.insert(0, user_data[1])
-                height_ft_entry.insert(0, user_data[2])
-                height_in_entry.insert(0, user_data[3])
-                goals_entry.insert(0, user_data[4])
+                activity_level_combobox.set(user_data[4])
+                dietary_preferences_combobox.set(user_data[5])
+                allergies_combobox.set(user_data[6])
+                weight_entry.insert(0, user_data[0])
+                height_ft_entry.insert(0, user_data[1])
+                height_in_entry.insert(0, user_data[2])
+                goals_entry.insert(0, user_data[3])
         except:
             messagebox.showwarning("Profile Selection", "Please select a valid profile.")
 
+    # Function to run one rendering stage on the worker pool; returns a future. Without background mode the stage
+    # runs right away on this thread, like before.
+    def run_stage(name, function, *args):
+        if tracing.is_enabled():                        # Measured where it runs, the span comes back with the result
+            function, args = tracing.run_traced, (f"stage.{name}", function, *args)
+        if not background:
+            future = concurrent.futures.Future()
+            try:
+                future.set_result(function(*args))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+
+        if not workers:                                 # Start the pool on the first submit, not with the window
+            spawn = multiprocessing.get_context("spawn")    # Forking a process that runs Tk is not safe
+            workers.append(concurrent.futures.ProcessPoolExecutor(max_workers=RENDER_WORKERS, mp_context=spawn))
+        return workers[0].submit(function, *args)
+
+    # Function to check on the current submit's stages, showing each artifact as soon as it is ready
+    def poll_stages(job):
+        if job is not current_job[0]:
+            return                                      # Cancelled or replaced by a newer submit
+
+        for future, display in list(job.items()):
+            if future.done():
+                del job[future]
+                progress.set(progress.get() + 1)
+                try:
+                    result = future.result()
+                    if isinstance(result, tracing.TracedResult):
+                        tracing.record(result.span)
+                        result = result.value
+                    with tracing.span(f"submit.{display.__name__}"):
+                        display(result)
+                except Exception as e:
+                    messagebox.showerror("Rendering Error", f"Could not render this part of your plan: {e}")
+
+        if job is not current_job[0]:
+            return                                      # Cancelled while an error was being shown
+        if job:
+            status_label.config(text=f"Rendering your plan... ({len(job)} left)")
+            window.after(POLL_INTERVAL_MS, poll_stages, job)
+        else:
+            finish_job("Done")
+
+    # Function to reset the progress indicator once a submit is finished or cancelled
+    def finish_job(status):
+        current_job[0] = None
+        progress.set(0)
+        status_label.config(text=status)
+        cancel_button.config(state=tk.DISABLED)
+
+    # Function to cancel the stages of the current submit that have not finished yet
+    def cancel_submit():
+        job = current_job[0]
+        if job:
+            for future in job:
+                future.cancel()                         # Stages already running finish, but are never shown
+            finish_job("Cancelled")
+
+    # Function to shut down the worker pool and close the window
+    def on_close():
+        cancel_submit()
+        if workers:
+            workers[0].shutdown(wait=False, cancel_futures=True)
+        window.destroy()
+
     # Function to process input from user and generate all output data (graph, menu, and qr code)
+    @tracing.traced("submit")
     def on_submit(event=None):
+        from chart_renderer import render_bmi_chart_png
         try:
-            weight = float(weight_entry.get())
-            height = (int(height_ft_entry.get()), int(height_in_entry.get()))
-            goals = goals_entry.get()
-            activity_level = activity_level_combobox.get()
-            dietary_preferences = dietary_preferences_combobox.get()
-            allergies = allergies_combobox.get()
-            
-            bmi = calculate_bmi(weight, height)
-            nutritional_plan = get_nutritional_plan(bmi, goals, activity_level, dietary_preferences, allergies) + get_food_menu() + get_daily_tip()         # Added food menu and daily tip to nutritional plan
-
-            qr_code_path = generate_qr_code(nutritional_plan)
-            chart_path = replicate_and_pinpoint_bmi_on_chart(weight, height)
-            food_table_path = create_food_options_table()
-            
-            selected_profile = profile_listbox.get(profile_listbox.curselection())
-            save_user_data(weight, height[0], height[1], goals, bmi, nutritional_plan, activity_level, dietary_preferences, allergies, selected_profile)
-            
-            messagebox.showinfo("Nutritional Plan", f"Your BMI: {bmi:.2f}\nPlan: {nutritional_plan}")
-
-            display_qr_code(qr_code_path)
-            display_bmi_chart(chart_path)
-            display_food_options(food_table_path)
-            
-            data_to_save = f"{weight},{height[0]},{height[1]},{goals},{activity_level},{dietary_preferences},{allergies}"
-            save_data_to_file(data_to_save)
+            with tracing.span("submit.read_form"):
+                weight = float(weight_entry.get())
+                height = (int(height_ft_entry.get()), int(height_in_entry.get()))
+                goals = goals_entry.get()
+                activity_level = activity_level_combobox.get()
+                dietary_preferences = dietary_preferences_combobox.get()
+                allergies = allergies_combobox.get()
+
+                selected_profile = profile_listbox.get(profile_listbox.curselection())
+
+            with tracing.span("submit.plan"):
+                bmi = calculate_bmi(weight, height)
+                nutritional_plan = get_full_plan(bmi, goals, activity_level, dietary_preferences, allergies)     # Plan with food menu and daily tip
+
+            with tracing.span("submit.start_stages"):
+                cancel_submit()                                     # A new submit replaces one still rendering
+                job = {                                             # Stages return PNG bytes, nothing is written to disk
+                    run_stage("qr_code", get_qr_code_png, nutritional_plan): display_qr_code,
+                    run_stage("bmi_chart", render_bmi_chart_png, weight, height, bmi): display_bmi_chart,    # Cached background + marker
+                    run_stage("food_table", get_food_options_table_png): display_food_options,
+                }
+                current_job[0] = job
+                progress.set(0)
+                progress_bar.config(maximum=len(job))
+                cancel_button.config(state=tk.NORMAL)
+
+            with tracing.span("submit.save_user_data"):
+                save_user_data(weight, height[0], height[1], goals, bmi, nutritional_plan, activity_level, dietary_preferences, allergies, selected_profile)
+
+            poll_stages(job)                                        # Windows pop up as stages finish, even while the
+            with tracing.span("submit.dialog.plan"):                # dialogs are open
+                messagebox.showinfo("Nutritional Plan", f"Your BMI: {bmi:.2f}\nPlan: {nutritional_plan}")
+
+            with tracing.span("submit.dialog.save"):
+                data_to_save = [weight, height[0], height[1], goals, activity_level, dietary_preferences, allergies]
+                save_data_to_file(data_to_save)
         
         except ValueError:
             messagebox.showerror("Input Error", "Please enter valid numbers for weight and height.")
@@ -436,15 +640,15 @@ def create_tkinter_window():
     goals_entry.pack(pady=(0, 10))
     
     tk.Label(frame, text="Activity Level").pack(pady=(10, 5))
-    activity_level_combobox = ttk.Combobox(frame, values=["Sedentary", "Moderate", "Active"])
+    activity_level_combobox = ttk.Combobox(frame, values=ACTIVITY_LEVELS)
     activity_level_combobox.pack(pady=(0, 10))
 
     tk.Label(frame, text="Dietary Preferences").pack(pady=(10, 5))
-    dietary_preferences_combobox = ttk.Combobox(frame, values=["None", "Vegetarian", "Vegan", "Keto", "Meat"])
+    dietary_preferences_combobox = ttk.Combobox(frame, values=DIETARY_PREFERENCES)
     dietary_preferences_combobox.pack(pady=(0, 10))
 
     tk.Label(frame, text="Allergies").pack(pady=(10, 5))
-    allergies_combobox = ttk.Combobox(frame, values=["None", "Nuts", "Chicken", "Gluten"])
+    allergies_combobox = ttk.Combobox(frame, values=ALLERGIES)
     allergies_combobox.pack(pady=(0, 10))
 
     tk.Label(frame, text="Profile Name").pack(pady=(10, 5))
@@ -452,41 +656,40 @@ def create_tkinter_window():
     profile_entry.pack(pady=(0, 10))
     tk.Button(frame, text="Create Profile", command=create_profile).pack(pady=(0, 10))
 
-    tk.Label(frame, text="Select Profile").pack(pady=(10, 5))
-    profile_listbox = tk.Listbox(frame)
-    profile_listbox.pack(pady=(0, 10))
+    tk.Label(frame, text="Select Profile (type to search)").pack(pady=(10, 5))
+    profile_picker = ProfilePicker(frame)
+    profile_picker.pack(pady=(0, 10))
+    profile_listbox = profile_picker.listbox
     profile_listbox.bind('<<ListboxSelect>>', select_profile)
     load_profiles()
     
     # Function for producing a graph showing the progress of a user over time as their weight/BMI changes
+    # (from the rollups and downsampled, so the chart takes the same time whatever the length of the history)
     def track_progress():
+        import matplotlib.pyplot as plt
+        import progress_analytics
         selected_profile = profile_listbox.get(profile_listbox.curselection())
-        conn = sqlite3.connect('nutritional_planner.db')
-        c = conn.cursor()
-        c.execute("SELECT timestamp, bmi FROM users WHERE profile_name=?", (selected_profile,))
-        data = c.fetchall()
-        conn.close()
-
-        dates = [datetime.datetime.strptime(row[0], '%Y-%m-%d %H:%M:%S') for row in data]
-        bmis = [row[1] for row in data]
-
-        plt.figure(figsize=(10, 5))
-        plt.plot(dates, bmis, marker='o')
-        plt.title('BMI Progress Over Time')
-        plt.xlabel('Date')
-        plt.ylabel('BMI')
-        plt.xticks(rotation=45)
-        plt.tight_layout()
+        progress_analytics.plot_progress(selected_profile)
         plt.show()
     
     # Button creation
     submit_button = tk.Button(frame, text="Submit", command=on_submit)
     submit_button.pack(pady=10)
+
+    progress_frame = tk.Frame(frame)
+    progress_frame.pack(pady=(0, 10))
+    progress = tk.DoubleVar(value=0)                    # Number of finished stages of the current submit
+    progress_bar = ttk.Progressbar(progress_frame, length=200, mode='determinate', variable=progress)
+    progress_bar.grid(row=0, column=0, padx=5)
+    cancel_button = tk.Button(progress_frame, text="Cancel", command=cancel_submit, state=tk.DISABLED)
+    cancel_button.grid(row=0, column=1, padx=5)
+    status_label = tk.Label(progress_frame, text="")
+    status_label.grid(row=1, column=0, columnspan=2)
     
     clear_button = tk.Button(frame, text="Clear", command=clear_form)
     clear_button.pack(pady=10)
     
-    save_button = tk.Button(frame, text="Save", command=lambda: save_data_to_file(f"{weight_entry.get()},{height_ft_entry.get()},{height_in_entry.get()},{goals_entry.get()},{activity_level_combobox.get()},{dietary_preferences_combobox.get()},{allergies_combobox.get()}"))
+    save_button = tk.Button(frame, text="Save", command=lambda: save_data_to_file([weight_entry.get(), height_ft_entry.get(), height_in_entry.get(), goals_entry.get(), activity_level_combobox.get(), dietary_preferences_combobox.get(), allergies_combobox.get()]))
     save_button.pack(pady=10)
     
     load_button = tk.Button(frame, text="Load", command=load_data_from_file)
@@ -502,36 +705,38 @@ def create_tkinter_window():
     tk.Label(frame, text=f"Daily Tip: {daily_tip}", wraplength=400, justify='center', font=('Arial', 12, 'italic')).pack(pady=(20, 10))
 
     window.bind('<Return>', on_submit)  # Bind the Enter key to the on_submit function
+    window.protocol("WM_DELETE_WINDOW", on_close)
     
     window.mainloop()
 
-# Initialize the database
+# Initialize the database (creates it, or upgrades an existing one in place without losing its history)
 def create_db():
-    conn = sqlite3.connect('nutritional_planner.db')
-    c = conn.cursor()
-    c.execute('''DROP TABLE IF EXISTS users''')  # Drop existing table to recreate it with correct columns
-    c.execute('''CREATE TABLE users
-                 (id INTEGER PRIMARY KEY, weight REAL, height_ft INTEGER, height_in INTEGER, goals TEXT, bmi REAL, plan TEXT, activity_level TEXT, dietary_preferences TEXT, allergies TEXT, profile_name TEXT, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS profiles (id INTEGER PRIMARY KEY, name TEXT)''')
-    conn.commit()
-    conn.close()
+    planner_db.migrate()
 
 # Function to save user data to local database
 def save_user_data(weight, height_ft, height_in, goals, bmi, plan, activity_level, dietary_preferences, allergies, profile_name):
-    conn = sqlite3.connect('nutritional_planner.db')
-    c = conn.cursor()
-    c.execute("INSERT INTO users (weight, height_ft, height_in, goals, bmi, plan, activity_level, dietary_preferences, allergies, profile_name) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-              (weight, height_ft, height_in, goals, bmi, plan, activity_level, dietary_preferences, allergies, profile_name))
-    conn.commit()
-    conn.close()
+    planner_db.insert_user((weight, height_ft, height_in, goals, bmi, plan, activity_level, dietary_preferences, allergies, profile_name))
 
-# Call create_db() once to initialize the database
-create_db()
-
-# Main function to start the Tkinter application
+# Main function to start the Tkinter application (--startup-report prints how long the app's imports take instead,
+# --no-background renders on the window's thread like older versions)
 def main():
-    create_tkinter_window()
+    if "--startup-report" in sys.argv[1:]:
+        import startup_report
+        return startup_report.main([arg for arg in sys.argv[1:] if arg != "--startup-report"])
+    options = dict(arg[2:].split("=", 1) for arg in sys.argv[1:] if arg.startswith(("--trace=", "--profile=")))
+    trace_path = tracing.enable_from_env(options.get("trace"))     # Spans of every submit, exported when the app closes
+    profiler = tracing.profile_run(options["profile"]) if "profile" in options else contextlib.nullcontext()
+
+    with profiler:
+        create_db()                                     # Create or upgrade the database once, before the window opens
+        planner_db.enable_write_behind()                # History inserts are committed off the window's thread
+        try:
+            create_tkinter_window(background="--no-background" not in sys.argv[1:])
+        finally:
+            planner_db.disable_write_behind()
+            if trace_path:
+                tracing.export(trace_path)
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
 
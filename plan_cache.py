@@ -0,0 +1,79 @@
+# Plan Cache for the Nutritional Planning/Tracking App
+#
+# Description: Memoizes values that many users get from the same inputs (the full plan text, its QR code, ...). Values
+# are kept in an in-process LRU and, optionally, in a RenderCache on disk so worker processes share what another
+# process already made. Every key also holds a fingerprint of what the values depend on (the food catalog, the tips,
+# ...): after invalidate() old entries are never returned again. Hits, misses and evictions are counted.
+
+#--------------------------------------- Imports ---------------------------------------
+
+import collections
+import threading
+
+from render_cache import RenderCache
+
+#--------------------------------------- Constants ---------------------------------------
+
+MAX_ENTRIES = 4096                              # Values kept in memory (least recently used dropped first)
+TEXT_EXTENSION = ".txt"                         # Values stored on disk with this extension are str, others bytes
+
+#--------------------------------------- Classes ---------------------------------------
+
+class PlanCache:
+
+    def __init__(self, fingerprint, max_entries=MAX_ENTRIES, disk=None):
+        self.get_fingerprint = fingerprint          # Function hashing everything the cached values depend on
+        self.max_entries = max_entries
+        self.disk = disk                            # RenderCache shared with other processes, or None
+        self.entries = collections.OrderedDict()    # (namespace, key) -> value, least recently used first
+        self.stats = collections.Counter()
+        self.lock = threading.Lock()
+        self.fingerprint = fingerprint()
+
+    # Function to get a value, calling compute() on a miss. Values with an extension are also looked up in (and
+    # stored to) the disk tier; keys must be JSON encodable for that.
+    def get(self, namespace, key, compute, extension=None):
+        entry_key = (namespace, key)
+        with self.lock:
+            if entry_key in self.entries:
+                self.entries.move_to_end(entry_key)
+                self.stats["hits"] += 1
+                return self.entries[entry_key]
+            fingerprint = self.fingerprint
+
+        value = None
+        if self.disk and extension:
+            disk_key = RenderCache.key([fingerprint, namespace, key])
+            data = self.disk.get(disk_key, extension)
+            if data is not None:
+                value = data.decode() if extension == TEXT_EXTENSION else data
+        counter = "misses" if value is None else "disk_hits"
+        if value is None:
+            value = compute()
+            if self.disk and extension:
+                self.disk.put(disk_key, value.encode() if extension == TEXT_EXTENSION else value, extension)
+
+        with self.lock:
+            self.stats[counter] += 1
+            if fingerprint == self.fingerprint:     # Not invalidated while computing
+                self.entries[entry_key] = value
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+                    self.stats["evictions"] += 1
+        return value
+
+    # Function to drop every cached value (call after the food catalog or tips change); entries on disk are keyed by
+    # the old fingerprint, so they are not read again and age out of the disk cache
+    def invalidate(self):
+        fingerprint = self.get_fingerprint()
+        with self.lock:
+            self.entries.clear()
+            self.fingerprint = fingerprint
+            self.stats["invalidations"] += 1
+
+    # Function to get the counters (hits, disk_hits, misses, evictions, invalidations) and the number of entries
+    def info(self):
+        with self.lock:
+            info = {name: self.stats[name] for name in ("hits", "disk_hits", "misses", "evictions", "invalidations")}
+            info["entries"] = len(self.entries)
+        return info
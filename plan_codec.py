@@ -0,0 +1,151 @@
+# Compact Plan Storage for the Nutritional Planning/Tracking App
+#
+# Description: A saved plan is mostly the same text over and over: the plan name, the activity/preference/allergy lines
+# (already stored in their own columns), the menu lines and a tip. Instead of the whole string, a history row keeps
+# small integer codes: the plan name and the tip as ids into the plan_parts lookup table, and the menu as a short
+# blob of line ids. Each distinct piece of text is stored once. The text is only rebuilt when a plan is read, and only
+# plans that rebuild to exactly the same string are compacted; anything else is kept as it was.
+
+#--------------------------------------- Imports ---------------------------------------
+
+import array
+import functools
+import sys
+
+#--------------------------------------- Constants ---------------------------------------
+
+PART_PLAN, PART_LINE, PART_TIP = 0, 1, 2        # Kinds of text in plan_parts: plan name, menu line, tip
+MENU_HEADER = "\nSuggested Healthy Menu:\n"     # Between the plan's header lines and its menu (see FoodCatalog.menu_text)
+MENU_TYPECODE = "H"                             # Menu line ids are stored as unsigned 16-bit numbers, little-endian
+MAX_PART_ID = 0xFFFF
+MAX_PLAN_CODES = 4096                          # Compacted plans remembered per connection (see compact_rows)
+
+SELECT_PART_SQL = "SELECT id FROM plan_parts WHERE kind = ? AND text = ?"
+INSERT_PART_SQL = "INSERT INTO plan_parts (kind, text) VALUES (?, ?) RETURNING id"
+
+#--------------------------------------- Functions ---------------------------------------
+
+# Function to build the header lines that follow the plan name (the same lines as build_plan_text)
+def plan_header(activity_level, dietary_preferences, allergies):
+    return f"\nActivity Level: {activity_level}\nDietary Preferences: {dietary_preferences}\nAllergies: {allergies}"
+
+# Function to rebuild a plan's text from its pieces
+def join_plan(name, lines, tip, activity_level, dietary_preferences, allergies):
+    return name + plan_header(activity_level, dietary_preferences, allergies) + MENU_HEADER + "".join(line + "\n" for line in lines) + tip
+
+# Function to split a plan's text into (plan name, menu lines, tip); None when it isn't a plan of the usual shape (or
+# would not rebuild to exactly the same text)
+def split_plan(plan, activity_level, dietary_preferences, allergies):
+    if not isinstance(plan, str):
+        return None
+    head, found, rest = plan.partition(MENU_HEADER)
+    header = plan_header(activity_level, dietary_preferences, allergies)
+    if not found or not head.endswith(header):
+        return None
+    *lines, tip = rest.split("\n")
+    parts = (head[:-len(header)], lines, tip)
+    if join_plan(*parts, activity_level, dietary_preferences, allergies) != plan:
+        return None
+    return parts
+
+# Function to get the id of a piece of text, adding it to plan_parts if it is new (in the caller's transaction)
+def intern_part(conn, kind, text, ids):
+    key = (kind, text)
+    part_id = ids.get(key)
+    if part_id is None:
+        row = conn.execute(SELECT_PART_SQL, key).fetchone() or conn.execute(INSERT_PART_SQL, key).fetchone()
+        part_id = ids[key] = row[0]
+    return part_id
+
+# Function to pack menu line ids into the bytes stored in the menu column
+def pack_ids(ids):
+    packed = array.array(MENU_TYPECODE, ids)
+    if sys.byteorder == "big":
+        packed.byteswap()
+    return packed.tobytes()
+
+# Function to unpack the menu column into menu line ids
+def unpack_ids(menu):
+    packed = array.array(MENU_TYPECODE, menu)
+    if sys.byteorder == "big":
+        packed.byteswap()
+    return packed.tolist()
+
+# Function to compact one plan: returns (plan, plan_type, menu, tip_id) to store, with plan None when the codes hold it
+# all (or the plan unchanged and no codes when it can't be compacted)
+def encode_plan(conn, plan, activity_level, dietary_preferences, allergies, ids):
+    parts = split_plan(plan, activity_level, dietary_preferences, allergies)
+    if parts is None:
+        return plan, None, None, None
+    name, lines, tip = parts
+    plan_type = intern_part(conn, PART_PLAN, name, ids)
+    line_ids = [intern_part(conn, PART_LINE, line, ids) for line in lines]
+    tip_id = intern_part(conn, PART_TIP, tip, ids)
+    if max(line_ids, default=0) > MAX_PART_ID:
+        return plan, None, None, None
+    return None, plan_type, pack_ids(line_ids), tip_id
+
+# Function to compact history rows (weight, height_ft, height_in, goals, bmi, plan, activity_level, dietary_preferences,
+# allergies, profile_name[, timestamp]) for insertion: the plan is replaced by its codes, which are appended to the row.
+# planner_db's connections keep the part ids they have seen and the codes of recent plans (users with the same choices
+# save the same plan), so a save usually neither splits the plan nor runs a plan_parts query.
+def compact_rows(conn, rows):
+    ids = getattr(conn, "part_ids", {})
+    codes = getattr(conn, "plan_codes", {})
+    compacted = []
+    for row in rows:
+        key = row[5:9]
+        stored = codes.get(key)
+        if stored is None:
+            stored = encode_plan(conn, *key, ids)
+            if stored[1] is not None:
+                if len(codes) >= MAX_PLAN_CODES:
+                    codes.clear()
+                codes[key] = stored
+        compacted.append(row[:5] + stored[:1] + row[6:] + stored[1:])
+    return compacted
+
+# Function to look up the text of part ids, reading plan_parts again only for ids not seen before. planner_db's
+# connections keep the texts they have read (a new connection, e.g. to a replaced database file, starts empty); other
+# connections read them on every call.
+def get_parts(conn, part_ids):
+    parts = getattr(conn, "part_texts", {})
+    if any(part_id not in parts for part_id in part_ids):
+        parts.update(conn.execute("SELECT id, text FROM plan_parts WHERE id > ?", (max(parts, default=0),)))
+    return parts
+
+# Function to rebuild the text of a stored plan from its columns (plan, plan_type, menu, tip_id, activity_level,
+# dietary_preferences, allergies); plans stored as text are returned as they are
+def decode_plan(conn, plan, plan_type, menu, tip_id, activity_level, dietary_preferences, allergies):
+    if plan_type is None:
+        return plan
+    parts = get_parts(conn, [plan_type, tip_id, *unpack_ids(menu)])
+    return rebuild_plan(parts, plan, plan_type, menu, tip_id, activity_level, dietary_preferences, allergies)
+
+# Function to rebuild the text of a stored plan with a {part id: text} dict holding all its parts
+def rebuild_plan(parts, plan, plan_type, menu, tip_id, activity_level, dietary_preferences, allergies):
+    if plan_type is None:
+        return plan
+    return join_plan(parts[plan_type], [parts[line_id] for line_id in unpack_ids(menu)], parts[tip_id], activity_level,
+                     dietary_preferences, allergies)
+
+# Function to make a rebuild_plan for bulk reads with a {part id: text} dict (e.g. the whole plan_parts table): the
+# header and menu text shared by many plans are only joined once
+def make_rebuilder(parts):
+
+    @functools.lru_cache(maxsize=4096)
+    def header(plan_type, activity_level, dietary_preferences, allergies):
+        return parts[plan_type] + plan_header(activity_level, dietary_preferences, allergies) + MENU_HEADER
+
+    @functools.lru_cache(maxsize=65536)
+    def menu_text(menu):
+        return "".join(parts[line_id] + "\n" for line_id in unpack_ids(menu))
+
+    # Function to rebuild one plan from its columns (plan, plan_type, menu, tip_id, activity_level,
+    # dietary_preferences, allergies)
+    def rebuild(plan, plan_type, menu, tip_id, activity_level, dietary_preferences, allergies):
+        if plan_type is None:
+            return plan
+        return header(plan_type, activity_level, dietary_preferences, allergies) + menu_text(menu) + parts[tip_id]
+
+    return rebuild
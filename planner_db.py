@@ -0,0 +1,553 @@
+# Database Access Layer for the Nutritional Planning/Tracking App
+#
+# Description: Keeps a small pool of long-lived SQLite connections (WAL journal, tuned pragmas, cached prepared
+# statements) instead of opening and closing a connection for every query. History inserts can also go through a
+# write-behind BatchWriter, which groups rows into one transaction with executemany and commits when enough rows are
+# waiting or a short interval has passed, so thousands of rows per second only cost a handful of fsyncs.
+
+#--------------------------------------- Imports ---------------------------------------
+
+import collections
+import os
+import queue
+import sqlite3
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import plan_codec
+import tracing
+
+#--------------------------------------- Constants ---------------------------------------
+
+DB_PATH = 'nutritional_planner.db'
+
+PRAGMAS = [
+    "PRAGMA journal_mode=WAL",                  # Readers don't block the writer and commits append to the log
+    "PRAGMA busy_timeout=5000",                 # Wait for other writers instead of failing with "database is locked"
+    "PRAGMA cache_size=-16000",                 # 16 MB page cache per connection
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA foreign_keys=ON",
+]
+
+SYNCHRONOUS = {"off": "OFF", "normal": "NORMAL", "full": "FULL"}     # Durability levels (see BatchWriter)
+
+# History rows are (weight, height_ft, height_in, goals, bmi, plan, activity_level, dietary_preferences, allergies, profile_name);
+# the plan is stored as codes (see plan_codec), which compact_rows appends to the row
+INSERT_USER_SQL = ("INSERT INTO users (weight, height_ft, height_in, goals, bmi, plan, activity_level, dietary_preferences, "
+                   "allergies, profile_id, plan_type, menu, tip_id) "
+                   "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, (SELECT id FROM profiles WHERE name = ?), ?, ?, ?)")
+IMPORT_USER_SQL = ("INSERT INTO users (weight, height_ft, height_in, goals, bmi, plan, activity_level, dietary_preferences, "
+                   "allergies, profile_id, timestamp, plan_type, menu, tip_id) "
+                   "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, (SELECT id FROM profiles WHERE name = ?), coalesce(?, CURRENT_TIMESTAMP), ?, ?, ?)")
+ENSURE_PROFILE_SQL = "INSERT OR IGNORE INTO profiles (name) VALUES (?)"
+
+LATEST_USER_SQL = ("SELECT weight, height_ft, height_in, goals, activity_level, dietary_preferences, allergies FROM users "
+                   "WHERE profile_id = (SELECT id FROM profiles WHERE name = ?) ORDER BY timestamp DESC, id DESC LIMIT 1")
+BMI_HISTORY_SQL = ("SELECT timestamp, bmi FROM users WHERE profile_id = (SELECT id FROM profiles WHERE name = ?) "
+                   "ORDER BY timestamp, id")
+PLANS_SQL = ("SELECT timestamp, plan, plan_type, menu, tip_id, activity_level, dietary_preferences, allergies FROM users "
+             "WHERE profile_id = (SELECT id FROM profiles WHERE name = ?) AND timestamp >= ? AND timestamp < ? "
+             "ORDER BY timestamp, id")
+BMI_RANGE_SQL = ("SELECT CAST(strftime('%s', timestamp) AS INTEGER), bmi FROM users "
+                 "WHERE profile_id = (SELECT id FROM profiles WHERE name = ?) AND timestamp >= ? AND timestamp < ? "
+                 "ORDER BY timestamp, id")
+
+# Pages of profile names starting with a prefix, in name order, from the unique name index. Pages continue from the last
+# (or first) name shown instead of an OFFSET, so any page is as fast as the first. The upper bound is the first string
+# after every name with the prefix (any text sorts before a blob, so b"" when there is no prefix).
+PROFILE_PAGE_SQL = "SELECT name FROM profiles WHERE name >= ? AND name < ? ORDER BY name LIMIT ?"
+PROFILE_PAGE_AFTER_SQL = "SELECT name FROM profiles WHERE name > ? AND name < ? ORDER BY name LIMIT ?"
+PROFILE_PAGE_BEFORE_SQL = "SELECT name FROM profiles WHERE name < ? AND name >= ? ORDER BY name DESC LIMIT ?"
+PROFILE_PAGE_SIZE = 100
+
+# Default date range of the range queries (full dates: a number such as "2024" would compare as one with the timestamps)
+FIRST_DATE = "0000-01-01"
+END_DATE = "9999-12-31"
+
+# Rollup tables (per profile and day or week, Monday to Sunday) kept up to date by write_users: period -> start date.
+# The new rows are read by id and added up in Python, then merged into the stored rollups (the latest reading of a
+# period is the one with the latest timestamp, the highest id among equal timestamps).
+ROLLUP_PERIODS = {"bmi_daily": "date(timestamp)", "bmi_weekly": "date(timestamp, 'weekday 0', '-6 days')"}
+ROLLUP_COLUMNS = "profile_id, " + ", ".join(ROLLUP_PERIODS.values()) + ", timestamp, id, bmi"
+ROLLUP_ROWS_SQL = f"SELECT {ROLLUP_COLUMNS} FROM users WHERE id > ? AND profile_id IS NOT NULL AND bmi IS NOT NULL"
+ROLLUP_RETURNING_SQL = f" RETURNING {ROLLUP_COLUMNS}"
+ROLLUP_SQL = '''INSERT INTO {table} (profile_id, period, count, bmi_sum, bmi_min, bmi_max, last_timestamp, last_bmi)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (profile_id, period) DO UPDATE SET
+                    count = count + excluded.count, bmi_sum = bmi_sum + excluded.bmi_sum,
+                    bmi_min = min(bmi_min, excluded.bmi_min), bmi_max = max(bmi_max, excluded.bmi_max),
+                    last_bmi = CASE WHEN excluded.last_timestamp >= last_timestamp THEN excluded.last_bmi ELSE last_bmi END,
+                    last_timestamp = max(last_timestamp, excluded.last_timestamp)'''
+ROLLUP_STATEMENTS = {table: ROLLUP_SQL.format(table=table) for table in ROLLUP_PERIODS}
+ROLLUP_RANGE_SQL = ("SELECT CAST(strftime('%s', period) AS INTEGER), count, bmi_sum, bmi_min, bmi_max, last_bmi FROM {table} "
+                    "WHERE profile_id = (SELECT id FROM profiles WHERE name = ?) AND period >= ? AND period < ? ORDER BY period")
+
+RETRY_TIMEOUT = 60                              # Seconds the BatchWriter retries a batch while the database is locked
+RETRY_DELAY = 0.05                              # First wait between retries, doubled up to MAX_RETRY_DELAY
+MAX_RETRY_DELAY = 1.0
+MAX_FAILED_ROWS = 10_000                        # Failed rows the BatchWriter keeps until they are reported
+
+_pools = {}
+_pools_lock = threading.Lock()
+_writer = None                                  # Process-wide BatchWriter when write-behind mode is on
+
+#--------------------------------------- Functions ---------------------------------------
+
+# Function to open a connection with the app's pragmas
+def connect(path=DB_PATH, durability="normal"):
+    conn = sqlite3.connect(path, timeout=5.0, check_same_thread=False, cached_statements=256, isolation_level=None,
+                           factory=PlannerConnection)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    conn.execute(f"PRAGMA synchronous={SYNCHRONOUS[durability]}")
+    return conn
+
+# Function to get the pool of a database (one per process, a forked child gets fresh connections)
+def get_pool(path=DB_PATH):
+    key = (os.path.abspath(path), os.getpid())
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = ConnectionPool(path)
+    return pool
+
+# Function to borrow a pooled connection (autocommit, use transaction() to group writes)
+@contextmanager
+def connection(path=DB_PATH):
+    with get_pool(path).connection() as conn:
+        yield conn
+
+# Function to run several statements as one transaction on a pooled connection
+@contextmanager
+def transaction(path=DB_PATH):
+    with get_pool(path).connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")             # Take the write lock up front, avoids deadlocking upgrades
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback_transaction()
+            raise
+        conn.execute("COMMIT")
+
+# Function to write history rows on a connection that is already in a transaction (creates missing profiles);
+# timestamps=True takes rows with their timestamp as an 11th field (imports keep the original times)
+def write_users(conn, rows, timestamps=False):
+    names = {row[9] for row in rows if row[9] is not None} - conn.profile_names
+    if names:
+        conn.executemany(ENSURE_PROFILE_SQL, [(name,) for name in names])
+        conn.profile_names.update(names)
+    sql = IMPORT_USER_SQL if timestamps else INSERT_USER_SQL
+    rows = plan_codec.compact_rows(conn, rows)
+    if len(rows) == 1:                              # A single save gets the rollup fields back from its insert
+        added = conn.execute(sql + ROLLUP_RETURNING_SQL, rows[0]).fetchall()
+        add_to_rollups(conn, [row for row in added if row[0] is not None and row[-1] is not None])
+    else:
+        last_id = conn.execute("SELECT max(id) FROM users").fetchone()[0] or 0
+        conn.executemany(sql, rows)
+        update_rollups(conn, last_id)
+
+# Function to add the history rows after last_id to the daily and weekly rollups (in the caller's transaction)
+def update_rollups(conn, last_id):
+    add_to_rollups(conn, conn.execute(ROLLUP_ROWS_SQL, (last_id,)))
+
+# Function to add history rows (ROLLUP_COLUMNS, with a profile and a BMI) to the daily and weekly rollups
+def add_to_rollups(conn, rows):
+    groups = [{} for _ in ROLLUP_PERIODS]         # Per table: (profile_id, period) -> [count, sum, min, max, (timestamp, id), bmi]
+    for row in rows:
+        profile_id, latest, bmi = row[0], row[-3:-1], row[-1]
+        for column, table_groups in enumerate(groups, 1):
+            key = (profile_id, row[column])
+            group = table_groups.get(key)
+            if group is None:
+                table_groups[key] = [1, bmi, bmi, bmi, latest, bmi]
+                continue
+            group[0] += 1
+            group[1] += bmi
+            if bmi < group[2]:
+                group[2] = bmi
+            elif bmi > group[3]:
+                group[3] = bmi
+            if latest > group[4]:
+                group[4], group[5] = latest, bmi
+    for table, table_groups in zip(ROLLUP_PERIODS, groups):
+        conn.executemany(ROLLUP_STATEMENTS[table], [(*key, count, total, low, high, latest[0], bmi)
+                                                    for key, (count, total, low, high, latest, bmi) in table_groups.items()])
+
+# Function to save one history row, through the write-behind writer when it is enabled
+# (wait=True returns only once the row is committed)
+@tracing.traced("db.insert_user")
+def insert_user(row, path=DB_PATH, wait=False):
+    writer = _writer
+    if writer is not None and writer.path == path:
+        writer.add(row, wait)
+    else:
+        with transaction(path) as conn:
+            write_users(conn, [row])
+
+# Function to get the most recent history row of a profile (or None) through the (profile_id, timestamp) index
+@tracing.traced("db.get_latest_user")
+def get_latest_user(profile_name, path=DB_PATH):
+    flush()                                         # Include rows still waiting in the write-behind queue
+    with connection(path) as conn:
+        return conn.execute(LATEST_USER_SQL, (profile_name,)).fetchone()
+
+# Function to get the (timestamp, bmi) history of a profile, oldest first
+@tracing.traced("db.get_bmi_history")
+def get_bmi_history(profile_name, path=DB_PATH):
+    flush()
+    with connection(path) as conn:
+        return conn.execute(BMI_HISTORY_SQL, (profile_name,)).fetchall()
+
+# Function to get the history of a profile between two timestamps ("YYYY-MM-DD[ HH:MM:SS]", end excluded) as
+# (unix time, bmi) rows, oldest first, through the (profile_id, timestamp) index
+@tracing.traced("db.get_bmi_range")
+def get_bmi_range(profile_name, start=FIRST_DATE, end=END_DATE, path=DB_PATH):
+    flush()
+    with connection(path) as conn:
+        return conn.execute(BMI_RANGE_SQL, (profile_name, start, end)).fetchall()
+
+# Function to get the plans of a profile between two timestamps as (timestamp, plan text) rows, oldest first (the
+# text is rebuilt from the stored codes)
+@tracing.traced("db.get_plans")
+def get_plans(profile_name, start=FIRST_DATE, end=END_DATE, path=DB_PATH):
+    flush()
+    with connection(path) as conn:
+        return [(row[0], plan_codec.decode_plan(conn, *row[1:])) for row in conn.execute(PLANS_SQL, (profile_name, start, end))]
+
+# Function to get the daily or weekly rollup of a profile between two dates as
+# (unix time of the period start, count, bmi sum, bmi min, bmi max, last bmi) rows, oldest first
+@tracing.traced("db.get_bmi_rollup")
+def get_bmi_rollup(profile_name, resolution="day", start=FIRST_DATE, end=END_DATE, path=DB_PATH):
+    table = {"day": "bmi_daily", "week": "bmi_weekly"}[resolution]
+    flush()
+    with connection(path) as conn:
+        return conn.execute(ROLLUP_RANGE_SQL.format(table=table), (profile_name, start, end)).fetchall()
+
+# Function to get a page of profile names starting with prefix, in name order: the first page, the page after the name
+# `after` or the page before the name `before`
+@tracing.traced("db.get_profile_page")
+def get_profile_page(prefix="", after=None, before=None, limit=PROFILE_PAGE_SIZE, path=DB_PATH):
+    end = prefix_end(prefix)
+    flush()                                         # Profiles of rows still waiting are created with them
+    with connection(path) as conn:
+        if before is not None:
+            return [row[0] for row in conn.execute(PROFILE_PAGE_BEFORE_SQL, (before, prefix, limit))][::-1]
+        if after is not None:
+            return [row[0] for row in conn.execute(PROFILE_PAGE_AFTER_SQL, (after, end, limit))]
+        return [row[0] for row in conn.execute(PROFILE_PAGE_SQL, (prefix, end, limit))]
+
+# Function to get the first string after every string starting with prefix, in SQLite's text order (that of the
+# code points); b"" (after all text) for no prefix
+def prefix_end(prefix):
+    while prefix:
+        code = ord(prefix[-1]) + 1
+        if code <= sys.maxunicode:
+            return prefix[:-1] + chr(0xE000 if 0xD800 <= code <= 0xDFFF else code)     # Surrogates can't be stored
+        prefix = prefix[:-1]
+    return b""
+
+# Function to bring a database up to the latest schema version, keeping its data (safe to run every start)
+@tracing.traced("db.migrate")
+def migrate(path=DB_PATH):
+    with connection(path) as conn:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        with transaction(path) as conn:
+            if conn.execute("PRAGMA user_version").fetchone()[0] >= number:
+                continue                            # Another process got here first
+            migration(conn)
+            conn.execute(f"PRAGMA user_version={number}")
+    return len(MIGRATIONS)
+
+# Function to turn on write-behind mode for insert_user (arguments are passed to BatchWriter)
+def enable_write_behind(**options):
+    global _writer
+    disable_write_behind()
+    _writer = BatchWriter(**options)
+    return _writer
+
+# Function to turn write-behind mode off, committing anything still waiting
+def disable_write_behind():
+    global _writer
+    writer, _writer = _writer, None
+    if writer is not None:
+        writer.close()
+
+# Function to wait until every row added so far is committed (no-op when write-behind mode is off). Called before
+# reads, so rows that failed are not raised here but to their own writers (see BatchWriter.flush).
+def flush():
+    if _writer is not None:
+        _writer.flush(report=False)
+
+# Function to tell whether an error is another connection holding the lock (worth retrying)
+def is_busy(error):
+    return (isinstance(error, sqlite3.OperationalError)
+            and getattr(error, "sqlite_errorcode", 0) & 0xFF in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED))
+
+#--------------------------------------- Classes ---------------------------------------
+
+class PlannerConnection(sqlite3.Connection):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.part_ids = {}                      # (kind, text) -> plan_parts id known on this connection (see plan_codec)
+        self.part_texts = {}                    # plan_parts id -> text read on this connection
+        self.plan_codes = {}                    # (plan, activity, preferences, allergies) -> codes stored for the plan
+        self.profile_names = set()              # Profiles known to exist (write_users doesn't create them again)
+
+    # Function to roll back the open transaction (if any); parts, plan codes and profiles found or added in it may be
+    # gone, so all of them are forgotten
+    def rollback_transaction(self):
+        self.part_ids.clear()
+        self.part_texts.clear()
+        self.plan_codes.clear()
+        self.profile_names.clear()
+        if self.in_transaction:
+            self.execute("ROLLBACK")
+
+
+class ConnectionPool:
+
+    def __init__(self, path=DB_PATH, size=4):
+        self.path = path
+        self.size = size
+        self.idle = queue.LifoQueue()           # Most recently used first, its pages are still warm
+        self.created = 0
+        self.lock = threading.Lock()
+
+    # Function to borrow a connection, opening a new one while the pool is below its size
+    @contextmanager
+    def connection(self):
+        try:
+            conn = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                can_open = self.created < self.size
+                if can_open:
+                    self.created += 1
+            conn = connect(self.path) if can_open else self.idle.get()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:             # Never hand out a connection in the middle of a transaction
+                conn.rollback_transaction()
+            self.idle.put(conn)
+
+    # Function to close every idle connection
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+        self.created = 0
+
+
+# Raised for history rows the BatchWriter could not commit; .rows holds them, in the order they were added, so the
+# caller can save them again
+class BatchWriteError(RuntimeError):
+
+    def __init__(self, failures):
+        super().__init__(f"BatchWriter failed to commit {len(failures)} row(s): {failures[0][2]}")
+        self.rows = [row for _, row, _ in failures]
+
+
+class BatchWriter:
+
+    # flush_size: commit as soon as this many rows are waiting
+    # flush_interval: commit rows that have waited this many seconds
+    # durability: "full" survives power loss on every commit, "normal" (WAL default) may lose the last commits on
+    # power loss but never corrupts, "off" leaves syncing to the operating system
+    # write: function that writes a batch of rows on a connection in a transaction (defaults to users rows)
+    # retry_timeout: seconds a batch keeps being retried while another connection holds the write lock
+    def __init__(self, path=DB_PATH, flush_size=500, flush_interval=0.05, durability="normal", write=write_users,
+                 retry_timeout=RETRY_TIMEOUT):
+        self.path = path
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.write = write
+        self.retry_timeout = retry_timeout
+        self.conn = connect(path, durability)
+        self.rows = []
+        self.added = 0                          # Rows added / done (committed or failed) so far, rows are numbered in order
+        self.done = 0
+        self.failures = collections.deque(maxlen=MAX_FAILED_ROWS)     # (row number, row, error) of failed rows not raised yet
+        self.closed = False
+        self.flushing = False                   # Set by flush() to commit without waiting for the interval
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name="BatchWriter", daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # Function to queue one row for the next batch (wait=True returns only once the row is committed)
+    def add(self, row, wait=False):
+        self.add_many([row], wait)
+
+    # Function to queue several rows for the next batch (wait=True returns once they are committed, and raises
+    # BatchWriteError with those of them that could not be)
+    def add_many(self, rows, wait=False):
+        with self.condition:
+            if self.closed:
+                raise RuntimeError("BatchWriter is closed")
+            first = self.added
+            was_empty = not self.rows
+            self.rows.extend(rows)
+            self.added += len(rows)
+            if was_empty or len(self.rows) >= self.flush_size:
+                self.condition.notify_all()             # Start the interval, or commit a full batch now
+            if not wait:
+                return
+            self.flushing = True
+            self.condition.notify_all()
+            while self.done < first + len(rows):
+                self.condition.wait()
+            failures = self.take_failures(first, first + len(rows))
+        if failures:
+            raise BatchWriteError(failures) from failures[0][2]
+
+    # Function to block until every row added so far is committed or failed. report=True raises BatchWriteError with
+    # the failed rows not raised yet; report=False only waits (readers, the rows aren't theirs).
+    def flush(self, report=True):
+        with self.condition:
+            target = self.added
+            self.flushing = True
+            self.condition.notify_all()
+            while self.done < target:
+                self.condition.wait()
+            failures = self.take_failures(0, target) if report else []
+        if failures:
+            raise BatchWriteError(failures) from failures[0][2]
+
+    # Function to commit what is waiting and stop the writer thread; raises BatchWriteError with the rows that failed
+    # and were not reported yet
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+        self.conn.close()
+        with self.condition:
+            failures = self.take_failures(0, self.added)
+        if failures:
+            raise BatchWriteError(failures) from failures[0][2]
+
+    # Function to remove and return the failed rows numbered [start, end) (called holding the condition)
+    def take_failures(self, start, end):
+        taken = [failure for failure in self.failures if start <= failure[0] < end]
+        if taken:
+            self.failures = collections.deque((failure for failure in self.failures if not start <= failure[0] < end),
+                                              maxlen=self.failures.maxlen)
+        return taken
+
+    # Writer thread: once rows are waiting, wait for a full batch, the flush interval, a flush() or close(), then commit
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.rows and not self.closed:
+                    self.condition.wait()
+                deadline = time.monotonic() + self.flush_interval
+                while not self.closed and not self.flushing and len(self.rows) < self.flush_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                rows, self.rows = self.rows, []
+                first = self.done                       # Only this thread takes rows, so they are the next ones
+                self.flushing = False
+                if not rows and self.closed:
+                    return
+
+            failures = []
+            error = self.commit(rows)
+            if error is not None and len(rows) > 1 and not is_busy(error):
+                for number, row in enumerate(rows, first):      # One bad row fails its batch, find the ones at fault
+                    row_error = self.commit([row])
+                    if row_error is not None:
+                        failures.append((number, row, row_error))
+            elif error is not None:
+                failures = [(number, row, error) for number, row in enumerate(rows, first)]
+
+            with self.condition:
+                self.failures.extend(failures)
+                self.done += len(rows)
+                self.condition.notify_all()
+
+    # Function to write rows in one transaction, retrying with a growing delay while another connection holds the
+    # write lock (for up to retry_timeout seconds); returns None once committed, else the error
+    def commit(self, rows):
+        delay, deadline = RETRY_DELAY, time.monotonic() + self.retry_timeout
+        while True:
+            try:
+                with tracing.span("db.write_batch", rows=len(rows)):
+                    self.conn.execute("BEGIN IMMEDIATE")
+                    self.write(self.conn, rows)
+                    self.conn.execute("COMMIT")
+                return None
+            except Exception as e:
+                self.conn.rollback_transaction()
+                if not is_busy(e) or time.monotonic() + delay > deadline:
+                    return e
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_RETRY_DELAY)
+
+
+#--------------------------------------- Migrations ---------------------------------------
+
+# Version 1: the original tables
+def create_tables(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS users
+                 (id INTEGER PRIMARY KEY, weight REAL, height_ft INTEGER, height_in INTEGER, goals TEXT, bmi REAL, plan TEXT, activity_level TEXT, dietary_preferences TEXT, allergies TEXT, profile_name TEXT, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS profiles (id INTEGER PRIMARY KEY, name TEXT)''')
+
+# Version 2: unique profile names, users.profile_id instead of the profile's name, index on (profile_id, timestamp)
+def normalize_profiles(conn):
+    conn.execute("CREATE TABLE profiles_new (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)")
+    conn.execute("INSERT INTO profiles_new (id, name) SELECT MIN(id), name FROM profiles WHERE name IS NOT NULL GROUP BY name")
+    conn.execute("INSERT OR IGNORE INTO profiles_new (name) SELECT DISTINCT profile_name FROM users WHERE profile_name IS NOT NULL")
+    conn.execute("DROP TABLE profiles")
+    conn.execute("ALTER TABLE profiles_new RENAME TO profiles")
+
+    conn.execute('''CREATE TABLE users_new
+                 (id INTEGER PRIMARY KEY, profile_id INTEGER REFERENCES profiles(id), weight REAL, height_ft INTEGER, height_in INTEGER, goals TEXT, bmi REAL, plan TEXT, activity_level TEXT, dietary_preferences TEXT, allergies TEXT, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)''')
+    conn.execute('''INSERT INTO users_new (id, profile_id, weight, height_ft, height_in, goals, bmi, plan, activity_level, dietary_preferences, allergies, timestamp)
+                 SELECT users.id, profiles.id, weight, height_ft, height_in, goals, bmi, plan, activity_level, dietary_preferences, allergies, timestamp
+                 FROM users LEFT JOIN profiles ON profiles.name = users.profile_name''')
+    conn.execute("DROP TABLE users")
+    conn.execute("ALTER TABLE users_new RENAME TO users")
+    conn.execute("CREATE INDEX users_profile_timestamp ON users (profile_id, timestamp)")
+
+# Version 3: daily and weekly BMI rollups, filled from the existing history
+def create_rollups(conn):
+    for table in ROLLUP_PERIODS:
+        conn.execute(f'''CREATE TABLE {table} (profile_id INTEGER NOT NULL, period TEXT NOT NULL, count INTEGER NOT NULL,
+                     bmi_sum REAL NOT NULL, bmi_min REAL NOT NULL, bmi_max REAL NOT NULL, last_timestamp TEXT, last_bmi REAL,
+                     PRIMARY KEY (profile_id, period)) WITHOUT ROWID''')
+    update_rollups(conn, 0)
+
+# Version 4: plans stored as codes into the plan_parts lookup table (see plan_codec), existing plans compacted
+def compact_plans(conn, chunk_size=10_000):
+    conn.execute('''CREATE TABLE plan_parts (id INTEGER PRIMARY KEY, kind INTEGER NOT NULL, text TEXT NOT NULL,
+                 UNIQUE (kind, text))''')
+    for column in ("plan_type INTEGER", "menu BLOB", "tip_id INTEGER"):
+        conn.execute(f"ALTER TABLE users ADD COLUMN {column}")
+
+    ids = {}
+    last_id = 0
+    while True:
+        rows = conn.execute("SELECT id, plan, activity_level, dietary_preferences, allergies FROM users "
+                            "WHERE id > ? AND plan IS NOT NULL ORDER BY id LIMIT ?", (last_id, chunk_size)).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        codes = [(plan_codec.encode_plan(conn, *row[1:], ids), row[0]) for row in rows]
+        conn.executemany("UPDATE users SET plan = ?, plan_type = ?, menu = ?, tip_id = ? WHERE id = ?",
+                         [(*encoded, row_id) for encoded, row_id in codes if encoded[1] is not None])
+
+MIGRATIONS = [create_tables, normalize_profiles, create_rollups, compact_plans]        # Append new versions, never edit or reorder old ones
@@ -0,0 +1,456 @@
+# HTTP Service for the Nutritional Planning/Tracking App
+#
+# Description: Serves the planner to many users at once over HTTP: profiles, plans, history and progress as JSON, and
+# the QR code, BMI chart, food table and progress chart as PNG images. The front end is a single asyncio event loop
+# (HTTP/1.1 with keep-alive, no dependencies outside the standard library). Plans are cheap and are made on the loop;
+# database calls run on a few threads sharing planner_db's connection pool, history rows are written behind in batches,
+# and images are rendered on a pool of processes. Identical renders requested while one is in flight share its result.
+#
+# Usage: python planner_service.py --port 8080 --workers 4
+#        curl -X POST localhost:8080/plan -d '{"profile": "Ann", "weight": 150, "height_ft": 5, "height_in": 6}'
+#        python load_test.py --spawn-server                 (requests per second and latency percentiles)
+#
+# Endpoints: GET  /health, /stats, /profiles?prefix=&after=&limit=, /profiles/<name> (latest entry), /profiles/<name>/history?start=&end=,
+#                 /profiles/<name>/progress?start=&end=&max_points=, /profiles/<name>/progress.png,
+#                 /chart.png?weight=&height_ft=&height_in=, /food_table.png
+#            POST /profiles {"name"}, /plan {"profile", "weight", "height_ft", "height_in", "goals", "activity_level",
+#                 "dietary_preferences", "allergies"} (saved to the profile's history when a profile is given),
+#                 /qr.png (the request body is encoded)
+
+#--------------------------------------- Imports ---------------------------------------
+
+import os
+os.environ.setdefault("MPLBACKEND", "Agg")          # Workers have no display, render off-screen
+
+import argparse
+import asyncio
+import collections
+import hashlib
+import json
+import multiprocessing
+import re
+import signal
+import sqlite3
+import sys
+import urllib.parse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from http import HTTPStatus
+
+import nutritional_planner as planner
+import planner_db
+import tracing
+
+#--------------------------------------- Constants ---------------------------------------
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8080
+RENDER_WORKERS = max(1, (os.cpu_count() or 2) - 1)      # Processes rendering images (one core left to the event loop)
+DB_THREADS = 4                                          # Threads running database calls (planner_db's pool size)
+MAX_BODY_BYTES = 1024 * 1024                            # Largest request body accepted
+MAX_HEADER_BYTES = 64 * 1024                            # Largest request line and headers accepted
+KEEP_ALIVE_TIMEOUT = 30                                 # Seconds an idle connection is kept open
+MAX_PROFILE_PAGE = 1000                                 # Most profile names returned by one GET /profiles
+
+Request = collections.namedtuple("Request", ["method", "path", "query", "headers", "body", "keep_alive"])
+
+# (method, path pattern, PlannerService method); groups of the pattern are passed to the method
+ROUTES = [
+    ("GET", r"/health", "health"),
+    ("GET", r"/stats", "get_stats"),
+    ("GET", r"/profiles", "list_profiles"),
+    ("POST", r"/profiles", "create_profile"),
+    ("GET", r"/profiles/([^/]+)", "latest_entry"),
+    ("GET", r"/profiles/([^/]+)/history", "history"),
+    ("GET", r"/profiles/([^/]+)/progress", "progress"),
+    ("GET", r"/profiles/([^/]+)/progress\.png", "progress_png"),
+    ("POST", r"/plan", "plan"),
+    ("GET", r"/chart\.png", "chart_png"),
+    ("POST", r"/qr\.png", "qr_png"),
+    ("GET", r"/food_table\.png", "food_table_png"),
+]
+COMPILED_ROUTES = [(method, re.compile(pattern), handler) for method, pattern, handler in ROUTES]
+
+#--------------------------------------- Classes ---------------------------------------
+
+# Error answered with its HTTP status and message (as {"error": message})
+class HTTPError(Exception):
+
+    def __init__(self, status, message=None):
+        super().__init__(message or HTTPStatus(status).phrase)
+        self.status = status
+        self.message = message or HTTPStatus(status).phrase
+
+
+class PlannerService:
+
+    def __init__(self, db_path=planner_db.DB_PATH, workers=RENDER_WORKERS):
+        self.db_path = db_path
+        self.workers = workers
+        self.render_pool = None
+        self.db_threads = None
+        self.in_flight = {}                         # Render key -> future of the render running for it
+        self.stats = collections.Counter()
+
+    # Function to start the worker pools and the database (call before serving)
+    def start(self):
+        planner_db.migrate(self.db_path)
+        spawn = multiprocessing.get_context("spawn")    # The service runs threads, forking it is not safe
+        self.render_pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=spawn, initializer=warm_up_worker)
+        self.db_threads = ThreadPoolExecutor(max_workers=DB_THREADS, thread_name_prefix="planner-db")
+        planner_db.enable_write_behind(path=self.db_path)
+
+    # Function to stop the pools, committing the history rows still waiting (raises BatchWriteError with any rows that
+    # could not be saved, once the pools are stopped)
+    def close(self):
+        try:
+            planner_db.disable_write_behind()
+        finally:
+            if self.db_threads:
+                self.db_threads.shutdown(wait=True)
+            if self.render_pool:
+                self.render_pool.shutdown(wait=True, cancel_futures=True)
+
+    # Function to run a database call on the database threads
+    async def db(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.db_threads, function, *args)
+
+    # Function to run a render on the process pool; a render with the same key already in flight is shared instead
+    # of started again (callers that give up do not cancel it for the others)
+    async def render(self, key, function, *args):
+        future = self.in_flight.get(key)
+        if future is None:
+            if tracing.is_enabled():                    # Measured in the worker, the span comes back with the image
+                function, args = tracing.run_traced, (f"render.{function.__name__}", function, *args)
+            future = asyncio.get_running_loop().run_in_executor(self.render_pool, function, *args)
+            self.in_flight[key] = future
+            future.add_done_callback(lambda done: self.finish_render(key, done))
+            self.stats["renders"] += 1
+        else:
+            self.stats["coalesced_renders"] += 1
+        result = await asyncio.shield(future)
+        return result.value if isinstance(result, tracing.TracedResult) else result
+
+    # Function to forget a finished render (and keep its span when tracing)
+    def finish_render(self, key, future):
+        del self.in_flight[key]
+        if not future.cancelled() and future.exception() is None and isinstance(future.result(), tracing.TracedResult):
+            tracing.record(future.result().span)
+
+    # Function to serve one connection: requests are answered in order until the client closes it or asks to
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(read_request(reader), KEEP_ALIVE_TIMEOUT)
+                except HTTPError as e:
+                    writer.write(error_response(e, keep_alive=False))
+                    break
+                if request is None:
+                    break
+                writer.write(await self.dispatch(request))
+                await writer.drain()
+                if not request.keep_alive:
+                    break
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    # Function to answer one request: finds its route, runs it and builds the response bytes
+    async def dispatch(self, request):
+        self.stats["requests"] += 1
+        handler, args, allowed = None, (), set()
+        for method, pattern, name in COMPILED_ROUTES:
+            match = pattern.fullmatch(request.path)
+            if match:
+                allowed.add(method)
+                if method == request.method:
+                    handler = getattr(self, name)
+                    args = [urllib.parse.unquote(group) for group in match.groups()]
+                    break
+        try:
+            if handler is None:
+                raise HTTPError(HTTPStatus.METHOD_NOT_ALLOWED if allowed else HTTPStatus.NOT_FOUND)
+            with tracing.span(f"http.{handler.__name__}"):
+                status, content_type, body = await handler(request, *args)
+        except HTTPError as e:
+            self.stats["errors"] += 1
+            return error_response(e, request.keep_alive)
+        except Exception as e:
+            self.stats["errors"] += 1
+            print(f"Error answering {request.method} {request.path}: {type(e).__name__}: {e}", file=sys.stderr)
+            return error_response(HTTPError(HTTPStatus.INTERNAL_SERVER_ERROR), request.keep_alive)
+        return build_response(status, content_type, body, request.keep_alive)
+
+    # Function for GET /health
+    async def health(self, request):
+        return json_response({"status": "ok"})
+
+    # Function for GET /stats: request, error and render counters, and the plan cache's counters
+    async def get_stats(self, request):
+        return json_response(dict(self.stats, renders_in_flight=len(self.in_flight), plan_cache=planner.get_plan_cache().info()))
+
+    # Function for GET /profiles?prefix=&after=&limit=: a page of profile names in order, and the name to ask for the
+    # next page after (null on the last page)
+    async def list_profiles(self, request):
+        limit = min(max(1, int_parameter(request, "limit", planner_db.PROFILE_PAGE_SIZE)), MAX_PROFILE_PAGE)
+        names = await self.db(planner_db.get_profile_page, request.query.get("prefix", ""), request.query.get("after"),
+                              None, limit, self.db_path)
+        return json_response({"profiles": names, "next": names[-1] if len(names) == limit else None})
+
+    # Function for POST /profiles
+    async def create_profile(self, request):
+        name = str(read_json(request).get("name", "")).strip()
+        if not name:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "A profile name is required")
+        if not await self.db(add_profile, name, self.db_path):
+            raise HTTPError(HTTPStatus.CONFLICT, f"Profile '{name}' already exists")
+        return json_response({"name": name}, HTTPStatus.CREATED)
+
+    # Function for GET /profiles/<name>: the profile's most recent entry
+    async def latest_entry(self, request, name):
+        row = await self.db(planner_db.get_latest_user, name, self.db_path)
+        if row is None:
+            raise HTTPError(HTTPStatus.NOT_FOUND, f"Profile '{name}' has no history")
+        fields = ["weight", "height_ft", "height_in", "goals", "activity_level", "dietary_preferences", "allergies"]
+        return json_response(dict(zip(fields, row), profile=name))
+
+    # Function for GET /profiles/<name>/history: (unix time, bmi) rows of a date range
+    async def history(self, request, name):
+        start, end = date_range(request)
+        rows = await self.db(planner_db.get_bmi_range, name, start, end, self.db_path)
+        return json_response({"profile": name, "history": rows})
+
+    # Function for GET /profiles/<name>/progress: the downsampled progress series and a summary
+    async def progress(self, request, name):
+        start, end = date_range(request)
+        max_points = int_parameter(request, "max_points", 500)
+        return json_response(await self.db(progress_data, name, start, end, max_points, self.db_path))
+
+    # Function for GET /profiles/<name>/progress.png
+    async def progress_png(self, request, name):
+        start, end = date_range(request)
+        await self.db(planner_db.flush)                 # The worker reads the database, commit waiting rows first
+        return png_response(await self.render(("progress", name, start, end), render_progress_png, name, start, end, self.db_path))
+
+    # Function for POST /plan: BMI and full plan of the submitted measurements, saved to the profile's history
+    async def plan(self, request):
+        data = read_json(request)
+        weight, height = parse_measurements(data)
+        goals, activity_level, dietary_preferences, allergies = (str(data.get(key, "")) for key in
+                                                                 ("goals", "activity_level", "dietary_preferences", "allergies"))
+        with tracing.span("plan.make"):
+            bmi = planner.calculate_bmi(weight, height)
+            plan = planner.get_full_plan(bmi, goals, activity_level, dietary_preferences, allergies)
+        profile = data.get("profile")
+        if profile:                                     # Queued for the next batched commit, never waits for the disk
+            planner_db.insert_user((weight, height[0], height[1], goals, bmi, plan, activity_level, dietary_preferences,
+                                    allergies, str(profile)), self.db_path)
+        query = urllib.parse.urlencode({"weight": weight, "height_ft": height[0], "height_in": height[1]})
+        return json_response({"profile": profile, "bmi": bmi, "plan": plan, "chart": f"/chart.png?{query}"})
+
+    # Function for GET /chart.png: the BMI chart of a weight and height
+    async def chart_png(self, request):
+        weight, height = parse_measurements({key: request.query.get(key) for key in ("weight", "height_ft", "height_in")})
+        bmi = planner.calculate_bmi(weight, height)
+        return png_response(await self.render(("chart", weight, height), render_chart_png, weight, height, bmi))
+
+    # Function for POST /qr.png: the QR code of the request body
+    async def qr_png(self, request):
+        from qrcode.exceptions import DataOverflowError
+
+        if not request.body:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "The request body (the text to encode) is empty")
+        try:
+            text = request.body.decode("utf-8")
+        except UnicodeDecodeError:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "The request body is not UTF-8 text")
+        key = ("qr", hashlib.sha256(request.body).hexdigest())
+        try:
+            # Client text: encoded without the plan cache, so it never reaches the shared render cache on disk
+            return png_response(await self.render(key, planner.generate_qr_code_png, text))
+        except DataOverflowError:
+            raise HTTPError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, "The text is too long for a QR code")
+
+    # Function for GET /food_table.png
+    async def food_table_png(self, request):
+        return png_response(await self.render(("food_table",), planner.get_food_options_table_png))
+
+#--------------------------------------- Functions ---------------------------------------
+
+# Function to read one request from a connection; returns None when the client has closed it
+async def read_request(reader):
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+    except asyncio.IncompleteReadError as e:
+        if e.partial.strip():
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Incomplete request")
+        return None
+    except asyncio.LimitOverrunError:
+        raise HTTPError(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE)
+
+    lines = head.decode("latin-1").split("\r\n")
+    try:
+        method, target, version = lines[0].split(" ")
+    except ValueError:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, "Malformed request line")
+    headers = {}
+    for line in lines[1:]:
+        if line:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+    if "chunked" in headers.get("transfer-encoding", "").lower():
+        raise HTTPError(HTTPStatus.LENGTH_REQUIRED, "Send the body with a Content-Length")
+    try:
+        length = int(headers.get("content-length", 0))
+    except ValueError:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, "Bad Content-Length")
+    if length > MAX_BODY_BYTES:
+        raise HTTPError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+    try:
+        body = await reader.readexactly(length) if length else b""
+    except asyncio.IncompleteReadError:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, "Incomplete request body")
+
+    connection = headers.get("connection", "").lower()
+    keep_alive = connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"
+    url = urllib.parse.urlsplit(target)
+    query = {key: values[-1] for key, values in urllib.parse.parse_qs(url.query).items()}
+    return Request(method.upper(), url.path, query, headers, body, keep_alive)
+
+# Function to build the bytes of a response
+def build_response(status, content_type, body, keep_alive=True):
+    status = HTTPStatus(status)
+    head = (f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+    return head.encode("latin-1") + body
+
+# Function to build the response of an HTTPError
+def error_response(error, keep_alive=True):
+    return build_response(error.status, "application/json", json.dumps({"error": error.message}).encode(), keep_alive)
+
+# Function to answer with JSON: returns (status, content type, body)
+def json_response(data, status=HTTPStatus.OK):
+    return status, "application/json", json.dumps(data).encode()
+
+# Function to answer with a PNG image
+def png_response(png):
+    return HTTPStatus.OK, "image/png", png
+
+# Function to decode a JSON object request body (an empty body is an empty object)
+def read_json(request):
+    if not request.body:
+        return {}
+    try:
+        data = json.loads(request.body)
+    except ValueError:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, "The request body is not valid JSON")
+    if not isinstance(data, dict):
+        raise HTTPError(HTTPStatus.BAD_REQUEST, "The request body must be a JSON object")
+    return data
+
+# Function to read weight and height from a request's fields, as the form does: (weight, (feet, inches))
+def parse_measurements(data):
+    try:
+        weight = float(data["weight"])
+        height = (int(data["height_ft"]), int(data["height_in"]))
+    except (KeyError, TypeError, ValueError):
+        raise HTTPError(HTTPStatus.BAD_REQUEST, "weight, height_ft and height_in must be numbers")
+    if not weight > 0 or height[0] * 12 + height[1] <= 0:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, "weight and height must be positive")
+    return weight, height
+
+# Function to read the start and end dates of a request (YYYY-MM-DD, end excluded; the whole history by default)
+def date_range(request):
+    return request.query.get("start", planner_db.FIRST_DATE), request.query.get("end", planner_db.END_DATE)
+
+# Function to read an integer query parameter
+def int_parameter(request, name, default):
+    try:
+        return int(request.query.get(name, default))
+    except ValueError:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, f"{name} must be an integer")
+
+# Function to create a profile; returns False when the name is taken
+def add_profile(name, path):
+    try:
+        with planner_db.connection(path) as conn:
+            conn.execute("INSERT INTO profiles (name) VALUES (?)", (name,))
+    except sqlite3.IntegrityError:                  # Profile names are unique
+        return False
+    return True
+
+# Function to get the progress series and summary of a profile (JSON-ready)
+def progress_data(name, start, end, max_points, path):
+    import progress_analytics
+
+    times, bmis, resolution = progress_analytics.progress_series(name, start, end, max_points, path)
+    return {"profile": name, "resolution": resolution, "times": times.astype("int64").tolist(), "bmi": bmis.tolist(),
+            "summary": progress_analytics.progress_summary(name, start, end, path)}
+
+# Function run in a worker process: warm up the renderers so the first requests do not pay for it
+def warm_up_worker():
+    from chart_renderer import render_bmi_chart_png
+    render_bmi_chart_png(150.0, (5, 6), planner.calculate_bmi(150.0, (5, 6)))
+
+# Function run in a worker process: render a BMI chart
+def render_chart_png(weight, height, bmi):
+    from chart_renderer import render_bmi_chart_png
+    return render_bmi_chart_png(weight, height, bmi)
+
+# Function run in a worker process: render a profile's progress chart
+def render_progress_png(name, start, end, path):
+    import io
+    import matplotlib.pyplot as plt
+    import progress_analytics
+
+    figure = progress_analytics.plot_progress(name, start, end, path=path)
+    buffer = io.BytesIO()
+    figure.savefig(buffer, format="png")
+    plt.close(figure)
+    return buffer.getvalue()
+
+# Function to run the service until it is interrupted (Ctrl+C or SIGTERM)
+async def serve(service, host=DEFAULT_HOST, port=DEFAULT_PORT):
+    loop = asyncio.get_running_loop()
+    stop = loop.create_future()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signal_number, lambda: stop.done() or stop.set_result(None))
+        except (NotImplementedError, RuntimeError):     # Windows: Ctrl+C still raises KeyboardInterrupt
+            pass
+
+    server = await asyncio.start_server(service.handle_connection, host, port, limit=MAX_HEADER_BYTES, backlog=1024)
+    address = server.sockets[0].getsockname()
+    print(f"Serving on http://{address[0]}:{address[1]} with {service.workers} render workers", flush=True)
+    async with server:
+        await stop
+
+# Function for the command line interface
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the nutritional planner over HTTP.")
+    parser.add_argument("--host", default=DEFAULT_HOST, help="address to listen on (default: %(default)s)")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="port to listen on (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=RENDER_WORKERS, help="render processes (default: %(default)s)")
+    parser.add_argument("--db", default=planner_db.DB_PATH, help="history database file (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    trace_path = tracing.enable_from_env()
+    service = PlannerService(args.db, args.workers)
+    service.start()
+    try:
+        asyncio.run(serve(service, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
+        if trace_path:
+            tracing.export(trace_path)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,143 @@
+# Profile Picker for the Nutritional Planning/Tracking App
+#
+# Description: A Tk list of profile names that stays instant with millions of profiles. Only a window of names around
+# what is visible is loaded, one page at a time from the name index (see planner_db.get_profile_page): scrolling near
+# either end of the window loads the next or previous page and drops names from the other end. Typing in the search
+# box shows the names starting with what was typed (case-sensitive, like the list order). A new profile is inserted
+# where it belongs instead of reloading the list.
+
+#--------------------------------------- Imports ---------------------------------------
+
+import bisect
+import tkinter as tk
+
+import planner_db
+
+#--------------------------------------- Constants ---------------------------------------
+
+PAGE_SIZE = 100                                 # Names fetched per query
+MAX_LOADED = 500                                # Names kept in the list (the window around the visible ones)
+LOAD_MARGIN = 0.2                               # Load a page when the view is this close (fraction) to an end
+SEARCH_DELAY_MS = 150                           # Wait for a pause in typing before searching
+
+#--------------------------------------- Classes ---------------------------------------
+
+class ProfilePicker:
+
+    def __init__(self, parent, path=planner_db.DB_PATH, page_size=PAGE_SIZE, max_loaded=MAX_LOADED):
+        self.path = path
+        self.page_size = page_size
+        self.max_loaded = max(max_loaded, 2 * page_size)
+        self.names = []                             # Names in the listbox, in order
+        self.prefix = ""
+        self.at_start = self.at_end = True          # Whether the first/last name with the prefix is loaded
+        self.search_job = None
+        self.loading = False
+
+        self.frame = tk.Frame(parent)
+        self.search = tk.StringVar()
+        self.search_entry = tk.Entry(self.frame, textvariable=self.search)
+        self.search_entry.pack(fill=tk.X)
+        list_frame = tk.Frame(self.frame)
+        list_frame.pack(fill=tk.BOTH, expand=True)
+        self.scrollbar = tk.Scrollbar(list_frame, orient=tk.VERTICAL)
+        self.listbox = tk.Listbox(list_frame, exportselection=False, yscrollcommand=self.on_view_change)
+        self.scrollbar.config(command=self.listbox.yview)
+        self.listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.search.trace_add("write", self.on_search_change)
+
+    # Function to place the picker in its parent (as Frame.pack)
+    def pack(self, **options):
+        self.frame.pack(**options)
+
+    # Function to show the first page of the names starting with prefix
+    def reload(self, prefix=None):
+        if prefix is not None:
+            self.prefix = prefix
+        names = planner_db.get_profile_page(self.prefix, limit=self.page_size, path=self.path)
+        self.names = names
+        self.at_start, self.at_end = True, len(names) < self.page_size
+        self.loading = True                         # Filling the listbox moves the view, don't page while doing it
+        try:
+            self.listbox.delete(0, tk.END)
+            self.listbox.insert(tk.END, *names)
+            self.listbox.yview_moveto(0)
+        finally:
+            self.loading = False
+
+    # Function to add a newly created profile where it belongs (if it is in the loaded window of the current search)
+    def add(self, name):
+        if not name.startswith(self.prefix):
+            return
+        index = bisect.bisect_left(self.names, name)
+        if index < len(self.names) and self.names[index] == name:
+            return
+        if (index == 0 and not self.at_start) or (index == len(self.names) and not self.at_end):
+            return                                  # Outside the loaded window, it is loaded with its page
+        self.names.insert(index, name)
+        self.listbox.insert(index, name)
+
+    # Function called by the listbox when its view moves: loads a page when the view gets near an end of the window
+    def on_view_change(self, first, last):
+        self.scrollbar.set(first, last)
+        if self.loading:
+            return
+        if float(last) > 1 - LOAD_MARGIN and not self.at_end:
+            self.listbox.after_idle(self.load_next)
+        elif float(first) < LOAD_MARGIN and not self.at_start:
+            self.listbox.after_idle(self.load_previous)
+
+    # Function to load the page after the last loaded name, dropping names from the start past max_loaded
+    def load_next(self):
+        if self.loading or self.at_end or not self.names or self.listbox.yview()[1] <= 1 - LOAD_MARGIN:
+            return                                  # Already loaded by an earlier call
+        names = planner_db.get_profile_page(self.prefix, after=self.names[-1], limit=self.page_size, path=self.path)
+        self.at_end = len(names) < self.page_size
+        self.loading = True
+        try:
+            top = self.listbox.nearest(0)
+            self.names.extend(names)
+            self.listbox.insert(tk.END, *names)
+            drop = max(0, len(self.names) - self.max_loaded)
+            if drop:
+                self.drop(0, drop)
+                self.at_start = False
+            self.listbox.yview(max(0, top - drop))  # The same names stay in view
+        finally:
+            self.loading = False
+
+    # Function to load the page before the first loaded name, dropping names from the end past max_loaded
+    def load_previous(self):
+        if self.loading or self.at_start or not self.names or self.listbox.yview()[0] >= LOAD_MARGIN:
+            return
+        names = planner_db.get_profile_page(self.prefix, before=self.names[0], limit=self.page_size, path=self.path)
+        self.at_start = len(names) < self.page_size
+        self.loading = True
+        try:
+            top = self.listbox.nearest(0)
+            self.names[:0] = names
+            self.listbox.insert(0, *names)
+            drop = max(0, len(self.names) - self.max_loaded)
+            if drop:
+                self.drop(len(self.names) - drop, len(self.names))
+                self.at_end = False
+            self.listbox.yview(top + len(names))
+        finally:
+            self.loading = False
+
+    # Function to remove the loaded names [start, end)
+    def drop(self, start, end):
+        del self.names[start:end]
+        self.listbox.delete(start, end - 1)
+
+    # Function called on each change of the search box: searches after a pause in typing
+    def on_search_change(self, *args):
+        if self.search_job is not None:
+            self.frame.after_cancel(self.search_job)
+        self.search_job = self.frame.after(SEARCH_DELAY_MS, self.run_search)
+
+    # Function to show the names starting with the search text
+    def run_search(self):
+        self.search_job = None
+        self.reload(self.search.get())
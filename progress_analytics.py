@@ -0,0 +1,151 @@
+# Progress Analytics for the Nutritional Planning/Tracking App
+#
+# Description: The numbers behind "Track Progress". A profile's BMI history is read for a date range only, from the raw
+# rows when there are few of them and otherwise from the daily or weekly rollups that planner_db keeps up to date on
+# every save, so a chart never reads more than a few thousand rows whatever the length of the history. Rolling
+# averages and the trend are computed with numpy, and the series is downsampled (largest triangle three buckets) to a
+# fixed number of points before it is drawn.
+#
+# Usage: python progress_analytics.py <profile> [start] [end] [--db history.db]     (dates as YYYY-MM-DD, end excluded)
+
+#--------------------------------------- Imports ---------------------------------------
+
+import argparse
+import sys
+import numpy as np
+import planner_db
+import tracing
+
+#--------------------------------------- Constants ---------------------------------------
+
+MAX_POINTS = 500                                # Points drawn on a progress chart
+RAW_LIMIT = 5_000                               # Most raw rows read for a chart; longer ranges use the rollups
+DAY_LIMIT = 5_000                               # Most days read for a chart; longer ranges use the weekly rollup
+ROLLING_WINDOW = 7                              # Points in the rolling average
+SECONDS_PER_WEEK = 7 * 24 * 3600
+SERIES_LABELS = {"raw": "BMI", "day": "BMI (daily mean)", "week": "BMI (weekly mean)"}
+
+#--------------------------------------- Functions ---------------------------------------
+
+# Function to get the raw history of a profile between two dates as (datetime64 array, bmi array)
+def get_history_range(profile_name, start=planner_db.FIRST_DATE, end=planner_db.END_DATE, path=planner_db.DB_PATH):
+    rows = planner_db.get_bmi_range(profile_name, start, end, path)
+    data = np.array(rows, dtype=np.float64).reshape(-1, 2)
+    return data[:, 0].astype("datetime64[s]"), data[:, 1]
+
+# Function to get the daily ("day") or weekly ("week") rollup of a profile between two dates as a dict of arrays:
+# start (datetime64 of the period start), count, mean, min, max, last
+def get_rollup(profile_name, resolution="day", start=planner_db.FIRST_DATE, end=planner_db.END_DATE, path=planner_db.DB_PATH):
+    rows = planner_db.get_bmi_rollup(profile_name, resolution, start, end, path)
+    data = np.array(rows, dtype=np.float64).reshape(-1, 6)
+    return {"start": data[:, 0].astype("datetime64[s]"), "count": data[:, 1].astype(np.int64),
+            "mean": data[:, 2] / np.maximum(data[:, 1], 1), "min": data[:, 3], "max": data[:, 4], "last": data[:, 5]}
+
+# Function to compute the rolling average of the last `window` values (fewer at the start of the series)
+def rolling_mean(values, window=ROLLING_WINDOW):
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) == 0:
+        return values
+    sums = np.cumsum(values)
+    sums[window:] = sums[window:] - sums[:-window]
+    return sums / np.minimum(np.arange(1, len(values) + 1), window)
+
+# Function to fit a straight line to a series: returns the change in BMI per week (0 with fewer than two points)
+def trend(times, values):
+    if len(values) < 2:
+        return 0.0
+    seconds = (times - times[0]).astype(np.float64)
+    if seconds[-1] == seconds[0]:
+        return 0.0
+    return float(np.polyfit(seconds, values, 1)[0] * SECONDS_PER_WEEK)
+
+# Function to downsample a series to `threshold` points with largest triangle three buckets: the first and last points
+# are kept, and from each bucket in between the point making the largest triangle with the point kept before it and
+# the average of the next bucket. Returns the indexes of the points kept.
+def lttb(x, y, threshold=MAX_POINTS):
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    edges = np.append(np.linspace(1, n - 1, threshold - 1).astype(np.int64), n)    # Buckets, then the last point
+    sizes = np.diff(edges)
+    averages_x = (np.add.reduceat(x, edges[:-1]) / sizes)[1:].tolist()   # Average of the bucket after each bucket
+    averages_y = (np.add.reduceat(y, edges[:-1]) / sizes)[1:].tolist()
+    edges, points_x, points_y = edges.tolist(), x.tolist(), y.tolist()
+    kept = [0]
+    for bucket in range(threshold - 2):
+        start, end, a = edges[bucket], edges[bucket + 1], kept[-1]
+        # Twice the triangle's area is |dx * (y - y_a) - dy * (x - x_a)| with (dx, dy) from point a to the average
+        dx, dy = averages_x[bucket] - points_x[a], averages_y[bucket] - points_y[a]
+        areas = np.abs(dx * y[start:end] - dy * x[start:end] + (dy * points_x[a] - dx * points_y[a]))
+        kept.append(start + int(areas.argmax()))
+    kept.append(n - 1)
+    return np.array(kept)
+
+# Function to get the series to chart for a profile between two dates, reading raw rows, daily or weekly rollups
+# depending on how many rows the range holds: returns (datetime64 array, bmi array, resolution) with at most
+# `max_points` points ("raw", "day" or "week"; rollup points are period means)
+@tracing.traced("progress.series")
+def progress_series(profile_name, start=planner_db.FIRST_DATE, end=planner_db.END_DATE, max_points=MAX_POINTS, path=planner_db.DB_PATH):
+    daily = get_rollup(profile_name, "day", start, end, path)
+    if daily["count"].sum() <= RAW_LIMIT:
+        times, bmis = get_history_range(profile_name, start, end, path)
+        resolution = "raw"
+    elif len(daily["start"]) <= DAY_LIMIT:
+        times, bmis, resolution = daily["start"], daily["mean"], "day"
+    else:
+        weekly = get_rollup(profile_name, "week", start, end, path)
+        times, bmis, resolution = weekly["start"], weekly["mean"], "week"
+
+    kept = lttb(times.astype(np.int64), bmis, max_points)
+    return times[kept], bmis[kept], resolution
+
+# Function to get a summary of a profile's progress between two dates: readings, first/last/min/max BMI, the change
+# and the trend per week (computed from the daily rollup)
+def progress_summary(profile_name, start=planner_db.FIRST_DATE, end=planner_db.END_DATE, path=planner_db.DB_PATH):
+    daily = get_rollup(profile_name, "day", start, end, path)
+    if len(daily["start"]) == 0:
+        return {"readings": 0}
+    return {"readings": int(daily["count"].sum()), "first": float(daily["mean"][0]), "last": float(daily["last"][-1]),
+            "min": float(daily["min"].min()), "max": float(daily["max"].max()),
+            "change": float(daily["last"][-1] - daily["mean"][0]), "trend_per_week": trend(daily["start"], daily["mean"])}
+
+# Function to draw a profile's progress between two dates on a new pyplot figure: the BMI points, their rolling
+# average and the trend in the title; returns the figure
+def plot_progress(profile_name, start=planner_db.FIRST_DATE, end=planner_db.END_DATE, max_points=MAX_POINTS, path=planner_db.DB_PATH):
+    import matplotlib.pyplot as plt
+
+    times, bmis, resolution = progress_series(profile_name, start, end, max_points, path)
+    with tracing.span("progress.plot", points=len(times)):
+        figure = plt.figure(figsize=(10, 5))
+        plt.plot(times, bmis, marker='o', markersize=3, linestyle='', label=SERIES_LABELS[resolution])
+        if len(times):
+            plt.plot(times, rolling_mean(bmis), label=f'{ROLLING_WINDOW}-point average')
+            plt.legend(loc='upper right')
+        plt.title(f'BMI Progress Over Time (trend {trend(times, bmis):+.2f} per week)')
+        plt.xlabel('Date')
+        plt.ylabel('BMI')
+        plt.xticks(rotation=45)
+        plt.tight_layout()
+    return figure
+
+#--------------------------------------- Command Line ---------------------------------------
+
+# Function for the command line interface
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Summarize a profile's BMI progress over a date range.")
+    parser.add_argument("profile", help="profile name")
+    parser.add_argument("start", nargs="?", default=planner_db.FIRST_DATE, help="first date (YYYY-MM-DD)")
+    parser.add_argument("end", nargs="?", default=planner_db.END_DATE, help="date after the last one (YYYY-MM-DD)")
+    parser.add_argument("--db", default=planner_db.DB_PATH, help="history database file (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    for key, value in progress_summary(args.profile, args.start, args.end, args.db).items():
+        print(f"{key}: {value:.2f}" if isinstance(value, float) else f"{key}: {value}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,89 @@
+# QR Code Renderer for the Nutritional Planning/Tracking App
+#
+# Description: Makes QR codes with qrcode.make (box size 10, border 4), in memory. Codes are returned as PNG bytes or
+# a PIL image and only written to disk when asked, under a name derived from their content and renamed into place, so
+# concurrent writers never clobber each other. Identical payloads are encoded once, and batches can be spread over
+# several processes.
+
+#--------------------------------------- Imports ---------------------------------------
+
+import functools
+import hashlib
+import io
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import qrcode
+
+#--------------------------------------- Constants ---------------------------------------
+
+BOX_SIZE = 10                                   # Pixels per module (qrcode.make default)
+BORDER = 4                                      # Light modules around the code (qrcode.make default)
+ERROR_CORRECTION = qrcode.constants.ERROR_CORRECT_M
+PNG_CACHE_SIZE = 4096                           # Encoded codes kept per process
+BATCH_CHUNK_SIZE = 64                           # Payloads sent to a worker process at a time
+
+#--------------------------------------- Functions ---------------------------------------
+
+# Function to get the QR code of some data as PNG bytes (identical payloads are only encoded once per process)
+@functools.lru_cache(maxsize=PNG_CACHE_SIZE)
+def qr_png(data):
+    buffer = io.BytesIO()
+    qrcode.make(data, error_correction=ERROR_CORRECTION, box_size=BOX_SIZE, border=BORDER).save(buffer)
+    return buffer.getvalue()
+
+# Function to get the QR code of some data as a PIL image
+def qr_image(data):
+    from PIL import Image
+    image = Image.open(io.BytesIO(qr_png(data)))
+    image.load()
+    return image
+
+# Function to get the content-addressed file name of a QR code
+def qr_filename(data):
+    return f"qr_{hashlib.sha256(str(data).encode()).hexdigest()[:32]}.png"
+
+# Function to write a QR code to qr_path, or under its content-addressed name in directory; the file is written under
+# a temporary name and renamed, so readers and concurrent writers only ever see complete files. Returns the path.
+def save_qr_code(data, qr_path=None, directory="."):
+    if qr_path is None:
+        qr_path = os.path.join(directory, qr_filename(data))
+        if os.path.exists(qr_path):             # Same content, already written
+            return qr_path
+    write_file(qr_path, qr_png(data))
+    return qr_path
+
+# Function to write a file atomically
+def write_file(path, data):
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(temp_path, "wb") as file:
+            file.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+# Function to make the QR codes of many payloads, each distinct payload once, over several processes (workers=1 runs
+# in this process). Returns PNG bytes in the order of the payloads, or file paths when output_dir is given.
+def generate_qr_batch(payloads, workers=None, output_dir=None):
+    payloads = list(payloads)
+    unique = list(dict.fromkeys(payloads))
+    workers = min(workers or os.cpu_count() or 1, max(1, len(unique) // BATCH_CHUNK_SIZE))
+
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+        encode = functools.partial(save_qr_code, directory=output_dir)
+    else:
+        encode = qr_png
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = dict(zip(unique, pool.map(encode, unique, chunksize=BATCH_CHUNK_SIZE)))
+    else:
+        results = {data: encode(data) for data in unique}
+    return [results[data] for data in payloads]
@@ -0,0 +1,140 @@
+# Render Cache for the Nutritional Planning/Tracking App
+#
+# Description: Stores rendered artifacts (images and other files that only depend on their inputs) on disk under a
+# hash of those inputs, so the same artifact is only ever rendered once. The cache is bounded in size (least recently
+# used files are removed first) and can be shared by several processes: files are written under a temporary name and
+# renamed into place. A running total of the bytes stored is kept in a small file under a lock file, so a write costs
+# the same whatever the number of files; the directory is only scanned when the total goes over the limit, and then
+# files are removed until the cache is LOW_WATER full, so the next scan is many writes away.
+
+#--------------------------------------- Imports ---------------------------------------
+
+import hashlib
+import json
+import os
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl                                    # File locks between processes (not available on Windows)
+except ImportError:
+    fcntl = None
+
+#--------------------------------------- Constants ---------------------------------------
+
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")), "nutritional_planner")
+MAX_CACHE_BYTES = 256 * 1024 * 1024
+LOW_WATER = 0.9                                 # Eviction removes files until the cache is this fraction of its limit
+LOCK_FILE = ".lock"
+SIZE_FILE = ".size"                             # Running total of the bytes stored (read and written under the lock)
+
+#--------------------------------------- Classes ---------------------------------------
+
+class RenderCache:
+
+    def __init__(self, directory=CACHE_DIR, max_bytes=MAX_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    # Function to hash an artifact's inputs (anything JSON can encode) into its cache key
+    @staticmethod
+    def key(inputs):
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+    # Function to get the file an artifact is stored in
+    def path(self, key, extension=".png"):
+        return os.path.join(self.directory, key + extension)
+
+    # Function to get the path of a stored artifact, or None on a miss
+    def get_path(self, key, extension=".png"):
+        path = self.path(key, extension)
+        try:
+            os.utime(path)                          # Mark as recently used for eviction
+        except FileNotFoundError:
+            return None
+        except OSError:
+            if not os.path.exists(path):            # Read-only cache, the file can still be used
+                return None
+        return path
+
+    # Function to get the bytes of a stored artifact, or None on a miss
+    def get(self, key, extension=".png"):
+        path = self.get_path(key, extension)
+        if path is None:
+            return None
+        try:
+            with open(path, "rb") as file:
+                return file.read()
+        except FileNotFoundError:                   # Evicted by another process in the meantime
+            return None
+
+    # Function to store an artifact; returns its path, or None if the cache directory cannot be written
+    def put(self, key, data, extension=".png"):
+        path = self.path(key, extension)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(temp_path, "wb") as file:
+                file.write(data)
+            try:
+                replaced = os.stat(path).st_size    # Same key stored again, its old bytes go away
+            except FileNotFoundError:
+                replaced = 0
+            os.replace(temp_path, path)             # Readers only ever see complete files
+        except OSError:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            return None
+        self.add_size(len(data) - replaced)
+        return path
+
+    # Function to hold the cache's lock file (one process updates the total or evicts at a time)
+    @contextmanager
+    def lock(self):
+        with open(os.path.join(self.directory, LOCK_FILE), "w") as lock:
+            if fcntl:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    # Function to add to the running total of the bytes stored, evicting when it goes over max_bytes; the directory is
+    # only scanned then, or when there is no total yet (a new or older cache)
+    def add_size(self, delta):
+        size_path = os.path.join(self.directory, SIZE_FILE)
+        try:
+            with self.lock():
+                try:
+                    with open(size_path) as file:
+                        total = int(file.read()) + delta
+                except (OSError, ValueError):
+                    total = None
+                if total is None or total > self.max_bytes:
+                    total = self.evict(int(self.max_bytes * LOW_WATER) if total is not None else self.max_bytes)
+                with open(size_path, "w") as file:
+                    file.write(str(total))
+        except OSError:
+            pass
+
+    # Function to remove the least recently used artifacts until the cache fits in target bytes (called holding the
+    # lock); returns the bytes left
+    def evict(self, target):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.startswith(".") and not entry.name.endswith(".tmp"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        return total
@@ -0,0 +1,77 @@
+# Startup Time Report for the Nutritional Planning/Tracking App
+#
+# Description: Imports the app's modules in a fresh Python process with "-X importtime" and prints a summary: the
+# total cold import time of each module and the slowest imports it pulled in. With --budget-ms the report fails
+# (exit code 1) when a module takes longer than the budget, so import-time regressions can be caught early.
+#
+# Usage: python startup_report.py [modules ...] [--top 15] [--repeat 3] [--budget-ms 50]
+#        python nutritional_planner.py --startup-report
+
+#--------------------------------------- Imports ---------------------------------------
+
+import argparse
+import os
+import subprocess
+import sys
+
+#--------------------------------------- Constants ---------------------------------------
+
+DEFAULT_MODULES = ["nutritional_planner", "planner_db"]
+
+#--------------------------------------- Functions ---------------------------------------
+
+# Function to import a module in a new interpreter and return the imports it caused (not the interpreter's own
+# startup imports) as a list of (self microseconds, cumulative microseconds, module name), the module itself last
+def measure_imports(module):
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    if result.returncode != 0:
+        raise RuntimeError(f"importing {module} failed:\n{result.stderr}")
+
+    timings = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2           # Nested imports are indented two spaces per level
+        timings.append((int(self_us), int(cumulative_us), name.strip(), depth))
+
+    end = max(i for i, timing in enumerate(timings) if timing[2] == module and timing[3] == 0)
+    start = end
+    while start > 0 and timings[start - 1][3] > 0:                  # Imports are listed after the modules they load
+        start -= 1
+    return [timing[:3] for timing in timings[start:end + 1]]
+
+# Function to print the report for one module (fastest of several runs, to filter out noise from a busy machine);
+# returns its total import time in milliseconds
+def report(module, top=15, repeat=3):
+    timings = min((measure_imports(module) for _ in range(repeat)), key=lambda run: run[-1][1])
+    total_ms = timings[-1][1] / 1000
+
+    print(f"{module}: {total_ms:.1f} ms cold import, {len(timings)} modules loaded")
+    for self_us, cumulative_us, name in sorted(timings, key=lambda timing: timing[1], reverse=True)[1:top + 1]:
+        print(f"    {cumulative_us / 1000:8.1f} ms  (self {self_us / 1000:6.1f} ms)  {name}")
+    return total_ms
+
+# Function for the command line interface
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Report the cold import time of the app's modules.")
+    parser.add_argument("modules", nargs="*", default=DEFAULT_MODULES, help="modules to import (default: %(default)s)")
+    parser.add_argument("--top", type=int, default=15, help="number of slowest imports to list per module")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per module, the fastest one is reported")
+    parser.add_argument("--budget-ms", type=float, help="fail if any module takes longer than this to import")
+    args = parser.parse_args(argv)
+
+    over_budget = []
+    for module in args.modules:
+        total_ms = report(module, args.top, args.repeat)
+        if args.budget_ms is not None and total_ms > args.budget_ms:
+            over_budget.append(module)
+
+    if over_budget:
+        print(f"Over the {args.budget_ms:g} ms budget: {', '.join(over_budget)}")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,209 @@
+# Tracing for the Nutritional Planning/Tracking App
+#
+# Description: Named spans around the stages of a submit and the database helpers, each recording its wall time, CPU
+# time and memory (peak traced memory when tracemalloc is running, and the process's peak RSS). Tracing is off by
+# default and then a span is a shared no-op context manager, so the spans can stay in the code. When on, finished
+# spans are kept in memory (bounded) and exported as JSON lines or in Chrome's trace format (chrome://tracing,
+# Perfetto). profile_run wraps a whole run in cProfile and tracemalloc and dumps both when it ends.
+#
+# Usage: python nutritional_planner.py --trace=spans.jsonl      (or --trace=trace.json for the Chrome format)
+#        python nutritional_planner.py --profile=submit_profile (writes submit_profile.prof and submit_profile_memory.txt)
+#        PLANNER_TRACE=spans.jsonl python batch_pipeline.py users.csv
+
+#--------------------------------------- Imports ---------------------------------------
+
+import collections
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource                                 # Peak RSS (not available on Windows)
+except ImportError:
+    resource = None
+
+#--------------------------------------- Constants ---------------------------------------
+
+MAX_SPANS = 100_000                             # Finished spans kept in memory, oldest dropped first
+TRACE_ENV = "PLANNER_TRACE"                     # Environment variable naming the file to export the spans to
+
+TracedResult = collections.namedtuple("TracedResult", ["value", "span"])     # What run_traced returns
+
+_tracer = None                                  # Tracer while tracing is on
+_null_span = contextlib.nullcontext()           # What span() returns while tracing is off
+_current_span = contextvars.ContextVar("current_span", default=None)   # Innermost open span of each thread/asyncio task
+
+#--------------------------------------- Classes ---------------------------------------
+
+class Tracer:
+
+    def __init__(self, max_spans=MAX_SPANS):
+        self.spans = collections.deque(maxlen=max_spans)
+        self.origin = time.time() - time.perf_counter()     # Turns perf_counter readings into wall-clock times
+
+    # Function to keep a finished span
+    def record(self, span):
+        self.spans.append(span)
+
+
+class Span:
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.child_peak = 0                         # Highest traced memory reached before the last child span started
+
+    def __enter__(self):
+        parent = _current_span.get()                # Follows await (each task has its own context), unlike a thread local
+        self.parent = parent if parent is not None and parent.tracer is self.tracer else None
+        self.token = _current_span.set(self)
+        if memory_tracing():
+            import tracemalloc
+            if self.parent is not None:             # Keep the parent's peak so far before resetting it for this span
+                self.parent.child_peak = max(self.parent.child_peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        self.cpu_start = time.thread_time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        end = time.perf_counter()
+        cpu = time.thread_time() - self.cpu_start
+        _current_span.reset(self.token)
+        span = {
+            "name": self.name,
+            "start": self.tracer.origin + self.start,
+            "wall_ms": (end - self.start) * 1000,
+            "cpu_ms": cpu * 1000,
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "parent": self.parent.name if self.parent else None,
+        }
+        if memory_tracing():
+            import tracemalloc
+            span["peak_kb"] = max(tracemalloc.get_traced_memory()[1], self.child_peak) / 1024
+        if resource is not None:
+            span["max_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if self.args:
+            span["args"] = self.args
+        if exc_type is not None:
+            span["error"] = exc_type.__name__
+        self.tracer.record(span)
+        return False
+
+#--------------------------------------- Functions ---------------------------------------
+
+# Function to open a span: "with span('submit.plan'):" (a shared no-op while tracing is off)
+def span(name, **args):
+    if _tracer is None:
+        return _null_span
+    return Span(_tracer, name, args)
+
+# Function to decorate a function so every call is a span
+def traced(name):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _tracer is None:
+                return function(*args, **kwargs)
+            with Span(_tracer, name, {}):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# Function to run a function in a span that is returned with its result, for work done in another process:
+# returns a TracedResult; the calling process keeps the span with record()
+def run_traced(name, function, *args):
+    tracer = Tracer(max_spans=1)
+    with Span(tracer, name, {}):
+        value = function(*args)
+    return TracedResult(value, tracer.spans[0])
+
+# Function to keep a span measured elsewhere (e.g. returned by run_traced from a worker process)
+def record(span):
+    if _tracer is not None:
+        _tracer.record(span)
+
+# Function to tell whether tracing is on
+def is_enabled():
+    return _tracer is not None
+
+# Function to tell whether tracemalloc is recording (memory is then measured per span)
+def memory_tracing():
+    tracemalloc = sys.modules.get("tracemalloc")    # Never imported just to ask
+    return tracemalloc is not None and tracemalloc.is_tracing()
+
+# Function to turn tracing on
+def enable(max_spans=MAX_SPANS):
+    global _tracer
+    if _tracer is None:
+        _tracer = Tracer(max_spans)
+    return _tracer
+
+# Function to turn tracing off; returns the spans recorded
+def disable():
+    global _tracer
+    tracer, _tracer = _tracer, None
+    return list(tracer.spans) if tracer else []
+
+# Function to get the spans recorded so far
+def get_spans():
+    return list(_tracer.spans) if _tracer else []
+
+# Function to export spans: Chrome trace format for a .json path, JSON lines otherwise
+def export(path, spans=None):
+    spans = get_spans() if spans is None else spans
+    with open(path, "w") as file:
+        if path.endswith(".json"):
+            json.dump(chrome_trace(spans), file)
+        else:
+            for span in spans:
+                file.write(json.dumps(span) + "\n")
+    return path
+
+# Function to convert spans into Chrome's trace event format (complete events, times in microseconds)
+def chrome_trace(spans):
+    events = []
+    for span in spans:
+        args = dict(span.get("args", {}))
+        args.update({key: span[key] for key in ("cpu_ms", "peak_kb", "max_rss_kb", "error") if key in span})
+        events.append({"name": span["name"], "ph": "X", "ts": span["start"] * 1e6, "dur": span["wall_ms"] * 1000,
+                       "pid": span["pid"], "tid": span["tid"], "args": args})
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+# Function to turn tracing on when the PLANNER_TRACE environment variable (or trace_path) names an export file;
+# returns the path the spans should be exported to at the end, or None
+def enable_from_env(trace_path=None):
+    trace_path = trace_path or os.environ.get(TRACE_ENV)
+    if trace_path:
+        enable()
+    return trace_path
+
+# Function to profile everything run inside the block with cProfile and tracemalloc (spans then record their peak
+# memory too); writes <prefix>.prof (open with pstats or snakeviz) and <prefix>_memory.txt (top allocation sites)
+@contextlib.contextmanager
+def profile_run(prefix, memory_frames=10, top=50):
+    import cProfile
+    import tracemalloc
+
+    profiler = cProfile.Profile()
+    tracemalloc.start(memory_frames)
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        profiler.dump_stats(f"{prefix}.prof")
+        with open(f"{prefix}_memory.txt", "w") as file:
+            file.write(f"Traced memory: {current / 1024:.1f} KiB at the end, {peak / 1024:.1f} KiB at the peak\n\n")
+            for statistic in snapshot.statistics("lineno")[:top]:
+                file.write(f"{statistic}\n")